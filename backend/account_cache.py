@@ -0,0 +1,79 @@
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+
+def fingerprint(*details: str) -> str:
+    "Hash of the account details a cached Method account was created from, raw account numbers are never stored."
+    return hashlib.sha256('|'.join(details).encode()).hexdigest()
+
+
+@dataclass
+class CachedAccount:
+    entity_id: str
+    account_id: str
+    fingerprint: str
+
+
+class AccountCache:
+    """
+    DunkinId -> Method entity/account ids, persisted in Mongo with an in-process LRU in front of it.
+    Entries are kept per Method environment, ids created in dev are never used against production.
+    An entry whose fingerprint no longer matches the account details is stale, the entity can be reused
+    but the account has to be recreated.
+    """
+    def __init__(self, collection: AsyncIOMotorCollection, max_size: int = 10000, env: str = 'dev'):
+        self.collection = collection
+        self.max_size = max_size
+        self.env = env
+        self._lru: OrderedDict = OrderedDict()
+
+    def key(self, kind: str, dunkin_id: str) -> str:
+        return f'{self.env}:{kind}:{dunkin_id}'
+
+    async def get_many(self, kind: str, dunkin_ids: Iterable[str]) -> Dict[str, CachedAccount]:
+        "Cached accounts by DunkinId, the ones missing from the LRU are fetched with a single query."
+        result = {}
+        missing = []
+        for dunkin_id in dunkin_ids:
+            key = self.key(kind, dunkin_id)
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                result[dunkin_id] = self._lru[key]
+            else:
+                missing.append(key)
+        if missing:
+            async for document in self.collection.find({'_id': {'$in': missing}}):
+                cached = CachedAccount(entity_id=document['entity_id'], account_id=document['account_id'], fingerprint=document['fingerprint'])
+                result[document['dunkin_id']] = cached
+                self._remember(document['_id'], cached)
+        return result
+
+    async def set_many(self, kind: str, accounts: Dict[str, CachedAccount]):
+        now = datetime.utcnow()
+        updates: List[UpdateOne] = []
+        for dunkin_id, cached in accounts.items():
+            key = self.key(kind, dunkin_id)
+            updates.append(UpdateOne({'_id': key},
+                                     {'$set': {'env': self.env,
+                                               'kind': kind,
+                                               'dunkin_id': dunkin_id,
+                                               'entity_id': cached.entity_id,
+                                               'account_id': cached.account_id,
+                                               'fingerprint': cached.fingerprint,
+                                               'date_updated': now}},
+                                     upsert=True))
+            self._remember(key, cached)
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False)
+
+    def _remember(self, key: str, cached: CachedAccount):
+        self._lru[key] = cached
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
@@ -0,0 +1,58 @@
+"""
+Parse and validation throughput of the per-row pydantic path against the bulk column path.
+
+    python -m benchmarks.bench_ingest --rows 100000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import types
+
+from benchmarks.synthetic import write_payroll_xml
+from models import parse_date, transactions_from_records
+from xml_parser import iter_row_elements, parse_record, parse_row
+
+
+def timed(fn) -> float:
+    parse_date.cache_clear()
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run(path: str) -> dict:
+    with open(path, 'rb') as file:
+        start = time.perf_counter()
+        elements = [element for chunk in iter_row_elements(types.SimpleNamespace(file=file)) for element in chunk]
+        parse = time.perf_counter() - start
+    per_row = timed(lambda: [parse_row(element) for element in elements])
+    bulk = timed(lambda: transactions_from_records([parse_record(element) for element in elements]))
+    rows = len(elements)
+    return {
+        'rows': rows,
+        'parse_seconds': round(parse, 3),
+        'per_row_validation_seconds': round(per_row, 3),
+        'bulk_validation_seconds': round(bulk, 3),
+        'per_row_rows_per_second': round(rows / (parse + per_row)),
+        'bulk_rows_per_second': round(rows / (parse + bulk)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--employees', type=int, default=20000)
+    parser.add_argument('--payors', type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as out:
+        write_payroll_xml(out, args.rows, args.employees, args.payors)
+    try:
+        print(json.dumps(run(out.name), indent=2))
+    finally:
+        os.unlink(out.name)
+
+
+if __name__ == '__main__':
+    main()
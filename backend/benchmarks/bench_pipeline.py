@@ -0,0 +1,218 @@
+"""
+End to end timing of one synthetic batch through upload, create, invoke and report against a fake Method api.
+
+    python -m benchmarks.bench_pipeline --rows 100000 --malformed 0.01 --output baseline.json
+    python -m benchmarks.bench_pipeline --rows 100000 --malformed 0.01 --baseline baseline.json
+
+The API handlers' steps and the worker jobs run in this process, on a local mongod in a scratch database
+that is dropped before and after the run. Results are written as JSON: the seconds of every step, the
+per stage totals of the pipeline metrics, the Method calls and the batch counters. With --baseline the
+seconds are compared with an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+from account_cache import AccountCache
+from benchmarks.fake_method import FakeMethod, FakeMethodApi
+from benchmarks.synthetic import write_payroll_xml
+from dedup import UploadHashes
+from fastapi import UploadFile
+from indexes import ensure_indexes
+from ingest import Ingestor
+from jobs import INGEST, PAYOUT, JobQueue, WorkerRegistry
+from metrics import METRICS
+from models import Batch, BatchStatus, format_cents
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
+from payouts import PayoutRunner
+from reconcile import Reconciler
+from reports import BRANCH_COLUMNS, PAYMENT_COLUMNS, SOURCE_ACCOUNT_COLUMNS, iter_csv
+from repository import BatchRepository, IngestErrorRepository, ProgressRepository, TransactionRepository, create_client
+from rollups import BRANCH, SOURCE, BatchRollups
+from worker import Worker
+
+STEPS = ('upload', 'create', 'invoke', 'report')
+
+
+@contextmanager
+def stopwatch(results: Dict[str, float], step: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        results[step] = round(time.perf_counter() - start, 3)
+
+
+def create_workers(db: AsyncIOMotorDatabase, method: FakeMethod, args) -> List[Worker]:
+    "Workers wired like worker.create_worker, sharing one Method client as the jobs of one process would."
+    progress = ProgressRepository(db["batch_progress"])
+    batches = BatchRepository(db["batches"], db["versions"], progress)
+    transactions = TransactionRepository(db["transactions"])
+    rollups = BatchRollups(db["batch_rollups"], transactions)
+    ingestor = Ingestor(method, batches, transactions, IngestErrorRepository(db["ingest_errors"]), rollups,
+                        AsyncIOMotorGridFSBucket(db, "uploads"), AccountCache(db["method_accounts"]), UploadHashes(db["upload_hashes"], db["row_hashes"]), progress)
+    payouts = PayoutRunner(method, batches, transactions, db["payout_jobs"], rollups, args.chunk_size, args.shard_size, progress)
+    queue = JobQueue(db["job_queue"])
+    registry = WorkerRegistry(db["workers"])
+    return [Worker(queue, registry, ingestor, payouts, f'bench-{index}', lease_seconds=600, poll_interval=0)
+            for index in range(args.workers)]
+
+
+async def drain(workers: List[Worker]):
+    "Run queued jobs until the queue is empty, the workers claim them concurrently."
+    async def work(worker: Worker):
+        while True:
+            job = await worker.queue.claim(worker.worker_id, worker.lease_seconds)
+            if job is None:
+                return
+            await worker.run_job(job)
+    await asyncio.gather(*[work(worker) for worker in workers])
+
+
+async def consume(rows, columns: List[str]) -> int:
+    size = 0
+    async for chunk in iter_csv(rows, columns):
+        size += len(chunk)
+    return size
+
+
+async def run_pipeline(path: str, workers: List[Worker], steps: Dict[str, float]) -> str:
+    "Same steps as POST /upload/xml, POST /invoke-payment/{id} and the report endpoints, with the jobs run in between."
+    worker = workers[0]
+    ingestor, payouts, queue = worker.ingestor, worker.payouts, worker.queue
+    with stopwatch(steps, 'upload'):
+        with open(path, 'rb') as file:
+            file_id, content_hash = await ingestor.save_upload(UploadFile(os.path.basename(path), file=file))
+        batch = Batch(batch_name='bench', total_transactions=0, valid_transactions=0, invalid_transactions=0, content_hash=content_hash)
+        await ingestor.hashes.claim_upload(content_hash, str(batch.id))
+        await ingestor.batches.insert(batch)
+        await queue.enqueue(INGEST, str(batch.id), {'file_id': file_id})
+    batch_id = str(batch.id)
+    with stopwatch(steps, 'create'):
+        await drain(workers)
+    with stopwatch(steps, 'invoke'):
+        if not await ingestor.batches.transition(batch_id, BatchStatus.PROCESSING):
+            raise RuntimeError(f'Batch {batch_id} was not created')
+        # As if invoked with force, rows with a missing account are still skipped.
+        _, skipped = await Reconciler(ingestor.transactions).check(batch_id)
+        _, shards = await payouts.start(batch_id, skipped)
+        if shards:
+            await queue.enqueue_many(PAYOUT, batch_id, shards)
+            await drain(workers)
+        else:
+            await payouts.complete(batch_id)
+    with stopwatch(steps, 'report'):
+        rollups = payouts.rollups
+        await consume(({"Source Account": row["key"], "Total Amount": format_cents(row["total"])} async for row in await rollups.totals(batch_id, SOURCE)),
+                      SOURCE_ACCOUNT_COLUMNS)
+        await consume(({"Dunkin branch Id": row["key"], "Total Amount": format_cents(row["total"])} async for row in await rollups.totals(batch_id, BRANCH)),
+                      BRANCH_COLUMNS)
+        await consume((tnx['payment'] async for tnx in ingestor.transactions.payments(batch_id)), PAYMENT_COLUMNS)
+    return batch_id
+
+
+def stage_totals(snapshot: dict, before: dict) -> Dict[str, Dict[str, float]]:
+    "Seconds and count per pipeline stage, and per Method operation, added to the process metrics since before."
+    earlier = {(histogram['name'], tuple(histogram['labels'].items())): histogram for histogram in before['histograms']}
+    totals = {}
+    for histogram in snapshot['histograms']:
+        if histogram['name'] == 'stage_duration_seconds':
+            key = histogram['labels']['stage']
+        elif histogram['name'] == 'method_call_duration_seconds':
+            key = f"method.{histogram['labels']['operation']}"
+        else:
+            continue
+        previous = earlier.get((histogram['name'], tuple(histogram['labels'].items())), {'sum': 0.0, 'count': 0})
+        if histogram['count'] > previous['count']:
+            totals[key] = {'seconds': round(histogram['sum'] - previous['sum'], 3), 'count': histogram['count'] - previous['count']}
+    return totals
+
+
+def compare(current: dict, baseline: dict) -> Dict[str, dict]:
+    "Relative change of every timing present in both runs, positive is slower."
+    result = {}
+    pairs = [(f'steps.{step}', current['steps'].get(step), baseline['steps'].get(step)) for step in STEPS]
+    pairs.append(('total_seconds', current['total_seconds'], baseline['total_seconds']))
+    pairs += [(f'stages.{stage}', values['seconds'], baseline['stages'].get(stage, {}).get('seconds'))
+              for stage, values in current['stages'].items()]
+    for key, now, before in pairs:
+        if now is not None and before:
+            result[key] = {'baseline': before, 'current': now, 'change': round(now / before - 1, 3)}
+    return result
+
+
+async def run(args) -> dict:
+    client = create_client(args.mongo_uri)
+    db = client[args.database]
+    api = FakeMethodApi(calls=args.api_calls or args.calls + 1, period=args.period, latency=args.latency,
+                        error_rate=args.error_rate, seed=args.seed)
+    method = FakeMethod(api, calls=args.calls, period=args.period, max_in_flight=args.max_in_flight)
+    with tempfile.NamedTemporaryFile('w', suffix='.xml', delete=False) as out:
+        malformed = write_payroll_xml(out, args.rows, args.employees, args.payors, args.seed, args.malformed)
+    workers = create_workers(db, method, args)
+    steps: Dict[str, float] = {}
+    try:
+        await client.drop_database(args.database)
+        await ensure_indexes(db)
+        metrics = METRICS.snapshot()
+        start = time.perf_counter()
+        batch_id = await run_pipeline(out.name, workers, steps)
+        total = time.perf_counter() - start
+        batch = await workers[0].ingestor.batches.get(batch_id)
+    finally:
+        os.unlink(out.name)
+        await client.drop_database(args.database)
+    return {
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'mongo_uri')},
+        'rows': args.rows,
+        'malformed_rows': malformed,
+        'steps': steps,
+        'total_seconds': round(total, 3),
+        'rows_per_second': round(args.rows / total) if total else None,
+        'stages': stage_totals(METRICS.snapshot(), metrics),
+        'batch': {key: batch.get(key) for key in ('status', 'total_transactions', 'valid_transactions', 'invalid_transactions',
+                                                  'rejected_rows', 'duplicate_rows', 'distinct_employees', 'distinct_payors', 'cache_hits', 'cache_misses')},
+        'method': {'calls': len(api.call_times), 'rejected': api.rejected, 'max_calls_in_window': api.max_calls_in_window(),
+                   'rate_limit': method.rate_limiter.stats()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--employees', type=int, default=2000)
+    parser.add_argument('--payors', type=int, default=20)
+    parser.add_argument('--malformed', type=float, default=0.0, help='share of malformed rows, between 0 and 1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per fake Method call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of fake Method calls that fail')
+    parser.add_argument('--calls', type=int, default=100000, help='client side rate limit, calls per period')
+    parser.add_argument('--api-calls', type=int, default=None, help='limit enforced by the fake api, defaults to calls + 1')
+    parser.add_argument('--period', type=float, default=60)
+    parser.add_argument('--max-in-flight', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=1, help='concurrent job workers')
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--shard-size', type=int, default=5000)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='bench_pipeline', help='scratch database, dropped before and after the run')
+    parser.add_argument('--output', default=None, help='write the results to this file')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare with')
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline) as file:
+            results['comparison'] = compare(results, json.load(file))
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Drive TransactionService and payouts through the executor against FakeMethodApi and check the budget.
+
+    python -m benchmarks.bench_rate_limit --employees 200 --calls 60 --period 5
+
+With --shared N, N clients (standing in for worker processes) split the transactions and share one
+Mongo backed limiter, on --mongo-uri or on an in-memory mongomock database when no uri is given.
+
+    python -m benchmarks.bench_rate_limit --shared 4 --mongo-uri mongodb://localhost:27017
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Optional
+
+from benchmarks.fake_method import FakeMethod, FakeMethodApi
+from method_manager import TransactionService
+from models import Address, Employee, Payee, Payor, Transaction
+from pymongo import MongoClient
+from rate_limiter import RateLimiter
+
+
+def make_transactions(employees: int, payors: int):
+    result = []
+    for i in range(employees):
+        result.append(Transaction(
+            Employee=Employee(DunkinId=f'EMP-{i}', DunkinBranch=f'BRC-{i % payors}', FirstName='First', LastName='Last', DOB='2000-01-01', PhoneNumber='+15121231111'),
+            Payor=Payor(DunkinId=f'CORP-{i % payors}', ABARouting='148386123', AccountNumber='12719660', Name="Dunkin' Donuts LLC", DBA="Dunkin' Donuts", EIN='32120240',
+                        Address=Address(Line1='999 Hayes Lights', City='Kerlukemouth', State='IA', Zip='50001')),
+            Payee=Payee(PlaidId='ins_116947', LoanAccountNumber='91400799'),
+            Amount=1000,
+        ))
+    return result
+
+
+def shared_collection(mongo_uri: Optional[str]):
+    if mongo_uri:
+        collection = MongoClient(mongo_uri)['bench']['rate_limits']
+    else:
+        import mongomock
+        collection = mongomock.MongoClient()['bench']['rate_limits']
+    collection.delete_many({})
+    return collection
+
+
+async def pay(method: FakeMethod, transactions):
+    summaries = await TransactionService(method, transactions, 'bench', 'bench').create_batch()
+    await method.executor.map(lambda s: TransactionService.invoke_payment(s.transaction.Amount, s.source, s.destination, method), summaries)
+
+
+async def run(args):
+    api = FakeMethodApi(calls=args.api_calls or args.calls + 1, period=args.period, latency=args.latency)
+    if args.shared:
+        collection = shared_collection(args.mongo_uri)
+        methods = [FakeMethod(api, max_in_flight=args.max_in_flight,
+                              rate_limiter=RateLimiter(args.calls, args.period, collection=collection, fallback_share=args.shared))
+                   for _ in range(args.shared)]
+    else:
+        methods = [FakeMethod(api, calls=args.calls, period=args.period, max_in_flight=args.max_in_flight)]
+    transactions = make_transactions(args.employees, args.payors)
+    start = time.monotonic()
+    # Disjoint payors per client, like workers running different batches.
+    await asyncio.gather(*[pay(method, [tnx for i, tnx in enumerate(transactions) if i % args.payors % len(methods) == n])
+                           for n, method in enumerate(methods)])
+    elapsed = time.monotonic() - start
+    total = len(api.call_times)
+    limiter = methods[0].rate_limiter
+    ideal = max(0.0, (total - limiter.capacity) / limiter.rate)
+    print(f'calls={total} elapsed={elapsed:.2f}s ideal={ideal:.2f}s utilization={ideal / elapsed if elapsed else 1:.0%}')
+    print(f'max calls in any {args.period}s window={api.max_calls_in_window()} budget={args.calls} rejected={api.rejected}')
+    for n, method in enumerate(methods):
+        print(f'client {n}: {json.dumps(method.rate_limiter.stats())}')
+    return api.max_calls_in_window() <= args.calls and api.rejected == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--employees', type=int, default=200)
+    parser.add_argument('--payors', type=int, default=5)
+    parser.add_argument('--calls', type=int, default=60)
+    parser.add_argument('--api-calls', type=int, default=None, help='limit enforced by the fake api, defaults to calls + 1')
+    parser.add_argument('--period', type=float, default=5)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--max-in-flight', type=int, default=16)
+    parser.add_argument('--shared', type=int, default=0, help='number of clients sharing a Mongo backed limiter')
+    parser.add_argument('--mongo-uri', default=None, help='mongod for --shared, defaults to an in-memory mongomock database')
+    ok = asyncio.run(run(parser.parse_args()))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Cold start time of the API and of the worker processes, to keep startup fast as workers are added.
+
+    python -m benchmarks.bench_startup --output startup.json
+    python -m benchmarks.bench_startup --baseline startup.json --max-import-seconds 0.5
+    python -m benchmarks.bench_startup --mongo-uri mongodb://localhost:27017
+
+Every run is a fresh interpreter. The imports of main and worker are timed with python -X importtime, which
+also gives the slowest modules. With --mongo-uri the API startup (the Mongo check and the indexes) is timed
+as well. Results are written as JSON. With --baseline the medians are compared with an earlier run, and with
+--max-import-seconds the command fails when the median import of main is slower.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+MODULES = ('main', 'worker')
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_SCRIPT = """
+import asyncio, json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+asyncio.run(main.context.startup())
+print(json.dumps({'import': imported - start, 'startup': time.perf_counter() - imported}))
+"""
+
+
+def parse_importtime(output: str) -> Dict[str, Dict[str, int]]:
+    "Self and cumulative microseconds per module from the -X importtime output."
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if self_us.strip().isdigit():
+            modules[name.strip()] = {'self': int(self_us), 'cumulative': int(cumulative_us)}
+    return modules
+
+
+def time_import(module: str, env: Dict[str, str]) -> Dict[str, Dict[str, int]]:
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=BACKEND, env=env,
+                            capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f'import {module} failed:\n{result.stderr[-2000:]}')
+    return parse_importtime(result.stderr)
+
+
+def time_startup(env: Dict[str, str]) -> Dict[str, float]:
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=BACKEND, env=env, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f'startup failed:\n{result.stderr[-2000:]}')
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {'median': round(statistics.median(values), 4), 'min': round(min(values), 4), 'max': round(max(values), 4)}
+
+
+def slowest(runs: List[Dict[str, Dict[str, int]]], top: int) -> List[Dict]:
+    "Modules with the highest median self time over the runs."
+    names = set().union(*runs)
+    medians = {name: statistics.median(run.get(name, {'self': 0})['self'] for run in runs) for name in names}
+    return [{'module': name, 'self_seconds': round(us / 1e6, 4)} for name, us in sorted(medians.items(), key=lambda item: -item[1])[:top]]
+
+
+def compare(current: dict, baseline: dict) -> Dict[str, dict]:
+    "Relative change of the medians present in both runs, positive is slower."
+    result = {}
+    for key, values in current['seconds'].items():
+        before = baseline['seconds'].get(key, {}).get('median')
+        if before:
+            result[key] = {'baseline': before, 'current': values['median'], 'change': round(values['median'] / before - 1, 3)}
+    return result
+
+
+def run(args) -> dict:
+    env = dict(os.environ)
+    env.pop('MONGO_URI', None)
+    seconds: Dict[str, Dict[str, float]] = {}
+    modules = {}
+    for module in MODULES:
+        runs = [time_import(module, env) for _ in range(args.runs)]
+        seconds[f'import.{module}'] = summarize([run[module]['cumulative'] / 1e6 for run in runs])
+        modules[module] = {'slowest': slowest(runs, args.top),
+                           'loaded': {name: name in runs[-1] for name in ('method', 'numpy', 'pyarrow', 'dateutil', 'motor')}}
+    if args.mongo_uri:
+        runs = [time_startup({**env, 'MONGO_URI': args.mongo_uri}) for _ in range(args.runs)]
+        seconds['startup.main'] = summarize([run['startup'] for run in runs])
+    return {'python': sys.version.split()[0], 'runs': args.runs, 'seconds': seconds, 'modules': modules}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to report per entry point')
+    parser.add_argument('--mongo-uri', default=None, help='also time the API startup against this Mongo')
+    parser.add_argument('--max-import-seconds', type=float, default=None, help='fail when the median import of main is slower')
+    parser.add_argument('--output', default=None, help='write the results to this file')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare with')
+    args = parser.parse_args()
+    results = run(args)
+    if args.baseline:
+        with open(args.baseline) as file:
+            results['comparison'] = compare(results, json.load(file))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    print(output)
+    median = results['seconds']['import.main']['median']
+    if args.max_import_seconds is not None and median > args.max_import_seconds:
+        raise SystemExit(f'import main took {median}s, more than {args.max_import_seconds}s')
+
+
+if __name__ == '__main__':
+    main()
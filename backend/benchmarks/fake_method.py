@@ -0,0 +1,91 @@
+import itertools
+import random
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from method_manager import MethodWrapper
+from rate_limiter import RateLimiter
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class FakeMethodApi:
+    """
+    In-memory stand-in for the Method api.
+    Records the time of every call and answers with a 429 style error once more than
+    `calls` requests land inside any `period` seconds window.
+    """
+    def __init__(self, calls: int = 600, period: float = 60, latency: float = 0.0, error_rate: float = 0.0, seed: Optional[int] = None):
+        self.calls = calls
+        self.period = period
+        self.latency = latency
+        self.error_rate = error_rate
+        self.call_times: List[float] = []
+        self.rejected = 0
+        self.idempotent: Dict[str, Dict[str, str]] = {}
+        self._window: Deque[float] = deque()
+        self._ids = itertools.count()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def call(self, prefix: str) -> Dict[str, str]:
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= self.period:
+                self._window.popleft()
+            if len(self._window) >= self.calls:
+                self.rejected += 1
+                raise RateLimitExceeded(f'more than {self.calls} calls in {self.period}s')
+            self._window.append(now)
+            self.call_times.append(now)
+            failed = self._random.random() < self.error_rate
+            _id = f'{prefix}_{next(self._ids)}'
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise Exception('simulated Method error')
+        return {'id': _id, 'mch_id': f'mch_{_id}', 'status': 'pending'}
+
+    def max_calls_in_window(self) -> int:
+        """Largest number of calls observed inside any `period` seconds window."""
+        best = 0
+        start = 0
+        for end, t in enumerate(self.call_times):
+            while t - self.call_times[start] >= self.period:
+                start += 1
+            best = max(best, end - start + 1)
+        return best
+
+
+class FakeResource:
+    def __init__(self, api: FakeMethodApi, prefix: str):
+        self.api = api
+        self.prefix = prefix
+
+    def create(self, opts, request_opts=None):
+        key = (request_opts or {}).get('idempotency_key')
+        if key and key in self.api.idempotent:
+            return self.api.idempotent[key]
+        # Echo the request like Method does, so reports show the source, destination and amount.
+        result = {**opts, **self.api.call(self.prefix)}
+        if key:
+            self.api.idempotent[key] = result
+        return result
+
+    def list(self, opts=None):
+        return [self.api.call(self.prefix)]
+
+
+class FakeMethod(MethodWrapper):
+    "MethodWrapper whose resources talk to a FakeMethodApi instead of the network."
+    def __init__(self, api: FakeMethodApi, calls: int = 599, period: int = 60, max_in_flight: int = 16, rate_limiter: Optional[RateLimiter] = None):
+        super().__init__(api_key='fake', calls=calls, period=period, max_in_flight=max_in_flight, rate_limiter=rate_limiter)
+        self.api = api
+        self.entities = FakeResource(api, 'ent')
+        self.accounts = FakeResource(api, 'acc')
+        self.payments = FakeResource(api, 'pmt')
+        self.merchants = FakeResource(api, 'mch')
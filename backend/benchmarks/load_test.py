@@ -0,0 +1,88 @@
+"""
+Concurrent report download and upload latency against a running API.
+
+Run it against the server before and after a change and compare the percentiles:
+
+    uvicorn main:app --workers 1 &
+    python -m benchmarks.load_test --url http://localhost:8000 --batch-id <id> --report-clients 20 --uploads 10
+
+Report downloads and uploads run at the same time, so a handler that blocks the event loop
+shows up as upload latency growing with the number of report clients.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import urllib.request
+import uuid
+from typing import Dict, List
+
+REPORTS = ['source_account', 'branch', 'payments']
+
+
+def _get(url: str):
+    with urllib.request.urlopen(url) as response:
+        response.read()
+
+
+def _upload(url: str, filename: str, content: bytes):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: text/xml\r\n\r\n').encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+    request = urllib.request.Request(url, data=body, method='POST',
+                                     headers={'Content-Type': f'multipart/form-data; boundary={boundary}'})
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+async def timed(latencies: List[float], fn, *args):
+    start = time.perf_counter()
+    await asyncio.to_thread(fn, *args)
+    latencies.append(time.perf_counter() - start)
+
+
+def summary(latencies: List[float]) -> Dict[str, float]:
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'p50': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1],
+    }
+
+
+async def run(args):
+    content = open(args.file, 'rb').read()
+    report_latencies: List[float] = []
+    upload_latencies: List[float] = []
+    deadline = time.monotonic() + args.duration
+
+    async def report_client(index: int):
+        while time.monotonic() < deadline:
+            report = REPORTS[index % len(REPORTS)]
+            await timed(report_latencies, _get, f'{args.url}/reports/batches/{args.batch_id}/{report}')
+
+    async def uploader():
+        for i in range(args.uploads):
+            await timed(upload_latencies, _upload, f'{args.url}/upload/xml', f'load-test-{i}.xml', content)
+
+    await asyncio.gather(uploader(), *[report_client(i) for i in range(args.report_clients)])
+    return {'reports': summary(report_latencies), 'uploads': summary(upload_latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--batch-id', required=True, help='batch whose reports are downloaded')
+    parser.add_argument('--file', default='employees.xml', help='xml uploaded while reports are downloaded')
+    parser.add_argument('--report-clients', type=int, default=20)
+    parser.add_argument('--uploads', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30, help='seconds report clients keep downloading')
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Synthetic payroll files shaped like backend/employees.xml.
+
+    python -m benchmarks.synthetic payroll.xml --rows 100000 --employees 20000 --payors 50 --malformed 0.01
+
+With --malformed, that share of the rows is broken the way real uploads are: a missing field,
+an unparseable date of birth or an unparseable amount.
+"""
+import argparse
+import random
+import uuid
+from datetime import datetime
+from typing import IO
+from xml.sax.saxutils import escape
+
+DOB_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%b %d %Y')
+PLAID_IDS = ('ins_116947', 'ins_116948', 'ins_116949', 'ins_116950')
+MALFORMATIONS = ('missing', 'dob', 'amount')
+
+
+def _employee(rng: random.Random, index: int) -> str:
+    dob = f'{rng.randint(1960, 2004)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}'
+    dob = datetime.strptime(dob, '%Y-%m-%d').strftime(rng.choice(DOB_FORMATS))
+    return (f'\t<Employee>\n'
+            f'\t\t<DunkinId>EMP-{uuid.UUID(int=rng.getrandbits(128))}</DunkinId>\n'
+            f'\t\t<DunkinBranch>BRC-{index % 97}</DunkinBranch>\n'
+            f'\t\t<FirstName>First{index}</FirstName>\n'
+            f'\t\t<LastName>Last{index}</LastName>\n'
+            f'\t\t<DOB>{escape(dob)}</DOB>\n'
+            f'\t\t<PhoneNumber>+1512{rng.randint(1000000, 9999999)}</PhoneNumber>\n'
+            f'\t</Employee>\n'
+            f'\t<Payee>\n'
+            f'\t\t<PlaidId>{rng.choice(PLAID_IDS)}</PlaidId>\n'
+            f'\t\t<LoanAccountNumber>{rng.randint(10000000, 99999999)}</LoanAccountNumber>\n'
+            f'\t</Payee>\n')
+
+
+def _payor(rng: random.Random, index: int) -> str:
+    return (f'\t<Payor>\n'
+            f'\t\t<DunkinId>CORP-{uuid.UUID(int=rng.getrandbits(128))}</DunkinId>\n'
+            f'\t\t<ABARouting>{rng.randint(100000000, 999999999)}</ABARouting>\n'
+            f'\t\t<AccountNumber>{rng.randint(10000000, 99999999)}</AccountNumber>\n'
+            f'\t\t<Name>Dunkin&apos; Donuts {index} LLC</Name>\n'
+            f'\t\t<DBA>Dunkin&apos; Donuts</DBA>\n'
+            f'\t\t<EIN>{rng.randint(10000000, 99999999)}</EIN>\n'
+            f'\t\t<Address>\n'
+            f'\t\t\t<Line1>{index} Hayes Lights</Line1>\n'
+            f'\t\t\t<City>Kerlukemouth</City>\n'
+            f'\t\t\t<State>IA</State>\n'
+            f'\t\t\t<Zip>50001</Zip>\n'
+            f'\t\t</Address>\n'
+            f'\t</Payor>\n')
+
+
+def _malform(rng: random.Random, row: str) -> str:
+    kind = rng.choice(MALFORMATIONS)
+    if kind == 'missing':
+        start = row.index('\t\t<PhoneNumber>')
+        return row[:start] + row[row.index('\n', start) + 1:]
+    if kind == 'dob':
+        start = row.index('<DOB>') + len('<DOB>')
+        return row[:start] + 'not a date' + row[row.index('</DOB>'):]
+    start = row.index('<Amount>') + len('<Amount>')
+    return row[:start] + 'n/a' + row[row.index('</Amount>'):]
+
+
+def write_payroll_xml(out: IO[str], rows: int, employees: int, payors: int, seed: int = 0, malformed: float = 0.0) -> int:
+    "Write the rows and return how many of them were malformed."
+    rng = random.Random(seed)
+    broken = 0
+    employee_blocks = [_employee(rng, i) for i in range(employees)]
+    payor_blocks = [_payor(rng, i) for i in range(payors)]
+    out.write('<root>\n')
+    for i in range(rows):
+        employee = i % employees
+        employee_block = employee_blocks[employee]
+        employee_part, payee_part = employee_block.split('\t<Payee>\n')
+        row = (f'<row>\n{employee_part}{payor_blocks[employee % payors]}\t<Payee>\n{payee_part}'
+               f'\t<Amount>${rng.randint(1, 500)}.{rng.randint(0, 99):02d}</Amount>\n</row>\n')
+        if malformed and rng.random() < malformed:
+            row = _malform(rng, row)
+            broken += 1
+        out.write(row)
+    out.write('</root>\n')
+    return broken
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--employees', type=int, default=20000)
+    parser.add_argument('--payors', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--malformed', type=float, default=0.0, help='share of rows to break, between 0 and 1')
+    args = parser.parse_args()
+    with open(args.path, 'w') as out:
+        write_payroll_xml(out, args.rows, args.employees, args.payors, args.seed, args.malformed)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,72 @@
+"""
+Settings, every one can be overridden by an environment variable of the same name when the module is imported:
+
+    MONGO_URI=mongodb://mongo:27017 METHOD_API_KEY=sk_... PAYOR_TOTAL_LIMITS='{"CORP-1": 5000000}' python worker.py
+
+Strings are taken as is, anything else is parsed as json (numbers, null, objects).
+"""
+import json
+import os
+
+
 class Config(dict):
     METHOD_API_KEY = ""
-    MONGO_URI = ""
\ No newline at end of file
+    METHOD_ENV = "dev"
+    MONGO_URI = ""
+    # The API does not start when Mongo does not answer within this many seconds.
+    STARTUP_TIMEOUT_SECONDS = 10
+    # Connection pool of the shared async Mongo client.
+    MONGO_MAX_POOL_SIZE = 100
+    MONGO_MIN_POOL_SIZE = 0
+    # Method api allows 600 calls per minute, keep one spare.
+    METHOD_RATE_LIMIT_CALLS = 599
+    METHOD_RATE_LIMIT_PERIOD = 60
+    # Extra budgets per MethodOperation name within the same period, e.g. {'CREATE_PAYMENT': 400}.
+    METHOD_OPERATION_RATE_LIMITS = {}
+    # Calls that would wait longer than this for a token fail instead, None waits as long as needed.
+    METHOD_RATE_LIMIT_MAX_WAIT = None
+    # Number of Method requests allowed in flight at once.
+    METHOD_MAX_IN_FLIGHT = 16
+    # Number of DunkinId -> Method account entries kept in memory in front of Mongo.
+    ACCOUNT_CACHE_SIZE = 10000
+    # PlaidId -> Method merchant id lookups are cached for an hour.
+    MERCHANT_CACHE_TTL = 3600
+    MERCHANT_CACHE_SIZE = 1024
+    # Payout results are written every PAYOUT_CHUNK_SIZE transactions.
+    PAYOUT_CHUNK_SIZE = 500
+    # Payouts are split into jobs of PAYOUT_SHARD_SIZE transactions so a batch spreads across workers.
+    PAYOUT_SHARD_SIZE = 5000
+    # Worker processes started by worker.py, they share the Method rate limit through Mongo
+    # and split it between them while Mongo is unreachable.
+    WORKER_PROCESSES = 4
+    # A job whose lease is not renewed for this long is handed to another worker.
+    JOB_LEASE_SECONDS = 60
+    JOB_MAX_ATTEMPTS = 3
+    # Seconds an idle worker waits before polling the queue again.
+    JOB_POLL_INTERVAL = 1.0
+    # Reconciliation before payouts: limit in cents on what one payor pays in a batch, None for no limit,
+    # and limits per payor DunkinId, e.g. {'CORP-...': 5000000}. Batches above them need force to be paid.
+    PAYOR_TOTAL_LIMIT = None
+    PAYOR_TOTAL_LIMITS = {}
+    # Identical uploads return the existing batch and rows already created by another batch are skipped,
+    # for this long. Keep it shorter than the pay period, the same payroll is uploaded again every period.
+    UPLOAD_DEDUP_SECONDS = 3 * 24 * 3600
+    # Cursor batch size used when streaming reports out of Mongo.
+    REPORT_BATCH_SIZE = 1000
+    # Rows per Parquet row group and Arrow record batch in the columnar exports.
+    EXPORT_ROW_GROUP_SIZE = 50000
+
+
+def load_environ(config: type = Config, environ=os.environ):
+    for name in dir(config):
+        if not name.isupper() or name not in environ:
+            continue
+        default = getattr(config, name)
+        try:
+            value = environ[name] if isinstance(default, str) else json.loads(environ[name])
+        except ValueError:
+            raise ValueError(f"Invalid value for {name} in the environment: {environ[name]!r}")
+        setattr(config, name, value)
+
+
+load_environ()
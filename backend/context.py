@@ -0,0 +1,141 @@
+"""
+Clients, repositories and services of the API, created on first use instead of when main is imported.
+
+Importing main only builds the FastAPI app, so a cold start does not pay for the Method SDK, NumPy or pyarrow
+before they are needed and a bad MONGO_URI fails the startup checks with a clear error rather than the import.
+The startup hook opens the Mongo client and checks it, everything else is built by the first request that uses it
+and shared afterwards.
+"""
+import asyncio
+from functools import cached_property
+from typing import Dict
+
+from config import Config
+from fastapi.logger import logger
+
+
+class AppContext:
+    def __init__(self, config: Config):
+        self.config = config
+
+    @cached_property
+    def client(self):
+        from pymongo.errors import ConfigurationError
+        from repository import create_client
+
+        if not self.config.MONGO_URI:
+            raise RuntimeError("MONGO_URI is not set")
+        try:
+            return create_client(self.config.MONGO_URI, self.config.MONGO_MAX_POOL_SIZE, self.config.MONGO_MIN_POOL_SIZE)
+        except ConfigurationError as e:
+            raise RuntimeError(f"Invalid MONGO_URI: {e}")
+
+    @cached_property
+    def db(self):
+        return self.client["payments"]
+
+    @cached_property
+    def method(self):
+        # The API only needs it for the ingestor and payout runner it shares with the workers, it never calls Method.
+        from method_manager import MethodWrapper
+
+        config = self.config
+        return MethodWrapper(env=config.METHOD_ENV,api_key=config.METHOD_API_KEY,calls=config.METHOD_RATE_LIMIT_CALLS,period=config.METHOD_RATE_LIMIT_PERIOD,
+                             max_in_flight=config.METHOD_MAX_IN_FLIGHT,merchant_cache_ttl=config.MERCHANT_CACHE_TTL,merchant_cache_size=config.MERCHANT_CACHE_SIZE)
+
+    @cached_property
+    def progress(self):
+        from repository import ProgressRepository
+        return ProgressRepository(self.db["batch_progress"])
+
+    @cached_property
+    def batches(self):
+        from repository import BatchRepository
+        return BatchRepository(self.db["batches"], self.db["versions"], self.progress)
+
+    @cached_property
+    def transactions(self):
+        from repository import TransactionRepository
+        return TransactionRepository(self.db["transactions"])
+
+    @cached_property
+    def ingest_errors(self):
+        from repository import IngestErrorRepository
+        return IngestErrorRepository(self.db["ingest_errors"])
+
+    @cached_property
+    def rollups(self):
+        from rollups import BatchRollups
+        return BatchRollups(self.db["batch_rollups"], self.transactions)
+
+    @cached_property
+    def payouts(self):
+        from payouts import PayoutRunner
+        return PayoutRunner(self.method, self.batches, self.transactions, self.db["payout_jobs"], self.rollups,
+                            self.config.PAYOUT_CHUNK_SIZE, self.config.PAYOUT_SHARD_SIZE, self.progress)
+
+    @cached_property
+    def reconciler(self):
+        from reconcile import Reconciler
+        return Reconciler(self.transactions, self.config.PAYOR_TOTAL_LIMIT, self.config.PAYOR_TOTAL_LIMITS, self.config.REPORT_BATCH_SIZE)
+
+    @cached_property
+    def hashes(self):
+        from dedup import UploadHashes
+        return UploadHashes(self.db["upload_hashes"], self.db["row_hashes"])
+
+    @cached_property
+    def ingestor(self):
+        from account_cache import AccountCache
+        from ingest import Ingestor
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+        return Ingestor(self.method, self.batches, self.transactions, self.ingest_errors, self.rollups, AsyncIOMotorGridFSBucket(self.db, "uploads"),
+                        AccountCache(self.db["method_accounts"], self.config.ACCOUNT_CACHE_SIZE, self.config.METHOD_ENV), self.hashes, self.progress)
+
+    # Ingestion and payouts are run by worker.py, the API only queues them.
+    @cached_property
+    def queue(self):
+        from jobs import JobQueue
+        return JobQueue(self.db["job_queue"], self.config.JOB_MAX_ATTEMPTS)
+
+    @cached_property
+    def workers(self):
+        from jobs import WorkerRegistry
+        return WorkerRegistry(self.db["workers"])
+
+    # Batch progress written by the workers, pushed to the dashboards.
+    @cached_property
+    def hub(self):
+        from progress import ProgressHub
+        return ProgressHub(self.progress)
+
+    async def check(self) -> Dict[str, str]:
+        "Health of the dependencies, 'ok' or what is wrong with each."
+        checks = {}
+        try:
+            await asyncio.wait_for(self.db.command('ping'), self.config.STARTUP_TIMEOUT_SECONDS)
+            checks['mongo'] = 'ok'
+        except asyncio.TimeoutError:
+            checks['mongo'] = f"no answer within {self.config.STARTUP_TIMEOUT_SECONDS}s"
+        except Exception as e:
+            checks['mongo'] = str(e)
+        checks['method'] = 'ok' if self.config.METHOD_API_KEY else 'METHOD_API_KEY is not set'
+        return checks
+
+    async def startup(self):
+        "Check the configuration and Mongo, then create the indexes. Raises when Mongo is not usable."
+        from indexes import ensure_indexes
+
+        checks = await self.check()
+        if checks['method'] != 'ok':
+            logger.warning(f"Method: {checks['method']}, payouts will fail")
+        if checks['mongo'] != 'ok':
+            raise RuntimeError(f"Mongo is not available: {checks['mongo']}")
+        await ensure_indexes(self.db)
+
+    async def close(self):
+        if 'hub' in self.__dict__:
+            await self.hub.close()
+        if 'client' in self.__dict__:
+            self.client.close()
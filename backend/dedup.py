@@ -0,0 +1,102 @@
+import hashlib
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from typing import IO, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from models import RECORD_FIELDS, Transaction
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+DUPLICATE_KEY = 11000
+
+
+class HashingReader:
+    "File wrapper that hashes the content as it is read, so an upload is hashed while it is stored."
+    def __init__(self, file: IO[bytes]):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def row_hash(tnx: Transaction) -> str:
+    "Hash of a validated row, dates and amounts are normalized so that formatting differences do not matter."
+    values = ([getattr(tnx.Employee, name) for name in RECORD_FIELDS['Employee']]
+              + [getattr(tnx.Payor, name) for name in RECORD_FIELDS['Payor']]
+              + [getattr(tnx.Payor.Address, name) for name in RECORD_FIELDS['Address']]
+              + [getattr(tnx.Payee, name) for name in RECORD_FIELDS['Payee']]
+              + [str(tnx.Amount)])
+    return hashlib.sha256('\x1f'.join(values).encode()).hexdigest()
+
+
+@dataclass
+class UploadHashes:
+    """
+    Content hashes of the uploads and of their rows, keyed by hash so a lookup is a single _id read.
+    An upload claims its file hash before its batch is created, identical files get the first batch back.
+    Every row claims its hash and occurrence number ("hash:0", "hash:1", ...), so rows repeated within a file
+    stay distinct while the rows another batch already claimed are skipped before any Method call.
+    Both expire after Config.UPLOAD_DEDUP_SECONDS, payroll files legitimately repeat from one period to the next.
+    """
+    uploads: AsyncIOMotorCollection
+    rows: AsyncIOMotorCollection
+
+    async def claim_upload(self, content_hash: str, batch_id: str) -> Optional[str]:
+        "Claim a file hash for batch_id, returns the batch that claimed it first if there is one."
+        try:
+            await self.uploads.insert_one({'_id': content_hash, 'batch_id': batch_id, 'date_created': datetime.utcnow()})
+            return None
+        except DuplicateKeyError:
+            existing = await self.uploads.find_one({'_id': content_hash})
+            return existing['batch_id'] if existing else None
+
+    async def replace_upload(self, content_hash: str, batch_id: str):
+        "Move the claim of a file hash whose batch was never created to batch_id."
+        await self.uploads.replace_one({'_id': content_hash}, {'batch_id': batch_id, 'date_created': datetime.utcnow()}, upsert=True)
+
+    async def _seed(self, batch_id: str, bases: List[str], occurrences: Dict[str, int]):
+        "Continue the occurrence numbers of the rows the batch claimed in earlier attempts."
+        pipeline = [{'$match': {'batch_id': batch_id, 'base': {'$in': bases}}}, {'$group': {'_id': '$base', 'count': {'$sum': 1}}}]
+        async for result in self.rows.aggregate(pipeline):
+            occurrences[result['_id']] = result['count']
+
+    async def claim_rows(self, batch_id: str, attempt: int, transactions: List[Transaction], occurrences: Dict[str, int]) -> List[Transaction]:
+        """
+        Claim the rows of a chunk for a batch and return the ones that were not claimed before.
+        occurrences counts the rows seen per hash during one ingest attempt, across its chunks.
+        """
+        bases = [row_hash(tnx) for tnx in transactions]
+        unseen = [base for base in Counter(bases) if base not in occurrences]
+        for base in unseen:
+            occurrences[base] = 0
+        if attempt and unseen:
+            await self._seed(batch_id, unseen, occurrences)
+        now = datetime.utcnow()
+        documents = []
+        for base in bases:
+            documents.append({'_id': f'{base}:{occurrences[base]}', 'base': base, 'batch_id': batch_id, 'attempt': attempt, 'date_created': now})
+            occurrences[base] += 1
+        duplicates = set()
+        try:
+            await self.rows.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] != DUPLICATE_KEY:
+                    raise
+                duplicates.add(error['index'])
+        return [tnx for index, tnx in enumerate(transactions) if index not in duplicates]
+
+    async def release(self, batch_id: str):
+        "Drop the file and row hashes a batch claimed, for a batch that failed before its rows could be paid."
+        await self.uploads.delete_many({'batch_id': batch_id})
+        await self.rows.delete_many({'batch_id': batch_id})
+
+    async def delete_attempt(self, batch_id: str, attempt: int):
+        await self.rows.delete_many({'batch_id': batch_id, 'attempt': attempt})
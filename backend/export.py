@@ -0,0 +1,193 @@
+"""
+Columnar exports of batch transactions with their payment metadata, for the finance warehouse loads.
+
+    python export.py --batch-id 65f0c0ffee... --output batch.parquet
+    python export.py --start 2024-01-01 --end 2024-02-01 --format arrow --output january.arrow
+
+Every export has the same schema whatever the documents contain, and is written one row group (Parquet)
+or record batch (Arrow IPC stream) at a time, so a date range of batches is a single pass over Mongo with
+one row group of memory.
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from config import Config
+from fastapi.responses import StreamingResponse
+from metrics import timed
+from models import RECORD_KEYS, ExportFormat, parse_amount
+from reports import PAYMENT_COLUMNS
+from repository import BatchRepository, TransactionRepository, create_client
+
+# Payment fields Method returns as numbers, in cents. The others are exported as strings, the objects (metadata,
+# fee) as json.
+PAYMENT_INTEGERS = ('amount',)
+
+EXPORT_SCHEMA = pa.schema(
+    [
+        ('batch_id', pa.string()),
+        ('batch_name', pa.string()),
+        ('batch_date_created', pa.timestamp('ms')),
+        ('transaction_id', pa.string()),
+        ('status', pa.string()),
+        ('attempt', pa.int32()),
+        ('source', pa.string()),
+        ('destination', pa.string()),
+        ('payout_date', pa.timestamp('ms')),
+    ]
+    + [(key, pa.int64() if key == 'Amount' else pa.string()) for key in RECORD_KEYS]
+    + [(f'payment.{column}', pa.int64() if column in PAYMENT_INTEGERS else pa.string()) for column in PAYMENT_COLUMNS]
+)
+
+
+MEDIA_TYPES = {
+    ExportFormat.PARQUET: 'application/vnd.apache.parquet',
+    ExportFormat.ARROW: 'application/vnd.apache.arrow.stream',
+}
+
+
+def _lookup(document: Optional[dict], path: str):
+    for key in path.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def _string(value) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def export_row(batch: dict, tnx: dict) -> Dict:
+    "Flat row of EXPORT_SCHEMA for a transaction document of the batch."
+    row = {
+        'batch_id': str(batch['_id']),
+        'batch_name': batch.get('batch_name'),
+        'batch_date_created': batch.get('date_created'),
+        'transaction_id': str(tnx['_id']),
+        'status': tnx.get('status'),
+        'attempt': tnx.get('attempt', 0),
+        'source': tnx.get('source'),
+        'destination': tnx.get('destination'),
+        'payout_date': tnx.get('payout_date'),
+    }
+    for key in RECORD_KEYS:
+        value = _lookup(tnx.get('transaction'), key)
+        row[key] = parse_amount(value) if key == 'Amount' and value is not None else _string(value)
+    payment = tnx.get('payment') or {}
+    for column in PAYMENT_COLUMNS:
+        value = payment.get(column)
+        row[f'payment.{column}'] = int(value) if column in PAYMENT_INTEGERS and value is not None else _string(value)
+    return row
+
+
+async def record_batches(transactions: TransactionRepository, batches: AsyncIterable[dict],
+                         rows_per_group: int = Config.EXPORT_ROW_GROUP_SIZE, batch_size: int = 1000) -> AsyncIterator[pa.RecordBatch]:
+    "Transactions of the batches, in batch then _id order, as record batches of rows_per_group rows."
+    rows: List[Dict] = []
+    async for batch in batches:
+        async for tnx in transactions.find({'batch_id': str(batch['_id'])}, None, batch_size).sort('_id', 1):
+            rows.append(export_row(batch, tnx))
+            if len(rows) == rows_per_group:
+                yield pa.RecordBatch.from_pylist(rows, schema=EXPORT_SCHEMA)
+                rows = []
+    if rows:
+        yield pa.RecordBatch.from_pylist(rows, schema=EXPORT_SCHEMA)
+
+
+class _Sink:
+    "Write only file that hands out what was written since the last take, for writers that need tell()."
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+async def iter_export(record_batches: AsyncIterable[pa.RecordBatch], format: ExportFormat) -> AsyncIterator[bytes]:
+    "Encoded export, yielded one row group or record batch at a time. An empty export still has the schema."
+    sink = _Sink()
+    if format == ExportFormat.PARQUET:
+        writer = pq.ParquetWriter(sink, EXPORT_SCHEMA)
+    else:
+        writer = pa.ipc.new_stream(sink, EXPORT_SCHEMA)
+    # From the first row to the footer, including the time spent reading Mongo.
+    with timed('export'):
+        async for record_batch in record_batches:
+            writer.write_batch(record_batch)
+            data = sink.take()
+            if data:
+                yield data
+        writer.close()
+        yield sink.take()
+
+
+def export_response(record_batches: AsyncIterable[pa.RecordBatch], format: ExportFormat, filename: str) -> StreamingResponse:
+    response = StreamingResponse(iter_export(record_batches, format), media_type=MEDIA_TYPES[format])
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}.{format.value}"
+    return response
+
+
+async def single(batch: dict) -> AsyncIterator[dict]:
+    yield batch
+
+
+async def run(args):
+    db = create_client(Config.MONGO_URI)['payments']
+    batches = BatchRepository(db['batches'])
+    if args.batch_id:
+        batch = await batches.get(args.batch_id)
+        if not batch:
+            raise SystemExit(f'Batch {args.batch_id} not found')
+        selected = single(batch)
+    else:
+        selected = batches.created_between(args.start, args.end)
+    content = iter_export(record_batches(TransactionRepository(db['transactions']), selected, args.rows_per_group), args.format)
+    with open(args.output, 'wb') as file:
+        async for data in content:
+            file.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-id', default=None, help='export a single batch')
+    parser.add_argument('--start', type=datetime.fromisoformat, default=None, help='export the batches created from this date')
+    parser.add_argument('--end', type=datetime.fromisoformat, default=None, help='up to this date, excluded')
+    parser.add_argument('--format', type=ExportFormat, choices=[format.value for format in ExportFormat], default=ExportFormat.PARQUET)
+    parser.add_argument('--rows-per-group', type=int, default=Config.EXPORT_ROW_GROUP_SIZE)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+    if not args.batch_id and not (args.start and args.end):
+        parser.error('either --batch-id or both --start and --end are required')
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Index bootstrap and query plan diagnostics for the payments database.
+
+    python indexes.py            # create the indexes
+    python indexes.py --explain  # explain the hot queries and flag collection scans
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Set
+
+from bson import ObjectId
+from config import Config
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    'transactions': [
+        IndexModel([('batch_id', ASCENDING)]),
+        IndexModel([('batch_id', ASCENDING), ('status', ASCENDING)]),
+        IndexModel([('batch_id', ASCENDING), ('payment.source', ASCENDING)]),
+        IndexModel([('batch_id', ASCENDING), ('transaction.Payor.DunkinId', ASCENDING)]),
+        # Payout shards walk a range of a batch in _id order.
+        IndexModel([('batch_id', ASCENDING), ('_id', ASCENDING)]),
+        # Transactions of a partial ingest attempt are removed before it runs again.
+        IndexModel([('batch_id', ASCENDING), ('attempt', ASCENDING)]),
+    ],
+    'batches': [
+        # Also serves sorting/paging on date_created alone.
+        IndexModel([('date_created', DESCENDING), ('_id', DESCENDING)]),
+        # Listing filtered by status.
+        IndexModel([('status', ASCENDING), ('date_created', DESCENDING), ('_id', DESCENDING)]),
+    ],
+    'ingest_errors': [
+        # Error listing pages on _id, retries read a batch in row order.
+        IndexModel([('batch_id', ASCENDING), ('_id', ASCENDING)]),
+        IndexModel([('batch_id', ASCENDING), ('row', ASCENDING)]),
+    ],
+    'job_queue': [
+        # Claims take the oldest queued job or the oldest expired lease.
+        IndexModel([('status', ASCENDING), ('date_created', ASCENDING)]),
+        IndexModel([('status', ASCENDING), ('lease_expires', ASCENDING)]),
+        IndexModel([('batch_id', ASCENDING), ('date_created', ASCENDING)]),
+    ],
+    'workers': [
+        IndexModel([('date_updated', DESCENDING)]),
+    ],
+    # Hashes are looked up by _id, the TTL indexes drop them after the dedup window.
+    'upload_hashes': [
+        IndexModel([('date_created', ASCENDING)], expireAfterSeconds=Config.UPLOAD_DEDUP_SECONDS),
+        # Released when their batch fails.
+        IndexModel([('batch_id', ASCENDING)]),
+    ],
+    'row_hashes': [
+        IndexModel([('date_created', ASCENDING)], expireAfterSeconds=Config.UPLOAD_DEDUP_SECONDS),
+        IndexModel([('batch_id', ASCENDING), ('attempt', ASCENDING)]),
+        IndexModel([('batch_id', ASCENDING), ('base', ASCENDING)]),
+    ],
+    'batch_progress': [
+        # Polled by date_updated where change streams are not available.
+        IndexModel([('date_updated', ASCENDING)]),
+    ],
+    'batch_rollups': [
+        IndexModel([('batch_id', ASCENDING), ('kind', ASCENDING), ('key', ASCENDING)], unique=True),
+    ],
+}
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase):
+    for collection, indexes in INDEXES.items():
+        await db[collection].create_indexes(indexes)
+
+
+def _winning_stages(explain: Any) -> Set[str]:
+    "Stages of every winning plan in an explain output, including the ones nested in aggregation stages."
+    stages = set()
+    if isinstance(explain, dict):
+        for key, value in explain.items():
+            if key == 'winningPlan':
+                stages |= _stages(value)
+            elif key != 'rejectedPlans':
+                stages |= _winning_stages(value)
+    elif isinstance(explain, list):
+        for value in explain:
+            stages |= _winning_stages(value)
+    return stages
+
+
+def _stages(plan: Any) -> Set[str]:
+    stages = set()
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.add(plan['stage'])
+        for value in plan.values():
+            stages |= _stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages |= _stages(value)
+    return stages
+
+
+async def hot_queries(db: AsyncIOMotorDatabase, batch_id: str) -> Dict[str, dict]:
+    "Explain output of every query the API runs per request or per chunk."
+    transactions = db['transactions']
+    return {
+        'batches.list': await db['batches'].find().sort([('date_created', DESCENDING), ('_id', DESCENDING)]).limit(101).explain(),
+        'batches.list_by_status': await db['batches'].find({'status': {'$in': ['Created']}}).sort([('date_created', DESCENDING), ('_id', DESCENDING)]).limit(101).explain(),
+        'transactions.count_by_batch': await db.command('explain', {'count': 'transactions', 'query': {'batch_id': batch_id}}),
+        'transactions.payments_report': await transactions.find({'batch_id': batch_id, 'payment': {'$ne': None}}, {'payment': 1, '_id': 0}).explain(),
+        'transactions.payout_shard': await transactions.find({'batch_id': batch_id, 'payout_date': {'$exists': False}, '_id': {'$gte': ObjectId('0' * 24), '$lte': ObjectId('f' * 24)}}).sort('_id', ASCENDING).explain(),
+        'job_queue.claim': await db['job_queue'].find({'$or': [{'status': 'queued'}, {'status': 'running', 'lease_expires': {'$lt': datetime.utcnow()}}]}).sort('date_created', ASCENDING).limit(1).explain(),
+        'transactions.rollup_recompute': await db.command('explain', {'aggregate': 'transactions',
+                                                                'pipeline': [{'$match': {'batch_id': batch_id}},
+                                                                             {'$group': {'_id': '$payment.source', 'total': {'$sum': '$transaction.Amount'}}}],
+                                                                'cursor': {}}),
+        'ingest_errors.page': await db['ingest_errors'].find({'batch_id': batch_id, '_id': {'$gt': ObjectId('0' * 24)}}).sort('_id', ASCENDING).limit(101).explain(),
+        'batch_rollups.totals': await db['batch_rollups'].find({'batch_id': batch_id, 'kind': 'source', 'count': {'$gt': 0}}).explain(),
+    }
+
+
+async def explain_hot_queries(db: AsyncIOMotorDatabase, batch_id: str = '') -> List[dict]:
+    results = []
+    for name, explain in (await hot_queries(db, batch_id)).items():
+        stages = _winning_stages(explain)
+        results.append({'query': name, 'stages': sorted(stages), 'collection_scan': 'COLLSCAN' in stages})
+    return results
+
+
+async def run(args):
+    from repository import create_client
+
+    db = create_client(Config.MONGO_URI)['payments']
+    if not args.explain:
+        await ensure_indexes(db)
+        return
+    results = await explain_hot_queries(db, args.batch_id)
+    print(json.dumps(results, indent=2))
+    if any(result['collection_scan'] for result in results):
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--explain', action='store_true', help='explain the hot queries instead of creating indexes')
+    parser.add_argument('--batch-id', default='', help='batch id to explain the per batch queries with')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
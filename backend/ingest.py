@@ -0,0 +1,197 @@
+import tempfile
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Tuple
+
+from account_cache import AccountCache
+from bson import ObjectId
+from dedup import HashingReader, UploadHashes
+from fastapi import UploadFile
+from fastapi.logger import logger
+from method_manager import MethodWrapper, TransactionService
+from metrics import Timings, timed
+from models import BatchStatus, Interner, Transaction
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from repository import BatchRepository, IngestErrorRepository, ProgressRepository, TransactionRepository
+from rollups import BatchRollups
+from xml_parser import iter_rows_from_records, iter_rows_from_xml
+
+
+@dataclass
+class Ingestor:
+    """
+    Create the transactions of uploaded batches, run by the workers.
+    Uploads are kept in GridFS until their batch is created. An ingest attempt that dies part way runs again
+    from the start, the transactions, errors and row hashes it had already written are removed first.
+    With hashes, rows that another batch already created are skipped before any Method call.
+    """
+    method_client: MethodWrapper
+    batches: BatchRepository
+    transactions: TransactionRepository
+    ingest_errors: IngestErrorRepository
+    rollups: BatchRollups
+    uploads: AsyncIOMotorGridFSBucket
+    account_cache: Optional[AccountCache] = None
+    hashes: Optional[UploadHashes] = None
+    progress: Optional[ProgressRepository] = None
+
+    async def save_upload(self, file: UploadFile) -> Tuple[ObjectId, str]:
+        "Store an upload in GridFS, returns its id and the sha256 of its content."
+        reader = HashingReader(file.file)
+        return await self.uploads.upload_from_stream(file.filename, reader), reader.hexdigest()
+
+    async def open_upload(self, file_id: ObjectId) -> UploadFile:
+        "Copy an upload to a local temporary file, the parser reads it synchronously."
+        file = tempfile.TemporaryFile()
+        await self.uploads.download_to_stream(file_id, file)
+        file.seek(0)
+        return UploadFile(str(file_id), file=file)
+
+    async def clear_attempt(self, batch_id: str, attempt: int):
+        await self.ingest_errors.delete_attempt(batch_id, attempt)
+        if self.hashes:
+            await self.hashes.delete_attempt(batch_id, attempt)
+        if await self.transactions.delete_attempt(batch_id, attempt):
+            await self.rollups.recompute(batch_id)
+
+    async def fail(self, batch_id: str):
+        "Fail a batch whose ingest gave up. Its partial rows are removed and its hashes released, so the file can be uploaded again."
+        await self.clear_attempt(batch_id, 0)
+        if self.hashes:
+            await self.hashes.release(batch_id)
+        await self.batches.transition(batch_id, BatchStatus.FAILED)
+
+    async def abandon_retry(self, batch_id: str, attempt: int, error: str, file_id: Optional[ObjectId] = None):
+        """
+        Undo a retry that ran out of attempts and put the batch back to Created, with the rows it had before and
+        the error. The rejected rows are kept and can be retried again.
+        """
+        await self.clear_attempt(batch_id, attempt)
+        batch = await self.batches.get(batch_id)
+        await self.publish_totals(batch_id, batch['valid_transactions'], batch['invalid_transactions'],
+                                  batch.get('rejected_rows', 0), batch.get('duplicate_rows', 0))
+        await self.batches.transition(batch_id, BatchStatus.CREATED, {'retry_error': error})
+        if file_id:
+            await self.uploads.delete(file_id)
+
+    async def publish(self, batch_id: str, created: int, invalid: int, rejected: int, duplicates: int):
+        "Add the rows of a chunk to the batch progress."
+        if self.progress and created + rejected + duplicates:
+            await self.progress.inc(batch_id, ingested=created + rejected + duplicates, valid=created - invalid, invalid=invalid,
+                                    rejected=rejected, duplicates=duplicates)
+
+    async def publish_totals(self, batch_id: str, valid: int, invalid: int, rejected: int, duplicates: int):
+        "Replace the counters published chunk by chunk with the totals of the batch, before its status changes."
+        if self.progress:
+            await self.progress.set(batch_id, ingested=valid + invalid + rejected + duplicates, valid=valid, invalid=invalid,
+                                    rejected=rejected, duplicates=duplicates)
+
+    async def ingest(self, batch_name: str, batch_id: str, chunks: Iterable[List[Transaction]], errors: List[dict],
+                     attempt: int = 0, timings: Optional[Timings] = None) -> Tuple[int, int, int, TransactionService]:
+        """
+        Create the transactions of every chunk, the rows rejected while parsing a chunk are written with it.
+        Returns the number of transactions created and failed, the number of rows skipped as duplicates
+        and the service with its cache counters.
+        Stage timings are collected in timings and added to the batch at the end.
+        """
+        timings = timings or Timings()
+        total_transactions = 0
+        invalid_transactions_count = 0
+        duplicate_rows = 0
+        occurrences = {}
+
+        async def keep(transactions: List[Transaction]) -> List[Transaction]:
+            nonlocal duplicate_rows
+            with timed('dedup', timings):
+                new = await self.hashes.claim_rows(batch_id, attempt, transactions, occurrences)
+            duplicate_rows += len(transactions) - len(new)
+            return new
+
+        service = TransactionService(self.method_client,[],batch_name,batch_id,account_cache=self.account_cache,attempt=attempt,timings=timings)
+        published_duplicates = 0
+        async for transactions_summaries in service.create_batches(chunks, keep if self.hashes else None):
+            invalid = len([tnx for tnx in transactions_summaries if tnx.status =='failed'])
+            total_transactions += len(transactions_summaries)
+            invalid_transactions_count += invalid
+            with timed('mongo_write', timings):
+                if transactions_summaries:
+                    documents = [tnx.dict() for tnx in transactions_summaries]
+                    await self.transactions.insert_many(documents)
+                    await self.rollups.add_transactions(batch_id, documents)
+                await self.ingest_errors.insert_many(batch_id, errors, attempt)
+            await self.publish(batch_id, len(transactions_summaries), invalid, len(errors), duplicate_rows - published_duplicates)
+            published_duplicates = duplicate_rows
+            errors.clear()
+        # Rows rejected after the last chunk with valid transactions.
+        with timed('mongo_write', timings):
+            await self.ingest_errors.insert_many(batch_id, errors, attempt)
+        await self.publish(batch_id, 0, 0, len(errors), 0)
+        errors.clear()
+        await self.batches.add_timings(batch_id, timings.as_dict())
+        return total_transactions, invalid_transactions_count, duplicate_rows, service
+
+    async def create_transactions(self, batch_id: str, file_id: ObjectId) -> int:
+        batch = await self.batches.get(batch_id)
+        await self.clear_attempt(batch_id, 0)
+        await self.publish_totals(batch_id, 0, 0, 0, 0)
+        interner = Interner()
+        errors = []
+        timings = Timings()
+        upload = await self.open_upload(file_id)
+        try:
+            chunks = iter_rows_from_xml(upload, interner=interner, errors=errors, timings=timings)
+            total_transactions, invalid_transactions_count, duplicate_rows, service = await self.ingest(batch['batch_name'], batch_id, chunks, errors, timings=timings)
+        finally:
+            await upload.close()
+        valid_transactions_count = total_transactions - invalid_transactions_count
+        rejected_rows = await self.ingest_errors.count(batch_id)
+        await self.publish_totals(batch_id, valid_transactions_count, invalid_transactions_count, rejected_rows, duplicate_rows)
+        created = await self.batches.transition(batch_id, BatchStatus.CREATED, {
+            "total_transactions":total_transactions,"valid_transactions":valid_transactions_count,"invalid_transactions": invalid_transactions_count,
+            "cache_hits":service.cache_hits,"cache_misses":service.cache_misses,
+            "rejected_rows": rejected_rows,"duplicate_rows": duplicate_rows,
+            **interner.summary()})
+        if not created:
+            logger.warning(f"Batch {batch_id} was ingested but is no longer {BatchStatus.UPLOADED.value}")
+        await self.uploads.delete(file_id)
+        return valid_transactions_count
+
+    async def retry_transactions(self, batch_id: str, attempt: int, file_id: Optional[ObjectId] = None) -> int:
+        """
+        Re-ingest only the rejected rows of a batch, read by position from a corrected upload when there is one,
+        otherwise the stored raw rows are validated again. Rows that fail again replace the previous errors.
+        """
+        batch = await self.batches.get(batch_id)
+        await self.clear_attempt(batch_id, attempt)
+        records = await self.ingest_errors.records(batch_id)
+        errors = []
+        timings = Timings()
+        upload = await self.open_upload(file_id) if file_id else None
+        # Rejected rows the corrected file has, the others keep their errors. None when the stored rows are used.
+        found = set() if upload else None
+        try:
+            if upload:
+                chunks = iter_rows_from_xml(upload, errors=errors, rows={row for row, _ in records}, timings=timings, found=found)
+            else:
+                chunks = iter_rows_from_records(records, errors=errors, timings=timings)
+            total_transactions, invalid_transactions_count, duplicate_rows, service = await self.ingest(batch['batch_name'], batch_id, chunks, errors, attempt, timings)
+        finally:
+            if upload:
+                await upload.close()
+        # Rows that failed again were recorded under this attempt.
+        await self.ingest_errors.delete_previous(batch_id, attempt, found)
+        totals = {
+            "valid_transactions": batch['valid_transactions'] + total_transactions - invalid_transactions_count,
+            "invalid_transactions": batch['invalid_transactions'] + invalid_transactions_count,
+            "rejected_rows": await self.ingest_errors.count(batch_id),
+            "duplicate_rows": batch.get('duplicate_rows', 0) + duplicate_rows,
+        }
+        await self.publish_totals(batch_id, *totals.values())
+        await self.batches.transition(batch_id, BatchStatus.CREATED, {
+            "retry_error": None,
+            "total_transactions": batch['total_transactions'] + total_transactions,
+            "cache_hits": batch.get('cache_hits', 0) + service.cache_hits,
+            "cache_misses": batch.get('cache_misses', 0) + service.cache_misses,
+            **totals})
+        if file_id:
+            await self.uploads.delete(file_id)
+        return total_transactions - invalid_transactions_count
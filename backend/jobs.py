@@ -0,0 +1,94 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+
+from models import JobStatus, QueueJob
+
+INGEST = 'ingest'
+RETRY = 'retry'
+PAYOUT = 'payout'
+
+
+@dataclass
+class JobQueue:
+    """
+    Persistent job queue on a Mongo collection, shared by the API (which enqueues) and the workers.
+    A worker claims a job with a lease and keeps renewing it while the job runs. A job whose lease expires,
+    because its worker died, is claimed again by another worker until it runs out of attempts.
+    """
+    collection: AsyncIOMotorCollection
+    max_attempts: int = 3
+
+    async def enqueue(self, kind: str, batch_id: str, payload: Optional[Dict[str, Any]] = None) -> QueueJob:
+        return (await self.enqueue_many(kind, batch_id, [payload or {}]))[0]
+
+    async def enqueue_many(self, kind: str, batch_id: str, payloads: List[Dict[str, Any]]) -> List[QueueJob]:
+        jobs = [QueueJob(kind=kind, batch_id=batch_id, payload=payload, max_attempts=self.max_attempts) for payload in payloads]
+        if jobs:
+            await self.collection.insert_many([job.dict(by_alias=True) for job in jobs])
+        return jobs
+
+    async def claim(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        "Oldest job that is queued or whose lease expired, leased to worker_id."
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {'$or': [{'status': JobStatus.QUEUED.value},
+                     {'status': JobStatus.RUNNING.value, 'lease_expires': {'$lt': now}}]},
+            {'$set': {'status': JobStatus.RUNNING.value, 'lease_owner': worker_id,
+                      'lease_expires': now + timedelta(seconds=lease_seconds), 'date_updated': now},
+             '$inc': {'attempts': 1}},
+            sort=[('date_created', 1)],
+            return_document=ReturnDocument.AFTER)
+
+    async def _update_leased(self, job_id: ObjectId, worker_id: str, fields: Dict[str, Any]) -> bool:
+        "Update a job only while worker_id still holds its lease."
+        result = await self.collection.update_one({'_id': job_id, 'status': JobStatus.RUNNING.value, 'lease_owner': worker_id},
+                                                  {'$set': {**fields, 'date_updated': datetime.utcnow()}})
+        return result.modified_count == 1
+
+    async def heartbeat(self, job_id: ObjectId, worker_id: str, lease_seconds: float) -> bool:
+        "Renew the lease, False when it was lost to another worker."
+        return await self._update_leased(job_id, worker_id, {'lease_expires': datetime.utcnow() + timedelta(seconds=lease_seconds)})
+
+    async def complete(self, job_id: ObjectId, worker_id: str) -> bool:
+        return await self._update_leased(job_id, worker_id, {'status': JobStatus.DONE.value, 'lease_owner': None, 'lease_expires': None})
+
+    async def fail(self, job: dict, worker_id: str, error: str) -> Optional[str]:
+        "Queue the job again or give up on it when it ran out of attempts, returns the new status or None if the lease was lost."
+        status = JobStatus.FAILED if job['attempts'] >= job['max_attempts'] else JobStatus.QUEUED
+        updated = await self._update_leased(job['_id'], worker_id, {'status': status.value, 'error': error, 'lease_owner': None, 'lease_expires': None})
+        return status.value if updated else None
+
+    async def cancel(self, batch_id: str, kind: Optional[str] = None):
+        "Drop the queued jobs of a batch, jobs already running finish."
+        query = {'batch_id': batch_id, 'status': JobStatus.QUEUED.value}
+        if kind:
+            query['kind'] = kind
+        await self.collection.update_many(query, {'$set': {'status': JobStatus.CANCELLED.value, 'date_updated': datetime.utcnow()}})
+
+    async def pending(self, batch_id: str, kind: str, query: Optional[Dict[str, Any]] = None) -> int:
+        "Jobs of a batch that are queued or running."
+        return await self.collection.count_documents({'batch_id': batch_id, 'kind': kind,
+                                                      'status': {'$in': [JobStatus.QUEUED.value, JobStatus.RUNNING.value]},
+                                                      **(query or {})})
+
+    async def list(self, batch_id: str) -> List[QueueJob]:
+        return [QueueJob(**job) async for job in self.collection.find({'batch_id': batch_id}).sort('date_created', 1)]
+
+
+@dataclass
+class WorkerRegistry:
+    "Last report of every worker process: what it is running and its in-memory cache counters."
+    collection: AsyncIOMotorCollection
+
+    async def report(self, worker_id: str, fields: Dict[str, Any]):
+        await self.collection.update_one({'_id': worker_id}, {'$set': {**fields, 'date_updated': datetime.utcnow()}}, upsert=True)
+
+    async def live(self, max_age: float) -> List[dict]:
+        "Workers that reported in the last max_age seconds."
+        since = datetime.utcnow() - timedelta(seconds=max_age)
+        return await self.collection.find({'date_updated': {'$gte': since}}).sort('date_updated', -1).to_list(None)
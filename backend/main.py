@@ -1,15 +1,18 @@
-import csv
-import io
+from datetime import datetime
+from typing import List, Optional
+
 from config import Config
+from context import AppContext
 
-from bson import ObjectId
-from fastapi import BackgroundTasks, FastAPI, File, HTTPException, UploadFile
+from fastapi import FastAPI, File, Header, HTTPException, Query, Request, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
-from method_manager import MethodWrapper, TransactionService
-from models import Batch, BatchStatus, TransactionBatchResponse
-from pymongo import MongoClient, UpdateOne
-from xml_parser import parse_rows_from_xml
+from jobs import INGEST, PAYOUT, RETRY
+from metrics import METRICS, render
+from models import Batch, BatchPage, BatchProgress, BatchStatus, BatchTotals, ExportFormat, IngestErrorPage, PayoutJobStatus, QueueJob, Reconciliation, TransactionBatchResponse, format_cents
+from progress import stream_progress
+from reports import BRANCH_COLUMNS, PAYMENT_COLUMNS, SOURCE_ACCOUNT_COLUMNS, csv_response
+from rollups import BRANCH, SOURCE
 
 
 app = FastAPI()
@@ -22,144 +25,268 @@ app.add_middleware(
     allow_headers=["*"],
 )
 config = Config()
-client = MongoClient(config.MONGO_URI)
-method = MethodWrapper(api_key=config.METHOD_API_KEY)
-db = client["payments"]
+# Clients and services are created on first use, see context.py.
+context = AppContext(config)
+
+# Check Mongo and the configuration and create the indexes, the API does not start without Mongo.
+@app.on_event("startup")
+async def start_context():
+    await context.startup()
+
+@app.on_event("shutdown")
+async def close_context():
+    await context.close()
+
+# Health of Mongo and of the configuration, 503 while Mongo is not available.
+@app.get("/health")
+async def get_health(response: Response):
+    checks = await context.check()
+    if checks['mongo'] != 'ok':
+        response.status_code = 503
+    return checks
+
+# Explain the hot queries and flag the ones that fall back to a collection scan.
+@app.get("/diagnostics/query-plans")
+async def get_query_plans(batch_id: str = ''):
+    from indexes import explain_hot_queries
+    return await explain_hot_queries(context.db, batch_id)
 
 # Get cvs report of Total amount of funds paid out per unique source account.
 @app.get("/reports/batches/{id}/source_account")
-async def get_sum_transactions_per_source(id: str):
-    transactions_collection = db["transactions"]
+async def get_sum_transactions_per_source(id: str, gzip: bool = False):
+    results = await context.rollups.totals(id, SOURCE)
+    rows = ({"Source Account": result["key"], "Total Amount": format_cents(result["total"])} async for result in results)
+    return csv_response(rows, SOURCE_ACCOUNT_COLUMNS, "report_total_spend_per_source_account.csv", gzip)
 
-    pipeline = [
-    {"$match": {"batch_id":id}},  # Filter by batch_name
-    {"$group": {
-        "_id": "$payment.source",  # Group by payment.source
-        "totalAmount": {"$sum": "$transaction.Amount"}  # Sum the Amount
-    }}
-    ]
-    results =  list(transactions_collection.aggregate(pipeline))
-    results_list = [{"Source Account": result["_id"], "Total Amount": result["totalAmount"]} for result in results]
+# Get csv report of Total amount of funds paid out per Dunkin branch.
+@app.get("/reports/batches/{id}/branch")
+async def get_sum_transactions_for_account(id: str, gzip: bool = False):
+    results = await context.rollups.totals(id, BRANCH)
+    rows = ({"Dunkin branch Id": result["key"], "Total Amount": format_cents(result["total"])} async for result in results)
+    return csv_response(rows, BRANCH_COLUMNS, "report_total_spend_per_branch.csv", gzip)
 
-    # Define the fieldnames for the CSV
-    fieldnames = ["Source Account", "Total Amount"]
+# Compare the precomputed report totals of a batch with its transactions, optionally rebuilding them.
+@app.get("/reports/batches/{id}/consistency")
+async def check_report_rollups(id: str, recompute: bool = False):
+    if recompute:
+        await context.rollups.recompute(id)
+    return await context.rollups.check(id)
 
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(results_list)
+# Get csv report of all payments metadata for a given batch name.
+@app.get("/reports/batches/{id}/payments")
+async def get_payments_metadata(id: str, gzip: bool = False):
+    payments = (tnx['payment'] async for tnx in context.transactions.payments(id, config.REPORT_BATCH_SIZE))
+    return csv_response(payments, PAYMENT_COLUMNS, "report_all_payments.csv", gzip)
 
-    response = StreamingResponse(iter([output.getvalue()]), media_type="text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=report_total_spend_per_source_account.csv"
+# Export the transactions of a batch with their payment metadata as Parquet or an Arrow stream, for warehouse loads.
+@app.get("/exports/batches/{id}/payments")
+async def export_batch_payments(id: str, format: ExportFormat = ExportFormat.PARQUET):
+    from export import export_response, record_batches, single
+    batch = await context.batches.get(id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return export_response(record_batches(context.transactions, single(batch), config.EXPORT_ROW_GROUP_SIZE, config.REPORT_BATCH_SIZE),
+                           format, f"payments_{id}")
 
-    return response
+# Export the batches created in [start, end) in one file, same schema as the single batch export.
+@app.get("/exports/payments")
+async def export_payments(start: datetime, end: datetime, format: ExportFormat = ExportFormat.PARQUET):
+    from export import export_response, record_batches
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    selected = context.batches.created_between(start, end)
+    return export_response(record_batches(context.transactions, selected, config.EXPORT_ROW_GROUP_SIZE, config.REPORT_BATCH_SIZE),
+                           format, f"payments_{start.date()}_{end.date()}")
 
-# Get csv report of Total amount of funds paid out per Dunkin branch.
-@app.get("/reports/batches/{id}/branch")
-async def get_sum_transactions_for_account(id: str):
-    transactions_collection = db["transactions"]
+# Get hit/miss counters of the merchant lookup cache, summed over the live workers.
+@app.get("/merchants/cache")
+async def get_merchant_cache_stats():
+    stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'size': 0}
+    for worker in await context.workers.live(2 * config.JOB_LEASE_SECONDS):
+        for key, value in (worker.get('merchant_cache') or {}).items():
+            stats[key] = stats.get(key, 0) + value
+    return stats
 
-    pipeline = [
-    {"$match": {"batch_id":id}},  # Filter by batch_name
-    {"$group": {
-        "_id": "$transaction.Payor.DunkinId",  # Group by transaction.Payor.DunkinId
-        "totalAmount": {"$sum": "$transaction.Amount"}  # Sum the Amount
-    }}
-    ]
-    results =  list(transactions_collection.aggregate(pipeline))
-    results_list = [{"Dunkin branch Id": result["_id"], "Total Amount": result["totalAmount"]} for result in results]
+# Get Method rate limiter metrics per operation (calls, waits, rejections, fallbacks), summed over the live workers.
+@app.get("/rate-limits")
+async def get_rate_limit_stats():
+    stats = {}
+    for worker in await context.workers.live(2 * config.JOB_LEASE_SECONDS):
+        for operation, metrics in (worker.get('rate_limit') or {}).items():
+            totals = stats.setdefault(operation, {})
+            for key, value in metrics.items():
+                totals[key] = max(totals.get(key, 0), value) if key == 'max_wait_seconds' else totals.get(key, 0) + value
+    return stats
 
-    # Define the fieldnames for the CSV
-    fieldnames = ["Dunkin branch Id", "Total Amount"]
+# Get the metrics of the API and of the live workers in the Prometheus text format.
+@app.get("/metrics")
+async def get_metrics():
+    snapshots = {"api": METRICS.snapshot()}
+    for worker in await context.workers.live(2 * config.JOB_LEASE_SECONDS):
+        if worker.get('metrics'):
+            snapshots[worker['_id']] = worker['metrics']
+    return Response(render(snapshots), media_type="text/plain; version=0.0.4")
 
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(results_list)
+# Get the worker processes that reported recently and the job each one is running.
+@app.get("/workers")
+async def get_workers():
+    return [{**{key: value for key, value in worker.items() if key != 'metrics'}, 'job_id': str(worker['job_id']) if worker.get('job_id') else None}
+            for worker in await context.workers.live(2 * config.JOB_LEASE_SECONDS)]
 
-    response = StreamingResponse(iter([output.getvalue()]), media_type="text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=report_total_spend_per_branch.csv"
+# Stream the progress of every batch as server-sent events, used by the dashboard instead of polling /batches.
+@app.get("/events/batches")
+async def stream_batches_progress(request: Request):
+    return StreamingResponse(stream_progress(context.hub, request), media_type="text/event-stream")
 
-    return response
+# Stream the progress of one batch as server-sent events, starting with its current progress.
+@app.get("/events/batches/{id}")
+async def stream_batch_progress(id: str, request: Request):
+    return StreamingResponse(stream_progress(context.hub, request, id), media_type="text/event-stream")
 
-# Get csv report of all payments metadata for a given batch name.
-@app.get("/reports/batches/{id}/payments")
-async def get_payments_metadata(id: str):
-    transactions_collection = db["transactions"]
-    transactions = transactions_collection.find({"batch_id": id})
-    payments_list = [tnx['payment'] for tnx in transactions if 'payment' in tnx]
-
-    # Define the fieldnames for the CSV
-    fieldnames = [col for col in payments_list[0].keys()]
-
-    output = io.StringIO()
-    writer = csv.DictWriter(output, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(payments_list)
-
-    response = StreamingResponse(iter([output.getvalue()]), media_type="text/csv")
-    response.headers["Content-Disposition"] = "attachment; filename=report_all_payments.csv"
-
-    return response
-
-# Get all batches.
-@app.get("/batches",response_model=list[Batch])
-async def get_all_batches():
-    batches_collection = db["batches"]
-    results = []
-    batches = batches_collection.find()
-    for batch in batches:
-        results.append(Batch(**batch))
-    return results
+# Get the current progress counters of a batch, with the same fields as the events of /events/batches/{id}.
+@app.get("/batches/{id}/progress",response_model=BatchProgress,response_model_by_alias=False)
+async def get_batch_progress(id: str):
+    document = await context.progress.get(id)
+    if not document:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return document
+
+# Get a page of batches, newest first.
+# Unchanged listings are answered with 304 from the If-None-Match ETag without querying the batches.
+@app.get("/batches",response_model=BatchPage)
+async def get_all_batches(response: Response,
+                          status: Optional[List[str]] = Query(None),
+                          limit: int = Query(100, ge=1, le=1000),
+                          after: Optional[str] = None,
+                          if_none_match: Optional[str] = Header(None)):
+    etag = await context.batches.etag(status, limit, after)
+    if etag and if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    try:
+        page = await context.batches.page(status, limit, after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    if etag:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+    return page
+
+# Get a single batch with its totals, cache counters and distinct employee/payor counts.
+@app.get("/batches/{id}",response_model=Batch)
+async def get_batch(id: str):
+    batch = await context.batches.get(id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    return batch
 
 # Upload an xml and create transactions.
+# The file is stored in GridFS and ingested by a worker, totals are filled in once the batch is created.
+# A file that was already uploaded returns the existing batch, rows already created by another batch are skipped.
 @app.post("/upload/xml")
-async def upload_file(background_tasks: BackgroundTasks,file: UploadFile=File(...)):
+async def upload_file(file: UploadFile=File(...)):
     try:
         filename = file.filename.split('.')[0]
-        transactions = parse_rows_from_xml(file)
-        total_transactions = len(transactions)
-        batches_collection = db["batches"]
-        batch = Batch(batch_name=filename,total_transactions=total_transactions,valid_transactions=0,invalid_transactions=0)
-        batches_collection.insert_one(batch.dict(by_alias=True))
-        background_tasks.add_task(create_transactions,filename, transactions, total_transactions, batches_collection, batch)
-        return TransactionBatchResponse(batch_id=str(batch.id),batch_name=filename,total_transactions=total_transactions,valid_transactions=0)
+        file_id, content_hash = await context.ingestor.save_upload(file)
+        batch = Batch(batch_name=filename,total_transactions=0,valid_transactions=0,invalid_transactions=0,content_hash=content_hash)
+        existing_id = await context.hashes.claim_upload(content_hash, str(batch.id))
+        existing = await context.batches.get(existing_id) if existing_id else None
+        # A batch that failed while ingesting has no rows to pay, the file starts a new batch.
+        if existing and existing['status'] == BatchStatus.FAILED.value and not await context.payouts.get_job(existing_id):
+            await context.hashes.release(existing_id)
+            existing = None
+        if existing:
+            await context.ingestor.uploads.delete(file_id)
+            return TransactionBatchResponse(batch_id=existing_id,batch_name=existing['batch_name'],total_transactions=existing['total_transactions'],
+                                            valid_transactions=existing['valid_transactions'],duplicate=True)
+        if existing_id:
+            await context.hashes.replace_upload(content_hash, str(batch.id))
+        await context.batches.insert(batch)
+        await context.queue.enqueue(INGEST, str(batch.id), {'file_id': file_id})
+        return TransactionBatchResponse(batch_id=str(batch.id),batch_name=filename,total_transactions=0,valid_transactions=0)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-async def create_transactions(filename, transactions, total_transactions, batches_collection, batch):
-    transactions_summaries = await TransactionService(method,transactions,filename,str(batch.id)).create_batch()
-    invalid_transactions_count = len([tnx for tnx in transactions_summaries if tnx.status =='failed'])
-    valid_transactions_count = total_transactions - invalid_transactions_count
-    if transactions_summaries:
-        transactions_collection = db["transactions"]        
-        transactions_collection.insert_many([tnx.dict() for tnx in transactions_summaries])
-    batches_collection.update_one({"_id": batch.id}, {"$set": {"valid_transactions":valid_transactions_count,"invalid_transactions": invalid_transactions_count,'status':BatchStatus.CREATED.value}})
-    return valid_transactions_count
-    
+# Get exact totals in cents of a batch by source account, branch and status, computed from its transactions.
+# Reconcile them with the upload before invoking the payouts.
+@app.get("/batches/{id}/totals",response_model=BatchTotals)
+async def get_batch_totals(id: str):
+    if not await context.batches.get(id):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    from summary import summarize_batch
+    return await summarize_batch(context.transactions, id, config.REPORT_BATCH_SIZE)
+
+# Get the rows of a batch that were rejected while parsing, with the field and reason.
+@app.get("/batches/{id}/errors",response_model=IngestErrorPage)
+async def get_ingest_errors(id: str, limit: int = Query(100, ge=1, le=1000), after: Optional[str] = None):
+    try:
+        return await context.ingest_errors.page(id, limit, after)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+# Re-ingest only the rows of a batch that were rejected while parsing, the rows already created are left alone.
+# With a corrected file the rejected rows are read from it by position, otherwise the stored rows are validated again.
+@app.post("/batches/{id}/retry")
+async def retry_rejected_rows(id: str, file: Optional[UploadFile] = File(None)):
+    batch = await context.batches.get(id)
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    rows = await context.ingest_errors.count(id)
+    if not rows:
+        raise HTTPException(status_code=400, detail="No rejected rows to retry.")
+    attempt = batch.get('retries', 0) + 1
+    if batch['status'] != BatchStatus.CREATED.value or not await context.batches.transition(id, BatchStatus.UPLOADED, {'retries': attempt}):
+        raise HTTPException(status_code=400, detail="Cannot retry rows for this batch at this time.")
+    payload = {'attempt': attempt}
+    if file:
+        payload['file_id'], _ = await context.ingestor.save_upload(file)
+    await context.queue.enqueue(RETRY, id, payload)
+    return {"message": "Retrying rejected rows.", "rows": rows}
+
+# Get the queued, running and finished jobs of a batch.
+@app.get("/batches/{id}/jobs",response_model=List[QueueJob])
+async def get_batch_jobs(id: str):
+    return await context.queue.list(id)
+
+# Reconcile the unpaid rows of a batch without calling Method or changing anything: rows with a missing account,
+# duplicate employee + amount rows and payors above their limit.
+@app.get("/invoke-payment/{id}/dry-run", response_model=Reconciliation)
+async def reconcile_payment(id: str):
+    if not await context.batches.get(id):
+        raise HTTPException(status_code=404, detail="Batch not found")
+    reconciliation, _ = await context.reconciler.check(id)
+    return reconciliation
+
 # Invoke a payment for all transaction in a batch.
+# The payouts are queued as shards that the workers run in parallel, a failed payout can be invoked again
+# and only pays the rows that were not paid yet.
+# Rows with a missing account are skipped, a batch with duplicates or payors above their limit is refused with
+# the reconciliation unless force is set.
 @app.post("/invoke-payment/{id}")
-async def invoke_payment(id: str):
-    batch_collection = db["batches"]
-    batch = batch_collection.find_one({"_id": ObjectId(id)})
+async def invoke_payment(id: str, force: bool = False):
+    batch = await context.batches.get(id)
     if not batch:
         raise HTTPException(status_code=404, detail="Batch not found")
-    if batch['status'] != 'Created':
+    if not await context.transactions.exists(id):
+        raise HTTPException(status_code=404, detail="No transactions found for this batch name.")
+    # A batch fails while ingesting too, only one whose payout failed can be paid.
+    if batch['status'] == BatchStatus.FAILED.value and not await context.payouts.get_job(id):
+        raise HTTPException(status_code=400, detail="Cannot invoke payment for this batch at this time.")
+    reconciliation, skipped = await context.reconciler.check(id)
+    if not reconciliation.ok and not force:
+        raise HTTPException(status_code=409, detail=reconciliation.dict())
+    if not await context.batches.transition(id, BatchStatus.PROCESSING):
         raise HTTPException(status_code=400, detail="Cannot invoke payment for this batch at this time.")
-    transactions_collection = db["transactions"]
-    tnx_summaries = transactions_collection.find({"batch_id": id})
-    updates = []
-    for tnx_summary in tnx_summaries:
-        try:
-            payment = TransactionService.invoke_payment(tnx_summary['transaction']['Amount'],tnx_summary['source'],tnx_summary['destination'],method)
-            updates.append(UpdateOne({"_id": tnx_summary["_id"]}, {"$set": {"status": 'success','payment':payment}}))
-        except Exception:
-            updates.append(UpdateOne({"_id": tnx_summary["_id"]}, {"$set": {"status": 'failed'}}))
-            continue
-    batch_collection.update_one({"_id": batch["_id"]}, {"$set": {"status":BatchStatus.COMPLETED.value}})
-    if updates:
-        transactions_collection.bulk_write(updates)
-        return {"message": "Payouts created successfully!"}
+    job, shards = await context.payouts.start(id, skipped)
+    if shards:
+        await context.queue.enqueue_many(PAYOUT, id, shards)
     else:
-         raise HTTPException(status_code=404, detail="No transactions found for this batch name.")
+        await context.payouts.complete(id)
+    return {"message": "Payouts started.", "job": job, "shards": len(shards), "reconciliation": reconciliation}
 
+# Get progress, throughput and ETA of the payout job of a batch.
+@app.get("/invoke-payment/{id}/status", response_model=PayoutJobStatus)
+async def get_payout_status(id: str):
+    status = await context.payouts.status(id)
+    if not status:
+        raise HTTPException(status_code=404, detail="No payout job found for this batch.")
+    return status
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Tuple
+
+
+class MerchantCache:
+    """
+    PlaidId -> Method merchant id with a TTL and size bounded LRU eviction.
+    Concurrent misses for the same PlaidId share a single lookup, the other callers wait on its result.
+    Failed lookups are not cached.
+    """
+    def __init__(self, resolve: Callable[[str], str], ttl: float = 3600, max_size: int = 1024):
+        self.resolve = resolve
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def get(self, plaid_id: str) -> str:
+        with self._lock:
+            entry = self._entries.get(plaid_id)
+            if entry and entry[1] > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(plaid_id)
+                return entry[0]
+            future = self._pending.get(plaid_id)
+            owner = future is None
+            if owner:
+                self.misses += 1
+                future = self._pending[plaid_id] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            mch_id = self.resolve(plaid_id)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(mch_id)
+            with self._lock:
+                self._entries[plaid_id] = (mch_id, time.monotonic() + self.ttl)
+                self._entries.move_to_end(plaid_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return mch_id
+        finally:
+            with self._lock:
+                self._pending.pop(plaid_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'size': len(self._entries)}
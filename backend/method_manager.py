@@ -1,11 +1,16 @@
 import asyncio
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
-from typing import Dict, List
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, TypeVar
 
+from account_cache import AccountCache, CachedAccount, fingerprint
 from fastapi.logger import logger
+from merchant_cache import MerchantCache
 from method import Method
+from metrics import METRICS, Timings, timed
 from models import (
     Employee,
     Payee,
@@ -16,66 +21,150 @@ from models import (
     get_unique_employees,
     get_unique_payors,
 )
-from ratelimit import limits, sleep_and_retry
+from rate_limiter import RateLimiter
 
 PHONE_NUMBER = '15121231111'
 
+T = TypeVar('T')
+
 
 class MethodOperation(Enum):
     CREATE_PAYMENT = 1
     CREATE_ACCOUNT = 2
     CREATE_ENTITY = 3
+    LIST_MERCHANTS = 4
 class MethodWrapper(Method):
     "class to wrap the Method class and add functionality to avoid overuse of the method api"
-    def __init__(self,env:str='dev', api_key:str=''):
+    def __init__(self,env:str='dev', api_key:str='', calls:int=599, period:int=60, max_in_flight:int=16,
+                 merchant_cache_ttl:float=3600, merchant_cache_size:int=1024, rate_limiter:Optional[RateLimiter]=None):
         super().__init__(env=env,api_key=api_key)
+        # Method api has a limit of 600 calls per minute.
+        # Every call goes through this limiter, pass one backed by Mongo to share the budget between processes.
+        self.rate_limiter = rate_limiter or RateLimiter(calls, period)
+        self.executor = MethodExecutor(max_in_flight)
+        self.merchant_cache = MerchantCache(self.list_merchant_id, merchant_cache_ttl, merchant_cache_size)
+
+    def invoke_method_api(self,request,method_operation:MethodOperation,idempotency_key:Optional[str]=None):
+        operation = method_operation.name
+        METRICS.observe('method_rate_limit_wait_seconds', self.rate_limiter.acquire(operation), operation=operation)
+        logger.debug("invoking method api for : %s",method_operation)
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = self.call_method_api(request, method_operation, idempotency_key)
+            outcome = 'success'
+            return result
+        finally:
+            METRICS.observe('method_call_duration_seconds', time.perf_counter() - start, operation=operation)
+            METRICS.inc('method_calls_total', operation=operation, outcome=outcome)
 
-    # Method api has a limit of 600 calls per minute.
-    # This decorator will ensure that we do not exceed that limit.
-    @sleep_and_retry
-    @limits(calls=599, period=60)
-    def invoke_method_api(self,request,method_operation:MethodOperation):
-        logger.info("invoking method api for : %s",method_operation)
+    def call_method_api(self,request,method_operation:MethodOperation,idempotency_key:Optional[str]=None):
         match method_operation:
             case MethodOperation.CREATE_PAYMENT:
-                return self.payments.create(request)
+                return self.payments.create(request, {'idempotency_key': idempotency_key} if idempotency_key else None)
             case MethodOperation.CREATE_ACCOUNT:
                 return self.accounts.create(request)
             case MethodOperation.CREATE_ENTITY:
                 return self.entities.create(request)
+            case MethodOperation.LIST_MERCHANTS:
+                return self.merchants.list(request)
             case _:
                 raise Exception('Invalid Method Operation')
+
+    def list_merchant_id(self, plaid_id:str) -> str:
+        """
+        Look up the Method Merchant ID for a PlaidId.
+        Assume the first merchant is the correct one.
+        """
+        return self.invoke_method_api({'provider_ids.plaid_id': plaid_id}, MethodOperation.LIST_MERCHANTS)[0]['mch_id']
+
+    def get_merchant_id(self, plaid_id:str) -> str:
+        return self.merchant_cache.get(plaid_id)
+
+class MethodExecutor:
+    """
+    Bounded pool for blocking Method calls.
+    At most max_in_flight calls run at once, the rate limit itself is enforced by MethodWrapper.invoke_method_api,
+    so enough requests are pipelined to keep the budget saturated without ever exceeding it.
+    """
+    def __init__(self, max_in_flight:int=16):
+        self.max_in_flight = max_in_flight
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='method')
+        self._semaphores: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphores[loop]
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        async with self._semaphore():
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+
+    async def map(self, fn: Callable[..., T], *iterables) -> List[T]:
+        return await asyncio.gather(*[self.run(fn, *args) for args in zip(*iterables)])
+
 @dataclass
 class TransactionService:
     method_client : MethodWrapper
     transactions:List[Transaction]
     batch_name:str
     batch_id:str
+    # Accounts already created for this batch, kept across chunks so repeated ids are created once.
+    sources: Dict[str, str] = field(default_factory=dict)
+    destinations: Dict[str, str] = field(default_factory=dict)
+    account_cache: Optional[AccountCache] = None
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Ingest attempt the summaries are created by.
+    attempt: int = 0
+    timings: Timings = field(default_factory=Timings)
 
     @property
     async def employees_entities(self) -> Dict[str, str]:
-        unique_employees = get_unique_employees(self.transactions)
-        return {tnx.Employee.DunkinId:self.get_employee_account(tnx) for tnx in unique_employees}
-
-    def get_employee_account(self, tnx):    
-        return IndividualAccount(tnx.Payee, tnx.Employee, self.method_client).payment_account()
+        unique_employees = [tnx for tnx in get_unique_employees(self.transactions) if tnx.Employee.DunkinId not in self.destinations]
+        accounts = [IndividualAccount(tnx.Payee, tnx.Employee, self.method_client, timings=self.timings) for tnx in unique_employees]
+        self.destinations.update(await self.payment_accounts(IndividualAccount.kind, accounts))
+        return self.destinations
 
     @property
     async def corporate_entities(self) -> Dict[str, str]:
-        unique_payors = get_unique_payors(self.transactions)
-        tasks = [self.get_corp_account_async(tnx) for tnx in unique_payors]
-        result = await asyncio.gather(*tasks)
-        return {tnx.Payor.DunkinId: payment_account for tnx, payment_account in zip(unique_payors, result)}
-
-    async def get_corp_account_async(self, tnx):
-        loop = asyncio.get_event_loop()
-        account =  CorporationAccount(tnx.Payor, self.method_client)
-        return await loop.run_in_executor(None, account.payment_account)
+        unique_payors = [tnx for tnx in get_unique_payors(self.transactions) if tnx.Payor.DunkinId not in self.sources]
+        accounts = [CorporationAccount(tnx.Payor, self.method_client, timings=self.timings) for tnx in unique_payors]
+        self.sources.update(await self.payment_accounts(CorporationAccount.kind, accounts))
+        return self.sources
+
+    async def payment_accounts(self, kind: str, accounts: List['Account']) -> Dict[str, str]:
+        """
+        Payment account id per DunkinId.
+        Accounts created for the same DunkinId in a previous batch are reused when their details did not change,
+        when they did the cached entity is kept and only the account is recreated.
+        """
+        cached = await self.account_cache.get_many(kind, [account.dunkin_id for account in accounts]) if self.account_cache else {}
+        result = {}
+        missing = []
+        for account in accounts:
+            entry = cached.get(account.dunkin_id)
+            if entry and entry.fingerprint == account.fingerprint:
+                result[account.dunkin_id] = entry.account_id
+                continue
+            if entry:
+                account.holder_id = entry.entity_id
+            missing.append(account)
+        if self.account_cache:
+            self.cache_hits += len(result)
+            self.cache_misses += len(missing)
+        created = await self.method_client.executor.map(lambda account: account.payment_account(), missing)
+        result.update({account.dunkin_id: account_id for account, account_id in zip(missing, created)})
+        if self.account_cache:
+            await self.account_cache.set_many(kind, {account.dunkin_id: CachedAccount(entity_id=account.holder_id, account_id=account_id, fingerprint=account.fingerprint)
+                                                     for account, account_id in zip(missing, created) if account_id != 'N/A'})
+        return result
     
     async def create_batch(self) -> List[TransactionSummary]:
         result = []
-        sources = await self.corporate_entities
-        destinations = await self.employees_entities
+        sources, destinations = await asyncio.gather(self.corporate_entities, self.employees_entities)
         for tnx in self.transactions:
             destination = destinations[tnx.Employee.DunkinId]
             source = sources[tnx.Payor.DunkinId]
@@ -85,10 +174,29 @@ class TransactionService:
                                              destination=payment.destination,
                                              status='created' if payment.is_valid else 'failed',
                                              batch_id=self.batch_id,
-                                             batch_name=self.batch_name)
+                                             batch_name=self.batch_name,
+                                             attempt=self.attempt)
             result.append(tnx_summary)
         return result
 
+    async def create_batches(self, chunks: Iterable[List[Transaction]],
+                             keep: Optional[Callable[[List[Transaction]], Awaitable[List[Transaction]]]] = None) -> AsyncIterator[List[TransactionSummary]]:
+        """
+        Pipeline version of create_batch, consumes transactions chunk by chunk and yields the summaries of each chunk.
+        keep filters the transactions of a chunk before any Method call.
+        """
+        # Chunks are parsed on a worker thread so parsing does not block the event loop.
+        loop = asyncio.get_running_loop()
+        iterator = iter(chunks)
+        while (transactions := await loop.run_in_executor(None, next, iterator, None)) is not None:
+            if keep:
+                transactions = await keep(transactions)
+            if not transactions:
+                yield []
+                continue
+            self.transactions = transactions
+            yield await self.create_batch()
+
     @staticmethod
     def create_payment(source:str,destination:str)-> Payment:
         try:
@@ -98,23 +206,40 @@ class TransactionService:
             return Payment(status='failed',is_valid=False,source=None,destination=None)
         
     @staticmethod
-    def invoke_payment(amount:float,source:str,destination:str,method_client:MethodWrapper):
+    def invoke_payment(amount:int,source:str,destination:str,method_client:MethodWrapper,idempotency_key:Optional[str]=None):
         return method_client.invoke_method_api(request = {
-                # amount is in cents so multiply by 100.
-                'amount': amount*100,
+                # Method takes the amount in cents, like Transaction.Amount.
+                'amount': amount,
                 'source': source,
                 'destination': destination,
                 'description': 'Loan Pmt'
                 },
-                method_operation=MethodOperation.CREATE_PAYMENT)
+                method_operation=MethodOperation.CREATE_PAYMENT,
+                idempotency_key=idempotency_key)
 
 class Account(ABC):
+    # Method entity id, set once the entity is created or when it is reused from the cache.
+    holder_id: Optional[str]
+    # Entity and account creation times of the batch the account is created for.
+    timings: Optional[Timings]
     @abstractmethod
     def create_account(self):
         pass
     @abstractmethod
     def create_entity(self):
         pass
+    @property
+    @abstractmethod
+    def kind(self) -> str:
+        pass
+    @property
+    @abstractmethod
+    def dunkin_id(self) -> str:
+        pass
+    @property
+    @abstractmethod
+    def fingerprint(self) -> str:
+        pass
     
 
 @dataclass
@@ -122,12 +247,26 @@ class IndividualAccount(Account):
     payee:Payee
     employee:Employee
     method_client:MethodWrapper
+    holder_id:Optional[str] = None
+    timings:Optional[Timings] = None
 
+    kind = 'individual'
+
+    @property
+    def dunkin_id(self) -> str:
+        return self.employee.DunkinId
+
+    @property
+    def fingerprint(self) -> str:
+        return fingerprint(self.payee.PlaidId, self.payee.LoanAccountNumber)
     
     def payment_account(self) -> str:
         try:
-            holder_id = self.create_entity()['id']
-            account = self.create_account(holder_id,self.payee.PlaidId,self.payee.LoanAccountNumber)
+            if self.holder_id is None:
+                with timed('entity', self.timings):
+                    self.holder_id = self.create_entity()['id']
+            with timed('account', self.timings):
+                account = self.create_account(self.holder_id,self.payee.PlaidId,self.payee.LoanAccountNumber)
             return account['id']
         except BaseException as e:
             logger.error(f"Error creating Individual Account {e}")
@@ -158,20 +297,35 @@ class IndividualAccount(Account):
     def get_individual_mch_id(self,plaid_id:str) -> str:
         """
         This method is used to get the Method Merchant ID for an individual.
-        Assume the first merchant is the correct one.
+        There are only a few loan servicers, so lookups are served from the client's merchant cache.
         """
-        return self.method_client.merchants.list({'provider_ids.plaid_id': plaid_id})[0]['mch_id']
+        return self.method_client.get_merchant_id(plaid_id)
 
 
 @dataclass
 class CorporationAccount(Account):
     payor:Payor
     method_client:MethodWrapper
+    holder_id:Optional[str] = None
+    timings:Optional[Timings] = None
+
+    kind = 'corporation'
+
+    @property
+    def dunkin_id(self) -> str:
+        return self.payor.DunkinId
+
+    @property
+    def fingerprint(self) -> str:
+        return fingerprint(self.payor.ABARouting, self.payor.AccountNumber)
     
     def payment_account(self) -> str:
         try:
-            holder_id = self.create_entity()['id']
-            account = self.create_account(holder_id,self.payor.ABARouting,self.payor.AccountNumber)
+            if self.holder_id is None:
+                with timed('entity', self.timings):
+                    self.holder_id = self.create_entity()['id']
+            with timed('account', self.timings):
+                account = self.create_account(self.holder_id,self.payor.ABARouting,self.payor.AccountNumber)
             return account['id']
         except BaseException as e:
             logger.error(f"Error creating Corporation Account {e}",e)
@@ -0,0 +1,139 @@
+"""
+In-process counters and latency histograms, rendered in the Prometheus text format by the API.
+Every worker process keeps its own and ships a snapshot with its report to the workers collection,
+/metrics renders the API's and the live workers' snapshots with a `worker` label.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+# Upper bounds of the latency buckets in seconds, the last one catches everything.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+HELP = {
+    'stage_duration_seconds': 'Time spent per pipeline stage (parse, validate, dedup, entity, account, mongo_write, payout, report, export).',
+    'method_call_duration_seconds': 'Latency of Method api calls per operation, excluding the rate limiter wait.',
+    'method_calls_total': 'Method api calls per operation and outcome.',
+    'method_rate_limit_wait_seconds': 'Time Method api calls waited for the rate limiter per operation.',
+    'rate_limit_conflicts_total': 'Shared rate limiter reservations retried because another process updated the bucket first.',
+    'jobs_total': 'Queue jobs run per kind and outcome.',
+    'job_retries_total': 'Queue jobs claimed again after an earlier attempt failed or its worker died.',
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    "Thread safe counters and histograms of one process."
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        # Per series: count per bucket (not cumulative), then sum and count.
+        self._histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, _labels(labels))] += value
+
+    def observe(self, name: str, value: float, **labels):
+        index = next(i for i, bound in enumerate(self.buckets) if value <= bound)
+        with self._lock:
+            series = self._histograms.setdefault((name, _labels(labels)), [0] * (len(self.buckets) + 2))
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self) -> dict:
+        "Plain data, safe to store in Mongo and merge."
+        with self._lock:
+            return {
+                'buckets': [str(bound) for bound in self.buckets],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in self._counters.items()],
+                'histograms': [{'name': name, 'labels': dict(labels), 'counts': series[:-2], 'sum': series[-2], 'count': series[-1]}
+                               for (name, labels), series in self._histograms.items()],
+            }
+
+
+class Timings:
+    "Seconds and count per stage for one batch, added to the batch document."
+    def __init__(self):
+        self._stages: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self._stages[stage][0] += seconds
+            self._stages[stage][1] += 1
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {stage: {'seconds': seconds, 'count': count} for stage, (seconds, count) in self._stages.items()}
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def timed(stage: str, timings: Optional[Timings] = None) -> Iterator[None]:
+    "Time a block as a pipeline stage, in the process metrics and optionally in a batch's timings."
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        METRICS.observe('stage_duration_seconds', elapsed, stage=stage)
+        if timings is not None:
+            timings.add(stage, elapsed)
+
+
+def timed_iter(iterable: Iterable[T], stage: str, timings: Optional[Timings] = None) -> Iterator[T]:
+    "Time every step of an iterator as a stage, for generators that do their work lazily."
+    iterator = iter(iterable)
+    while True:
+        with timed(stage, timings):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def render(snapshots: Dict[str, dict]) -> str:
+    "Prometheus text exposition of the snapshots of several processes, keyed by worker name."
+    lines: Dict[str, List[str]] = defaultdict(list)
+    kinds = {}
+    for worker, snapshot in snapshots.items():
+        for counter in snapshot.get('counters', []):
+            kinds[counter['name']] = 'counter'
+            lines[counter['name']].append(f"{counter['name']}{_format_labels({**counter['labels'], 'worker': worker})} {counter['value']}")
+        bounds = ['+Inf' if bound == 'inf' else bound for bound in snapshot.get('buckets', [])]
+        for histogram in snapshot.get('histograms', []):
+            name, labels = histogram['name'], {**histogram['labels'], 'worker': worker}
+            kinds[name] = 'histogram'
+            cumulative = 0
+            for bound, count in zip(bounds, histogram['counts']):
+                cumulative += count
+                lines[name].append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {cumulative}")
+            lines[name].append(f"{name}_sum{_format_labels(labels)} {histogram['sum']}")
+            lines[name].append(f"{name}_count{_format_labels(labels)} {histogram['count']}")
+    output = []
+    for name in sorted(lines):
+        output.append(f'# HELP {name} {HELP.get(name, name)}')
+        output.append(f'# TYPE {name} {kinds[name]}')
+        output.extend(lines[name])
+    return '\n'.join(output) + '\n'
@@ -0,0 +1,57 @@
+"""
+Convert the transaction amounts stored as float dollars, before amounts were kept in cents, to integer cents.
+
+    python migrate_amounts.py
+
+The rollups of every batch that had such rows are recomputed afterwards, their totals summed dollars and cents.
+Running it again only finds the rows it could not convert.
+"""
+import asyncio
+from typing import Dict
+
+from config import Config
+from fastapi.logger import logger
+from models import parse_amount
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+
+async def migrate_amounts(db: AsyncIOMotorDatabase, batch_size: int = 1000) -> Dict[str, int]:
+    "Returns the number of transactions converted, of rows that could not be and of batches recomputed."
+    from repository import TransactionRepository
+    from rollups import BatchRollups
+
+    transactions = TransactionRepository(db['transactions'])
+    batch_ids = set()
+    updates = []
+    converted = invalid = 0
+    async for tnx in transactions.find({'transaction.Amount': {'$type': 'double'}}, {'batch_id': 1, 'transaction.Amount': 1}, batch_size):
+        amount = tnx['transaction']['Amount']
+        try:
+            cents = parse_amount(amount)
+        except ValueError as e:
+            logger.warning(f"Transaction {tnx['_id']}: amount {amount} left as is, {e}")
+            invalid += 1
+            continue
+        # Only a row that still holds the float is converted.
+        updates.append(UpdateOne({'_id': tnx['_id'], 'transaction.Amount': amount}, {'$set': {'transaction.Amount': cents}}))
+        batch_ids.add(tnx['batch_id'])
+        if len(updates) == batch_size:
+            converted += await transactions.bulk_write(updates)
+            updates = []
+    converted += await transactions.bulk_write(updates)
+    rollups = BatchRollups(db['batch_rollups'], transactions)
+    for batch_id in batch_ids:
+        await rollups.recompute(batch_id)
+    return {'converted': converted, 'invalid': invalid, 'batches': len(batch_ids)}
+
+
+async def run():
+    from repository import create_client
+
+    db = create_client(Config.MONGO_URI)['payments']
+    print(await migrate_amounts(db))
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
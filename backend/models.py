@@ -1,18 +1,107 @@
 from enum import Enum
 import re
-from datetime import datetime
-from typing import Dict, List, Optional
+from datetime import date, datetime
+from decimal import Decimal
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
 
 from bson import ObjectId
 from pydantic import BaseModel, Field, validator
-from dateutil.parser import parse
 
 class BatchStatus(Enum):
     UPLOADED = 'Uploaded' # Batch has been uploaded, entries are being processed.
     CREATED = 'Created' # Batch has been created, ready for payment invocation.
+    PROCESSING = 'Processing' # Payments are being invoked, an interrupted batch can be resumed.
     COMPLETED = 'Completed' # Batch has been completed, all payments have been processed
     FAILED = 'Failed' # Batch has failed to process.
 
+# Statuses a batch can move to from each status.
+BATCH_TRANSITIONS = {
+    BatchStatus.UPLOADED: (BatchStatus.CREATED, BatchStatus.FAILED),
+    # Back to Uploaded while rejected rows are retried.
+    BatchStatus.CREATED: (BatchStatus.UPLOADED, BatchStatus.PROCESSING),
+    BatchStatus.PROCESSING: (BatchStatus.COMPLETED, BatchStatus.FAILED),
+    # A failed payout can be invoked again, rows that were already paid are skipped.
+    BatchStatus.FAILED: (BatchStatus.PROCESSING,),
+    BatchStatus.COMPLETED: (),
+}
+
+# Date formats tried before falling back to dateutil, in order.
+DATE_FORMATS = ('%m/%d/%Y', '%Y/%m/%d', '%d %b %Y', '%b %d %Y')
+# A number with optional grouping and decimal separators, between an optional currency symbol or code.
+CURRENCY_PATTERN = re.compile(r"([^\d.,'\-]*?)\s*(\d[\d.,'\s\u00a0\u202f]*)\s*([^\d.,'\-]*)")
+GROUPING_PATTERN = re.compile(r"[\s'\u00a0\u202f]")
+# Whole part of an amount, plain or grouped by thousands with one separator after a leading group of 1 to 3 digits.
+WHOLE_PATTERN = re.compile(r'\d+|[1-9]\d{0,2}([.,])\d{3}(\1\d{3})*')
+# Thousands separator of the currencies that mark one, "$1,500" and "1.500 €" are whole amounts. Without one of
+# these a single separator followed by three digits is a decimal point, and rejected as fractions of a cent.
+CURRENCY_GROUPING = {'$': ',', 'US$': ',', 'USD': ',', '£': ',', 'GBP': ',', '€': '.', 'EUR': '.'}
+
+@lru_cache(maxsize=65536)
+def parse_date(value: str) -> str:
+    """
+    Normalize a date to "yyyy-mm-dd".
+    Dates repeat heavily across rows (the same employee appears every month) so results are cached,
+    and the common fixed formats are tried before dateutil.
+    """
+    try:
+        return date.fromisoformat(value).strftime('%Y-%m-%d')
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    # Use dateutil.parser.parse to automatically parse various date formats, imported here as few dates need it.
+    from dateutil.parser import parse
+    return parse(value).strftime('%Y-%m-%d')
+
+def parse_amount(value) -> int:
+    """
+    Amount in integer cents.
+    Strings may carry a currency symbol or code and use either convention for the separators ("$1,234.56",
+    "1.234,56 €", "1 234,5"). The number is whole when it is only thousands groups, with the separator repeated
+    ("1,234,567") or a single one the currency groups with ("$1,500"), otherwise the last separator is the decimal
+    point. More than two decimals are rejected, never rounded or read as groups. Floats are amounts in dollars,
+    as stored before amounts were in cents.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, float):
+        # 15 significant digits, the precision of a double, drops the error of float sums such as 0.1 + 0.2.
+        cents = Decimal(f'{value:.15g}') * 100
+    else:
+        match = CURRENCY_PATTERN.fullmatch(str(value).strip())
+        if not match:
+            raise ValueError('Invalid amount')
+        number = GROUPING_PATTERN.sub('', match.group(2))
+        currency = (match.group(1) + match.group(3)).strip().upper()
+        separators = [char for char in number if char in '.,']
+        grouped = separators and WHOLE_PATTERN.fullmatch(number) and (len(separators) > 1 or CURRENCY_GROUPING.get(currency) == separators[0])
+        if not separators or grouped:
+            whole, fraction = number, ''
+        else:
+            separator = number.rfind(separators[-1])
+            whole, fraction = number[:separator], number[separator + 1:]
+            if separators.count(separators[-1]) > 1:
+                raise ValueError('Invalid amount')
+            if len(fraction) > 2:
+                raise ValueError('Amount has more than two decimals')
+        if not WHOLE_PATTERN.fullmatch(whole) or not (fraction.isdigit() or fraction == ''):
+            raise ValueError('Invalid amount')
+        cents = Decimal(whole.replace('.', '').replace(',', '')) * 100 + Decimal(fraction.ljust(2, '0') or 0)
+    if cents != cents.to_integral_value():
+        raise ValueError('Amount has fractions of a cent')
+    return int(cents)
+
+def format_cents(cents: int) -> str:
+    "Cents as a dollar amount with two decimals, e.g. 123456 -> \"1234.56\". A float is a total in dollars of rows stored before cents."
+    cents = parse_amount(cents)
+    sign = '-' if cents < 0 else ''
+    return f'{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}'
+
 class PyObjectId(ObjectId):
     @classmethod
     def __get_validators__(cls):
@@ -49,11 +138,7 @@ class Employee(BaseModel):
     
     @validator('DOB')
     def parse_dob(cls, value):
-        # Use dateutil.parser.parse to automatically parse various date formats
-        dob_date = parse(value)
-
-        # Convert the datetime object back to the desired format "yyyy-mm-dd"
-        return dob_date.strftime('%Y-%m-%d')
+        return parse_date(value)
 
 class Payor(BaseModel):
     DunkinId: str
@@ -77,18 +162,13 @@ class Transaction(BaseModel):
     Employee: Employee
     Payor: Payor
     Payee: Payee
-    Amount: float
+    # In cents.
+    Amount: int
     status: Optional[str] = "Pending"
 
     @validator('Amount', pre=True)
     def parse_currency(cls, v):
-        if isinstance(v, float):
-            return v
-        match = re.search(r'([^\d]*)([\d.,]+)', str(v))
-        if match:
-            return float(match.group(2).replace(',', '.'))
-        else:
-            raise ValueError('Invalid amount')
+        return parse_amount(v)
 
 class TransactionBatchResponse(BaseModel):
     batch_name: str
@@ -96,6 +176,8 @@ class TransactionBatchResponse(BaseModel):
     # Transaction: List[Transaction]
     total_transactions: int
     valid_transactions: int
+    # The same file was uploaded before, batch_id is the existing batch.
+    duplicate: bool = False
     class Config:
         arbitrary_types_allowed = True
         json_encoders = {
@@ -116,6 +198,8 @@ class TransactionSummary(BaseModel):
     source: Optional[str]
     destination: Optional[str]
     payment : Optional[Dict[str,str]] = None
+    # Ingest attempt that created the transaction, 0 for the upload and then one per retry.
+    attempt: int = 0
     class Config:
         arbitrary_types_allowed = True
         json_encoders = {
@@ -129,6 +213,24 @@ class Batch(BaseModel):
     total_transactions: int
     valid_transactions: int
     invalid_transactions: int
+    # Method accounts reused from / missing in the account cache while creating the batch.
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Distinct employees/payors in the upload and DunkinIds that appeared with different details.
+    distinct_employees: int = 0
+    distinct_payors: int = 0
+    conflict_count: int = 0
+    conflicts: List[Dict[str, Any]] = []
+    # Rows rejected while parsing, see ingest_errors, and how many times they were retried.
+    rejected_rows: int = 0
+    retries: int = 0
+    # Error of the last retry if it gave up, the batch went back to Created without its rows.
+    retry_error: Optional[str] = None
+    # sha256 of the uploaded file and the rows skipped because another batch already created them.
+    content_hash: Optional[str] = None
+    duplicate_rows: int = 0
+    # Seconds and count per stage (parse, validate, dedup, entity, account, mongo_write, payout) spent on the batch.
+    timings: Dict[str, Dict[str, float]] = {}
     date_created: datetime = Field(default_factory=datetime.utcnow)
     class Config:
         arbitrary_types_allowed = True
@@ -137,8 +239,309 @@ class Batch(BaseModel):
             BatchStatus: lambda x: x.value
         }
 
+class BatchSummary(BaseModel):
+    # Lightweight projection of Batch returned by the dashboard listing.
+    id : PyObjectId = Field(alias="_id")
+    batch_name: str
+    status: str
+    total_transactions: int
+    valid_transactions: int
+    invalid_transactions: int
+    date_created: datetime
+    class Config:
+        arbitrary_types_allowed = True
+        json_encoders = {
+            ObjectId: str
+        }
+
+class BatchPage(BaseModel):
+    items: List[BatchSummary]
+    # Pass as `after` to get the next page, None on the last page.
+    next_cursor: Optional[str]
+    class Config:
+        json_encoders = {
+            ObjectId: str
+        }
+
+class IngestError(BaseModel):
+    # A row rejected while parsing an upload, kept with its raw values so it can be retried.
+    id: PyObjectId = Field(alias="_id")
+    batch_id: str
+    row: int # index of the <row> in the uploaded file
+    field: Optional[str]
+    reason: str
+    record: Dict[str, Optional[str]]
+    attempt: int = 0
+    class Config:
+        arbitrary_types_allowed = True
+        json_encoders = {
+            ObjectId: str
+        }
+
+class IngestErrorPage(BaseModel):
+    items: List[IngestError]
+    # Pass as `after` to get the next page, None on the last page.
+    next_cursor: Optional[str]
+    class Config:
+        json_encoders = {
+            ObjectId: str
+        }
+
+class PayoutJob(BaseModel):
+    # One payout job per batch, keyed by the batch id.
+    id: str = Field(alias="_id")
+    status: str = 'running'
+    total: int
+    processed: int = 0
+    paid: int = 0
+    failed: int = 0
+    # Rows left out by the reconciliation before any Method call, counted as processed.
+    skipped: int = 0
+    # Every invocation gets a new run, shards of an earlier run do not complete it.
+    run_id: PyObjectId = Field(default_factory=PyObjectId)
+    date_created: datetime = Field(default_factory=datetime.utcnow)
+    date_updated: datetime = Field(default_factory=datetime.utcnow)
+    # Start of the current run and the progress it resumed from, used for throughput.
+    run_started: datetime = Field(default_factory=datetime.utcnow)
+    run_processed_start: int = 0
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {
+            ObjectId: str
+        }
+
+class JobStatus(Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running' # leased by a worker until lease_expires
+    DONE = 'done'
+    FAILED = 'failed' # gave up after max_attempts
+    CANCELLED = 'cancelled'
+
+class ExportFormat(str, Enum):
+    # Columnar exports of export.py.
+    PARQUET = 'parquet'
+    ARROW = 'arrow'
+
+class QueueJob(BaseModel):
+    # Work item of the job queue, run by worker.py.
+    id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
+    kind: str
+    batch_id: str
+    payload: Dict[str, Any] = {}
+    status: str = JobStatus.QUEUED.value
+    attempts: int = 0
+    max_attempts: int = 3
+    lease_owner: Optional[str] = None
+    lease_expires: Optional[datetime] = None
+    error: Optional[str] = None
+    date_created: datetime = Field(default_factory=datetime.utcnow)
+    date_updated: datetime = Field(default_factory=datetime.utcnow)
+    class Config:
+        allow_population_by_field_name = True
+        arbitrary_types_allowed = True
+        json_encoders = {
+            ObjectId: str
+        }
+
+class PayoutJobStatus(PayoutJob):
+    throughput: float # transactions per second in the current run
+    eta_seconds: Optional[float]
+
+class BatchProgress(BaseModel):
+    # Live counters of a batch, published while it is ingested and paid, see progress.py.
+    batch_id: str = Field(alias="_id")
+    status: Optional[str]
+    # Ingestion: rows read, transactions created valid and invalid, rows rejected and rows skipped as duplicates.
+    ingested: int = 0
+    valid: int = 0
+    invalid: int = 0
+    rejected: int = 0
+    duplicates: int = 0
+    # Payouts of the current job.
+    total: int = 0
+    processed: int = 0
+    paid: int = 0
+    failed: int = 0
+    skipped: int = 0
+    date_updated: datetime
+    class Config:
+        allow_population_by_field_name = True
+
+class GroupTotal(BaseModel):
+    key: Optional[str]
+    total: int # cents
+    count: int
+
+class BatchTotals(BaseModel):
+    # Exact totals of a batch read from its transactions, see summary.py.
+    batch_id: str
+    total: int # cents
+    count: int
+    sources: List[GroupTotal]
+    branches: List[GroupTotal]
+    statuses: List[GroupTotal]
+
+class ReconciliationIssue(BaseModel):
+    transaction_id: str
+    reason: str # missing_account, duplicate
+    employee: Optional[str]
+    payor: Optional[str]
+    amount: int # cents
+
+class PayorLimit(GroupTotal):
+    limit: int # cents
+
+class Reconciliation(BaseModel):
+    # Pre-flight check of the rows of a batch that have not been paid yet, see reconcile.py.
+    batch_id: str
+    transactions: int
+    total: int # cents
+    # Rows that would be sent to Method, the rows with a missing account are skipped.
+    payable: int
+    payable_total: int # cents
+    missing_accounts: int
+    duplicates: int
+    payors_over_limit: List[PayorLimit]
+    # The first MAX_ISSUES flagged rows.
+    issues: List[ReconciliationIssue]
+    # Nothing for the operator to decide, payouts are invoked without force.
+    ok: bool
+
 def get_unique_employees(transactions:List[Transaction]):
     return list({tnx.Employee.DunkinId: tnx for tnx in transactions}.values())
 
 def get_unique_payors(transactions:List[Transaction]):
-    return list({tnx.Payor.DunkinId: tnx for tnx in transactions}.values())
\ No newline at end of file
+    return list({tnx.Payor.DunkinId: tnx for tnx in transactions}.values())
+
+# Flat record keys of a transaction, the bulk path validates each one as a column.
+RECORD_FIELDS = {
+    'Employee': ('DunkinId', 'DunkinBranch', 'FirstName', 'LastName', 'DOB', 'PhoneNumber'),
+    'Payor': ('DunkinId', 'ABARouting', 'AccountNumber', 'Name', 'DBA', 'EIN'),
+    'Address': ('Line1', 'City', 'State', 'Zip'),
+    'Payee': ('PlaidId', 'LoanAccountNumber'),
+}
+
+def _parse_column(values: List[Optional[str]], parser) -> List:
+    result = []
+    for value in values:
+        try:
+            result.append(parser(value))
+        except Exception:
+            result.append(None)
+    return result
+
+def _getter(prefix: str, names) -> Callable[[dict], tuple]:
+    return itemgetter(*[f'{prefix}.{name}' for name in names])
+
+_EMPLOYEE_FIELDS = _getter('Employee', RECORD_FIELDS['Employee'])
+_PAYOR_FIELDS = _getter('Payor', RECORD_FIELDS['Payor'])
+_ADDRESS_FIELDS = _getter('Payor.Address', RECORD_FIELDS['Address'])
+_PAYEE_FIELDS = _getter('Payee', RECORD_FIELDS['Payee'])
+
+# Every key a record needs, in row order.
+RECORD_KEYS = (tuple(f'Employee.{name}' for name in RECORD_FIELDS['Employee'])
+               + tuple(f'Payor.{name}' for name in RECORD_FIELDS['Payor'])
+               + tuple(f'Payor.Address.{name}' for name in RECORD_FIELDS['Address'])
+               + tuple(f'Payee.{name}' for name in RECORD_FIELDS['Payee'])
+               + ('Amount',))
+
+def record_error(record: Dict[str, Optional[str]]) -> Tuple[Optional[str], str]:
+    "Field and reason a record was rejected for by transactions_from_records, only used for the rejected rows."
+    for key in RECORD_KEYS:
+        if record.get(key) is None:
+            return key, 'missing'
+    for key, parser in (('Employee.DOB', parse_date), ('Amount', parse_amount)):
+        try:
+            parser(record[key])
+        except Exception as e:
+            return key, f'invalid value {record[key]!r}: {e}'
+    return None, 'invalid row'
+
+EMPLOYEE_NAMES = RECORD_FIELDS['Employee']
+PAYOR_NAMES = RECORD_FIELDS['Payor'] + tuple(f'Address.{name}' for name in RECORD_FIELDS['Address'])
+
+M = TypeVar('M', bound=BaseModel)
+
+class Interner:
+    """
+    Shared Employee/Payor instances for one upload, keyed by DunkinId.
+    Every row repeats the same employee and payor blocks, so each distinct one is built once and referenced by
+    all of its transactions. A DunkinId seen again with different details is recorded as a conflict and that
+    row keeps its own instance.
+    """
+    MAX_CONFLICTS = 100
+
+    def __init__(self):
+        self.employees: Dict[str, Tuple[tuple, Employee]] = {}
+        self.payors: Dict[str, Tuple[tuple, Payor]] = {}
+        self.conflict_count = 0
+        self.conflicts: List[Dict[str, Any]] = []
+
+    def _intern(self, table: Dict[str, Tuple[tuple, M]], model: str, names: Tuple[str, ...], values: tuple, build: Callable[[], M]) -> M:
+        # DunkinId is the first field of both models.
+        dunkin_id = values[0]
+        entry = table.get(dunkin_id)
+        if entry is None:
+            instance = build()
+            table[dunkin_id] = (values, instance)
+            return instance
+        if entry[0] == values:
+            return entry[1]
+        self.conflict_count += 1
+        if len(self.conflicts) < Interner.MAX_CONFLICTS:
+            self.conflicts.append({'model': model,
+                                   'DunkinId': dunkin_id,
+                                   'fields': [name for name, old, new in zip(names, entry[0], values) if old != new]})
+        return build()
+
+    def employee(self, values: tuple, build: Callable[[], Employee]) -> Employee:
+        return self._intern(self.employees, 'Employee', EMPLOYEE_NAMES, values, build)
+
+    def payor(self, values: tuple, build: Callable[[], Payor]) -> Payor:
+        return self._intern(self.payors, 'Payor', PAYOR_NAMES, values, build)
+
+    def intern_transaction(self, tnx: Transaction) -> Transaction:
+        "Point an already validated transaction at the shared instances."
+        employee, payor = tnx.Employee, tnx.Payor
+        tnx.Employee = self.employee(tuple(getattr(employee, name) for name in EMPLOYEE_NAMES), lambda: employee)
+        tnx.Payor = self.payor(tuple(getattr(payor, name) for name in RECORD_FIELDS['Payor']) + tuple(getattr(payor.Address, name) for name in RECORD_FIELDS['Address']),
+                               lambda: payor)
+        return tnx
+
+    def summary(self) -> Dict[str, Any]:
+        return {'distinct_employees': len(self.employees),
+                'distinct_payors': len(self.payors),
+                'conflict_count': self.conflict_count,
+                'conflicts': self.conflicts}
+
+def transactions_from_records(records: List[Dict[str, Optional[str]]], interner: Optional[Interner] = None) -> List[Optional[Transaction]]:
+    """
+    Bulk validation of flat records ("Employee.DOB", "Payor.Address.City", "Amount", ...).
+    DOB and Amount are parsed a column at a time, every other field only has to be present.
+    Models are then built without running pydantic validation again, invalid rows come back as None.
+    With an interner, employees and payors are shared across rows instead of rebuilt for every row.
+    """
+    interner = interner or Interner()
+    dobs = _parse_column([record.get('Employee.DOB') for record in records], parse_date)
+    amounts = _parse_column([record.get('Amount') for record in records], parse_amount)
+    result = []
+    for record, dob, amount in zip(records, dobs, amounts):
+        try:
+            employee, payor, address, payee = _EMPLOYEE_FIELDS(record), _PAYOR_FIELDS(record), _ADDRESS_FIELDS(record), _PAYEE_FIELDS(record)
+        except KeyError:
+            result.append(None)
+            continue
+        if dob is None or amount is None or None in employee or None in payor or None in address or None in payee:
+            result.append(None)
+            continue
+        # DOB is the fifth Employee field, compare and build with the normalized date.
+        employee = employee[:4] + (dob,) + employee[5:]
+        result.append(Transaction.construct(
+            Employee=interner.employee(employee, lambda: Employee.construct(**dict(zip(EMPLOYEE_NAMES, employee)))),
+            Payor=interner.payor(payor + address, lambda: Payor.construct(**dict(zip(RECORD_FIELDS['Payor'], payor)),
+                                                                          Address=Address.construct(**dict(zip(RECORD_FIELDS['Address'], address))))),
+            Payee=Payee.construct(**dict(zip(RECORD_FIELDS['Payee'], payee))),
+            Amount=amount,
+        ))
+    return result
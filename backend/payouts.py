@@ -0,0 +1,171 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from fastapi.logger import logger
+from method.errors import MethodError, MethodInvalidRequestError
+from method_manager import MethodWrapper, TransactionService
+from metrics import Timings, timed
+from models import BatchStatus, PayoutJob, PayoutJobStatus, PyObjectId, parse_amount
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from repository import BatchRepository, ProgressRepository, TransactionRepository
+from rollups import BatchRollups
+
+PAYOUT_PROJECTION = {'transaction.Amount': 1, 'status': 1, 'source': 1, 'destination': 1}
+
+
+@dataclass
+class PayoutRunner:
+    """
+    Invoke the payouts of a batch. Every invocation is split into shards, ranges of transaction ids queued as
+    separate jobs, so a batch spreads across the workers. A shard writes its results chunk by chunk and one that
+    dies part way is simply run again: rows that already have a result are skipped and payments are created with
+    the transaction id as idempotency key, so a chunk that was sent but not written is not paid twice.
+    Only a payment Method refused is written as failed. One that errored, timed out or was rejected by the rate
+    limiter is left unpaid and fails the shard once its other rows are written, so the queue runs it again.
+    """
+    method_client: MethodWrapper
+    batches: BatchRepository
+    transactions: TransactionRepository
+    jobs: AsyncIOMotorCollection
+    rollups: BatchRollups
+    chunk_size: int = 500
+    shard_size: int = 5000
+    progress: Optional[ProgressRepository] = None
+
+    async def get_job(self, batch_id: str) -> Optional[dict]:
+        return await self.jobs.find_one({'_id': batch_id})
+
+    async def start(self, batch_id: str, skip: List[dict] = ()) -> Tuple[PayoutJob, List[dict]]:
+        """
+        Start a new run of the batch's payout job, returns the job and the payload of each shard to queue.
+        The rows in skip, found by the reconciliation, are left out of the shards.
+        """
+        skipped = await self.skip(batch_id, skip)
+        shards = await self.shards(batch_id)
+        job = await self.get_job(batch_id)
+        now = datetime.utcnow()
+        if job:
+            job = PayoutJob(**job)
+            job.status = 'running'
+            job.run_id = PyObjectId()
+            job.run_started = job.date_updated = now
+            job.processed += skipped
+            job.skipped += skipped
+            job.run_processed_start = job.processed
+        else:
+            job = PayoutJob(_id=batch_id, total=await self.transactions.count(batch_id), processed=skipped, skipped=skipped, run_processed_start=skipped)
+        await self.jobs.replace_one({'_id': batch_id}, job.dict(by_alias=True), upsert=True)
+        if self.progress:
+            await self.progress.set(batch_id, total=job.total, processed=job.processed, paid=job.paid, failed=job.failed, skipped=job.skipped)
+        return job, [{'run_id': job.run_id, 'first': first, 'last': last} for first, last in shards]
+
+    async def skip(self, batch_id: str, rows: List[dict]) -> int:
+        "Mark unpaid rows as skipped without calling Method, like a payout result. Returns the number of rows skipped by this call."
+        result = {'status': 'skipped'}
+        now = datetime.utcnow()
+        skipped = 0
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = rows[start:start + self.chunk_size]
+            chunk, _ = await self.write_results(batch_id, chunk, [result] * len(chunk), now)
+            await self.rollups.apply_payouts(batch_id, ((tnx, result) for tnx in chunk))
+            skipped += len(chunk)
+        if self.progress and skipped:
+            await self.progress.inc(batch_id, processed=skipped, skipped=skipped)
+        return skipped
+
+    async def shards(self, batch_id: str) -> List[Tuple[ObjectId, ObjectId]]:
+        "First and last id of every shard_size transactions of the batch that have not been paid yet."
+        cursor = self.transactions.find({'batch_id': batch_id, 'payout_date': {'$exists': False}}, {'_id': 1}, self.shard_size).sort('_id', 1)
+        shards = []
+        while ids := await cursor.to_list(self.shard_size):
+            shards.append((ids[0]['_id'], ids[-1]['_id']))
+        return shards
+
+    async def run_shard(self, batch_id: str, first: ObjectId, last: ObjectId):
+        query = {'batch_id': batch_id, 'payout_date': {'$exists': False}, '_id': {'$gte': first, '$lte': last}}
+        cursor = self.transactions.find(query, PAYOUT_PROJECTION, self.chunk_size).sort('_id', 1)
+        timings = Timings()
+        unpaid = 0
+        try:
+            while chunk := await cursor.to_list(self.chunk_size):
+                unpaid += await self.run_chunk(batch_id, chunk, timings)
+        finally:
+            await self.batches.add_timings(batch_id, timings.as_dict())
+        if unpaid:
+            raise RuntimeError(f"{unpaid} payouts of batch {batch_id} could not be sent and are left unpaid")
+
+    async def finish(self, batch_id: str, run_id: ObjectId):
+        "Complete the batch once every shard of its current run is done."
+        job = await self.get_job(batch_id)
+        if job and job['run_id'] == run_id:
+            await self.complete(batch_id)
+
+    async def complete(self, batch_id: str):
+        await self.batches.transition(batch_id, BatchStatus.COMPLETED)
+        await self.jobs.update_one({'_id': batch_id}, {'$set': {'status': 'completed', 'date_updated': datetime.utcnow()}})
+
+    async def fail(self, batch_id: str):
+        logger.error(f"Payout job for batch {batch_id} failed")
+        await self.batches.transition(batch_id, BatchStatus.FAILED)
+        await self.jobs.update_one({'_id': batch_id}, {'$set': {'status': 'failed', 'date_updated': datetime.utcnow()}})
+
+    async def run_chunk(self, batch_id: str, chunk: List[dict], timings: Optional[Timings] = None) -> int:
+        "Pay and write a chunk, returns the number of rows left unpaid to be retried."
+        with timed('payout', timings):
+            results = await self.method_client.executor.map(self.pay_transaction, chunk)
+        sent = [(tnx_summary, result) for tnx_summary, result in zip(chunk, results) if result is not None]
+        unpaid = len(chunk) - len(sent)
+        now = datetime.utcnow()
+        with timed('mongo_write', timings):
+            chunk, results = await self.write_results(batch_id, [tnx_summary for tnx_summary, _ in sent], [result for _, result in sent], now)
+            paid = len([result for result in results if result['status'] == 'success'])
+            await self.rollups.apply_payouts(batch_id, zip(chunk, results))
+            await self.jobs.update_one({'_id': batch_id}, {'$set': {'date_updated': now},
+                                                           '$inc': {'processed': len(chunk), 'paid': paid, 'failed': len(chunk) - paid}})
+            if self.progress:
+                await self.progress.inc(batch_id, processed=len(chunk), paid=paid, failed=len(chunk) - paid)
+        return unpaid
+
+    async def write_results(self, batch_id: str, chunk: List[dict], results: List[dict], now: datetime) -> Tuple[List[dict], List[dict]]:
+        """
+        Write the payout results of rows that have none yet. Returns the rows and results this call wrote, the others
+        were written first by another run and are already counted.
+        """
+        # The chunk id tells which rows this call wrote.
+        chunk_id = ObjectId()
+        updates = [UpdateOne({'_id': tnx_summary['_id'], 'payout_date': {'$exists': False}},
+                             {'$set': {**result, 'payout_date': now, 'payout_chunk': chunk_id}}) for tnx_summary, result in zip(chunk, results)]
+        written = await self.transactions.bulk_write(updates)
+        if written == len(chunk):
+            return chunk, results
+        logger.warning(f"Batch {batch_id}: {len(chunk) - written} of {len(chunk)} transactions were already paid out by another run")
+        ids = {tnx['_id'] async for tnx in self.transactions.find({'_id': {'$in': [tnx_summary['_id'] for tnx_summary in chunk]}, 'payout_chunk': chunk_id}, {'_id': 1})}
+        written_rows = [(tnx_summary, result) for tnx_summary, result in zip(chunk, results) if tnx_summary['_id'] in ids]
+        return [tnx_summary for tnx_summary, _ in written_rows], [result for _, result in written_rows]
+
+    def pay_transaction(self, tnx_summary: dict) -> Optional[Dict]:
+        "The payout result of a row, None when the payment could not be sent and has to be retried."
+        try:
+            payment = TransactionService.invoke_payment(parse_amount(tnx_summary['transaction']['Amount']),tnx_summary['source'],tnx_summary['destination'],self.method_client,
+                                                        idempotency_key=str(tnx_summary['_id']))
+            return {"status": 'success','payment':payment}
+        except MethodInvalidRequestError:
+            return {"status": 'failed'}
+        except (Exception, MethodError) as e:
+            logger.warning(f"Payout of transaction {tnx_summary['_id']} left unpaid: {e!r}")
+            return None
+
+    async def status(self, batch_id: str) -> Optional[PayoutJobStatus]:
+        job = await self.get_job(batch_id)
+        if not job:
+            return None
+        job = PayoutJob(**job)
+        end = job.date_updated if job.status != 'running' else datetime.utcnow()
+        elapsed = (end - job.run_started).total_seconds()
+        throughput = (job.processed - job.run_processed_start) / elapsed if elapsed > 0 else 0.0
+        remaining = job.total - job.processed
+        eta = remaining / throughput if throughput else (0.0 if not remaining else None)
+        return PayoutJobStatus(**job.dict(by_alias=True), throughput=throughput, eta_seconds=eta)
@@ -0,0 +1,102 @@
+import asyncio
+import json
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Dict, Optional, Set
+
+from fastapi import Request
+from fastapi.logger import logger
+from models import BatchProgress
+from pymongo.errors import PyMongoError
+from repository import ProgressRepository
+
+# Updates kept per subscriber, a slow client only misses intermediate ones.
+QUEUE_SIZE = 100
+
+
+class ProgressHub:
+    """
+    In-process pub/sub of batch progress for the API. A single watcher per process follows the batch_progress
+    collection, with a change stream when Mongo supports one (replica sets) and by polling date_updated otherwise,
+    and hands every update to the subscribed clients, so an open dashboard costs a queue rather than queries.
+    """
+    def __init__(self, progress: ProgressRepository, poll_interval: float = 1.0):
+        self.progress = progress
+        self.poll_interval = poll_interval
+        # Subscribers per batch id, None subscribes to every batch.
+        self._subscribers: Dict[Optional[str], Set[asyncio.Queue]] = defaultdict(set)
+        self._task: Optional[asyncio.Task] = None
+
+    def publish(self, document: dict):
+        for queue in self._subscribers.get(document['_id'], set()) | self._subscribers.get(None, set()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(document)
+
+    @asynccontextmanager
+    async def subscribe(self, batch_id: Optional[str] = None) -> AsyncIterator[asyncio.Queue]:
+        queue = asyncio.Queue(QUEUE_SIZE)
+        self._subscribers[batch_id].add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._watch())
+        try:
+            yield queue
+        finally:
+            self._subscribers[batch_id].discard(queue)
+            if not self._subscribers[batch_id]:
+                del self._subscribers[batch_id]
+            if not self._subscribers and self._task:
+                self._task.cancel()
+                self._task = None
+
+    async def _watch(self):
+        try:
+            async with self.progress.collection.watch(full_document='updateLookup') as stream:
+                async for change in stream:
+                    if change.get('fullDocument'):
+                        self.publish(change['fullDocument'])
+        except PyMongoError as e:
+            logger.info(f"Change streams unavailable, polling batch progress every {self.poll_interval}s: {e}")
+        await self._poll()
+
+    async def _poll(self):
+        now = datetime.utcnow()
+        # Mongo keeps milliseconds.
+        since = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        # date_updated of the last update published per batch, updates in the same millisecond are read twice.
+        seen: Dict[str, datetime] = {}
+        while True:
+            async for document in self.progress.changed_since(since):
+                if seen.get(document['_id']) != document['date_updated']:
+                    seen[document['_id']] = document['date_updated']
+                    self.publish(document)
+                since = max(since, document['date_updated'])
+            seen = {batch_id: updated for batch_id, updated in seen.items() if updated >= since}
+            await asyncio.sleep(self.poll_interval)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+
+def event(document: dict) -> str:
+    return f"data: {json.dumps(BatchProgress(**document).dict(), default=str)}\n\n"
+
+
+async def stream_progress(hub: ProgressHub, request: Request, batch_id: Optional[str] = None,
+                          keepalive: float = 15) -> AsyncIterator[str]:
+    "Server-sent events of the progress of one batch, or of every batch, until the client disconnects."
+    async with hub.subscribe(batch_id) as queue:
+        if batch_id:
+            current = await hub.progress.get(batch_id)
+            if current:
+                yield event(current)
+        while not await request.is_disconnected():
+            try:
+                document = await asyncio.wait_for(queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield event(document)
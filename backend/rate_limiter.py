@@ -0,0 +1,221 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from fastapi.logger import logger
+from metrics import METRICS
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+# Key of the budget shared by every operation.
+GLOBAL = '*'
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+def _refill(tokens: float, elapsed: float, capacity: int, rate: float) -> float:
+    return min(capacity, tokens + max(0.0, elapsed) * rate)
+
+
+def _burst(calls: int, burst: Optional[int]) -> int:
+    if burst is None:
+        burst = calls // 60
+    return max(1, min(burst, calls))
+
+
+def _rate(calls: int, burst: int, period: float) -> float:
+    # A budget spent in one burst still refills, one call per period when it is a single call.
+    return max(calls - burst, 1) / period
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket shared by every caller of the Method api in this process.
+    The refill rate is derived so that no window of `period` seconds ever sees more than `calls` requests,
+    `burst` tokens are available up front and the rest trickle in evenly.
+    """
+    def __init__(self, calls: int, period: float, burst: Optional[int] = None):
+        burst = _burst(calls, burst)
+        self.calls = calls
+        self.period = period
+        self.capacity = burst
+        self.rate = _rate(calls, burst, period)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: Optional[float] = None) -> Optional[float]:
+        """
+        Take a token and return how long the caller has to wait before using it.
+        None, and no token taken, when the wait would be longer than max_wait.
+        """
+        with self._lock:
+            now = time.monotonic()
+            tokens = _refill(self._tokens, now - self._updated, self.capacity, self.rate) - 1
+            wait = 0.0 if tokens >= 0 else -tokens / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            self._tokens, self._updated = tokens, now
+            return wait
+
+    def refund(self):
+        "Give back a token taken by reserve, for a call that was not made."
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + 1)
+
+    def acquire(self) -> float:
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self) -> float:
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class MongoTokenBucket:
+    """
+    Same token bucket kept in a Mongo document, so every process that uses the same key shares the budget.
+    A reservation reads the document and writes it back only if nobody updated it in between (a version check),
+    retrying on conflict. Time is the callers' wall clock, a little skew between hosts only delays the refill.
+    """
+    def __init__(self, collection: Collection, key: str, calls: int, period: float, burst: Optional[int] = None):
+        burst = _burst(calls, burst)
+        self.collection = collection
+        self.key = key
+        self.calls = calls
+        self.period = period
+        self.capacity = burst
+        self.rate = _rate(calls, burst, period)
+
+    def reserve(self, max_wait: Optional[float] = None) -> Optional[float]:
+        while True:
+            now = time.time()
+            state = self.collection.find_one({'_id': self.key})
+            if state is None:
+                try:
+                    self.collection.insert_one({'_id': self.key, 'tokens': self.capacity - 1.0, 'updated': now, 'version': 0})
+                    return 0.0
+                except DuplicateKeyError:
+                    continue
+            tokens = _refill(state['tokens'], now - state['updated'], self.capacity, self.rate) - 1
+            wait = 0.0 if tokens >= 0 else -tokens / self.rate
+            if max_wait is not None and wait > max_wait:
+                return None
+            result = self.collection.update_one({'_id': self.key, 'version': state['version']},
+                                                {'$set': {'tokens': tokens, 'updated': max(now, state['updated'])},
+                                                 '$inc': {'version': 1}})
+            if result.modified_count:
+                return wait
+            METRICS.inc('rate_limit_conflicts_total', key=self.key)
+
+    def refund(self):
+        "Give back a token taken by reserve, the next reservation caps the tokens at the capacity."
+        self.collection.update_one({'_id': self.key}, {'$inc': {'tokens': 1, 'version': 1}})
+
+
+class RateLimiter:
+    """
+    Method rate limit: a global budget plus optional per operation budgets, a call takes a token from both.
+    With a collection the buckets live in Mongo and are shared by every process. While Mongo cannot be reached
+    calls fall back to in-process buckets holding 1/fallback_share of each budget, so that the processes
+    together still stay under the limit, and Mongo is tried again after retry_after seconds.
+    Calls that would have to wait longer than max_wait are rejected with RateLimitExceeded.
+    """
+    def __init__(self, calls: int, period: float, budgets: Optional[Dict[str, int]] = None, collection: Optional[Collection] = None,
+                 max_wait: Optional[float] = None, fallback_share: int = 1, retry_after: float = 30):
+        self.period = period
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self._local: Dict[str, TokenBucket] = {}
+        self._shared: Dict[str, MongoTokenBucket] = {}
+        for key, budget in {GLOBAL: calls, **(budgets or {})}.items():
+            share = max(1, budget // fallback_share) if collection is not None else budget
+            self._local[key] = TokenBucket(share, period)
+            if collection is not None:
+                self._shared[key] = MongoTokenBucket(collection, f'method:{key}', budget, period)
+        self._shared_down_until = 0.0
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, Dict[str, float]] = defaultdict(lambda: {'calls': 0, 'waited': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0,
+                                                                           'rejected': 0, 'fallback': 0})
+
+    @property
+    def capacity(self) -> int:
+        return (self._shared.get(GLOBAL) or self._local[GLOBAL]).capacity
+
+    @property
+    def rate(self) -> float:
+        return (self._shared.get(GLOBAL) or self._local[GLOBAL]).rate
+
+    def _reserve(self, key: str) -> Tuple[Optional[float], bool]:
+        "Reservation on one budget and whether it came from the local fallback."
+        if key in self._shared and time.monotonic() >= self._shared_down_until:
+            try:
+                return self._shared[key].reserve(self.max_wait), False
+            except PyMongoError as e:
+                logger.warning(f"Shared rate limit unavailable, using the local one for {self.retry_after}s: {e}")
+                self._shared_down_until = time.monotonic() + self.retry_after
+        return self._local[key].reserve(self.max_wait), key in self._shared
+
+    def _refund(self, key: str, local: bool):
+        if local or key not in self._shared:
+            self._local[key].refund()
+            return
+        try:
+            self._shared[key].refund()
+        except PyMongoError as e:
+            logger.warning(f"Could not give back a {key} token to the shared rate limit: {e}")
+
+    def reserve(self, operation: str) -> float:
+        "Take a token for operation from its budget and the global one, returns how long to wait before calling."
+        # The narrower budget first, so a rejection there does not use up a global token.
+        keys = [key for key in dict.fromkeys((operation, GLOBAL)) if key in self._local]
+        reserved = []
+        waits = []
+        fallback = False
+        for key in keys:
+            wait, local = self._reserve(key)
+            fallback = fallback or local
+            if wait is None:
+                # The tokens taken from the other budgets go back, the call is not made.
+                for taken in reserved:
+                    self._refund(*taken)
+                with self._lock:
+                    self._metrics[operation]['rejected'] += 1
+                raise RateLimitExceeded(f'{operation} would wait more than {self.max_wait}s for the {key} budget')
+            reserved.append((key, local))
+            waits.append(wait)
+        wait = max(waits)
+        with self._lock:
+            metrics = self._metrics[operation]
+            metrics['calls'] += 1
+            metrics['fallback'] += fallback
+            if wait:
+                metrics['waited'] += 1
+                metrics['wait_seconds'] += wait
+                metrics['max_wait_seconds'] = max(metrics['max_wait_seconds'], wait)
+        return wait
+
+    def acquire(self, operation: str = GLOBAL) -> float:
+        wait = self.reserve(operation)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, operation: str = GLOBAL) -> float:
+        wait = self.reserve(operation)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        "Per operation: calls, calls that had to wait, total and longest wait, rejections and calls served by the fallback."
+        with self._lock:
+            return {operation: dict(metrics) for operation, metrics in self._metrics.items()}
@@ -0,0 +1,71 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from models import PayorLimit, Reconciliation, ReconciliationIssue, parse_amount
+from repository import TransactionRepository
+from summary import Codes
+
+RECONCILE_PROJECTION = {'transaction.Amount': 1, 'transaction.Employee.DunkinId': 1, 'transaction.Payor.DunkinId': 1,
+                        'status': 1, 'source': 1, 'destination': 1}
+
+# Account ids of the rows whose Method entity or account could not be created.
+MISSING_ACCOUNTS = (None, 'N/A')
+
+
+@dataclass
+class Reconciler:
+    """
+    Pre-flight check of a batch before its payouts are invoked, in one pass over the unpaid rows in _id order.
+    Rows without a source or destination account would only fail after spending a Method call, they are skipped.
+    Duplicate employee + amount rows and payors whose total is above their limit are reported for the operator
+    to decide on before invoking with force.
+    """
+    transactions: TransactionRepository
+    payor_limit: Optional[int] = None
+    payor_limits: Dict[str, int] = field(default_factory=dict)
+    batch_size: int = 1000
+    MAX_ISSUES = 100
+
+    def limit(self, payor: Optional[str]) -> Optional[int]:
+        return self.payor_limits.get(payor, self.payor_limit)
+
+    async def check(self, batch_id: str) -> Tuple[Reconciliation, List[dict]]:
+        "The reconciliation of a batch and the rows to skip."
+        payors = Codes()
+        codes, amounts = [], []
+        seen = set()
+        issues: List[ReconciliationIssue] = []
+        skipped: List[dict] = []
+        duplicates = 0
+        query = {'batch_id': batch_id, 'payout_date': {'$exists': False}}
+        async for tnx in self.transactions.find(query, RECONCILE_PROJECTION, self.batch_size).sort('_id', 1):
+            amount = parse_amount(tnx['transaction']['Amount'])
+            employee = tnx['transaction']['Employee']['DunkinId']
+            payor = tnx['transaction']['Payor']['DunkinId']
+            if tnx.get('source') in MISSING_ACCOUNTS or tnx.get('destination') in MISSING_ACCOUNTS:
+                reason = 'missing_account'
+                skipped.append(tnx)
+            elif (employee, amount) in seen:
+                reason = 'duplicate'
+                duplicates += 1
+            else:
+                reason = None
+                seen.add((employee, amount))
+            if reason:
+                if len(issues) < self.MAX_ISSUES:
+                    issues.append(ReconciliationIssue(transaction_id=str(tnx['_id']), reason=reason, employee=employee, payor=payor, amount=amount))
+                if reason == 'missing_account':
+                    continue
+            amounts.append(amount)
+            codes.append(payors(payor))
+        totals = payors.totals(np.array(codes, dtype=np.intp), np.array(amounts, dtype=np.int64))
+        over_limit = [PayorLimit(**total.dict(), limit=self.limit(total.key)) for total in totals
+                      if self.limit(total.key) is not None and total.total > self.limit(total.key)]
+        skipped_total = sum(parse_amount(tnx['transaction']['Amount']) for tnx in skipped)
+        payable_total = sum(total.total for total in totals)
+        reconciliation = Reconciliation(batch_id=batch_id, transactions=len(amounts) + len(skipped), total=payable_total + skipped_total,
+                                        payable=len(amounts), payable_total=payable_total, missing_accounts=len(skipped),
+                                        duplicates=duplicates, payors_over_limit=over_limit, issues=issues,
+                                        ok=not duplicates and not over_limit)
+        return reconciliation, skipped
@@ -0,0 +1,72 @@
+import csv
+import io
+import zlib
+from typing import AsyncIterable, AsyncIterator, List
+
+from fastapi.responses import StreamingResponse
+from metrics import timed
+
+# Fixed report schemas, columns no longer depend on whatever the first document happens to contain.
+SOURCE_ACCOUNT_COLUMNS = ["Source Account", "Total Amount"]
+BRANCH_COLUMNS = ["Dunkin branch Id", "Total Amount"]
+PAYMENT_COLUMNS = [
+    "id",
+    "reversal_id",
+    "source_trace_id",
+    "destination_trace_id",
+    "source",
+    "destination",
+    "amount",
+    "description",
+    "status",
+    "fund_status",
+    "error",
+    "metadata",
+    "estimated_completion_date",
+    "source_settlement_date",
+    "destination_settlement_date",
+    "fee",
+    "type",
+    "created_at",
+    "updated_at",
+]
+
+# Rows written to the csv buffer before it is flushed to the client.
+ROWS_PER_CHUNK = 500
+
+
+async def iter_csv(rows: AsyncIterable[dict], fieldnames: List[str], rows_per_chunk: int = ROWS_PER_CHUNK) -> AsyncIterator[str]:
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=fieldnames, restval='', extrasaction='ignore')
+    writer.writeheader()
+    count = 0
+    # From the first row to the last chunk, including the time spent reading Mongo.
+    with timed('report'):
+        async for row in rows:
+            writer.writerow(row)
+            count += 1
+            if count % rows_per_chunk == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate(0)
+        yield output.getvalue()
+
+
+async def iter_gzip(chunks: AsyncIterable[str]) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def csv_response(rows: AsyncIterable[dict], fieldnames: List[str], filename: str, gzip: bool = False) -> StreamingResponse:
+    content = iter_csv(rows, fieldnames)
+    if gzip:
+        response = StreamingResponse(iter_gzip(content), media_type="application/gzip")
+        filename = f"{filename}.gz"
+    else:
+        response = StreamingResponse(content, media_type="text/csv")
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
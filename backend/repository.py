@@ -0,0 +1,207 @@
+import base64
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Collection, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorCursor
+from pymongo import MongoClient
+from models import BATCH_TRANSITIONS, Batch, BatchPage, BatchStatus, BatchSummary, IngestError, IngestErrorPage
+
+BATCH_SUMMARY_PROJECTION = {field.alias: 1 for field in BatchSummary.__fields__.values()}
+
+
+def create_client(mongo_uri: str, max_pool_size: int = 100, min_pool_size: int = 0) -> AsyncIOMotorClient:
+    "Pooled async Mongo client, one per process, shared by every request handler or job."
+    return AsyncIOMotorClient(mongo_uri, maxPoolSize=max_pool_size, minPoolSize=min_pool_size)
+
+
+def create_sync_client(mongo_uri: str, max_pool_size: int = 16, timeout_ms: int = 2000) -> MongoClient:
+    """
+    Blocking client for the code that runs on the Method executor threads, e.g. the shared rate limiter.
+    Short timeouts so that callers can fall back quickly when Mongo is unreachable.
+    """
+    return MongoClient(mongo_uri, maxPoolSize=max_pool_size, serverSelectionTimeoutMS=timeout_ms, socketTimeoutMS=timeout_ms)
+
+
+def encode_cursor(batch: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps([batch['date_created'].isoformat(), str(batch['_id'])]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> dict:
+    "Keyset filter for the batches after the cursor in (date_created, _id) descending order."
+    try:
+        date_created, _id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        date_created, _id = datetime.fromisoformat(date_created), ObjectId(_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    return {'$or': [{'date_created': {'$lt': date_created}},
+                    {'date_created': date_created, '_id': {'$lt': _id}}]}
+
+
+@dataclass
+class ProgressRepository:
+    """
+    Live counters and status of every batch, one document per batch updated as ingestion and payouts go.
+    Kept apart from the batches so that progress does not change the listing ETag.
+    """
+    collection: AsyncIOMotorCollection
+
+    async def inc(self, batch_id: str, **counters: int):
+        await self.collection.update_one({'_id': batch_id}, {'$inc': counters, '$set': {'date_updated': datetime.utcnow()}}, upsert=True)
+
+    async def set(self, batch_id: str, **fields):
+        await self.collection.update_one({'_id': batch_id}, {'$set': {**fields, 'date_updated': datetime.utcnow()}}, upsert=True)
+
+    async def get(self, batch_id: str) -> Optional[dict]:
+        return await self.collection.find_one({'_id': batch_id})
+
+    def changed_since(self, since: datetime) -> AsyncIOMotorCursor:
+        return self.collection.find({'date_updated': {'$gte': since}})
+
+
+@dataclass
+class BatchRepository:
+    collection: AsyncIOMotorCollection
+    # Holds a single document whose version changes on every batch write, used for ETags.
+    versions: Optional[AsyncIOMotorCollection] = None
+    # Status changes are published to the batch progress.
+    progress: Optional[ProgressRepository] = None
+
+    async def insert(self, batch: Batch):
+        await self.collection.insert_one(batch.dict(by_alias=True))
+        await self.touch()
+        if self.progress:
+            await self.progress.set(str(batch.id), status=batch.status)
+
+    async def get(self, batch_id) -> Optional[dict]:
+        return await self.collection.find_one({'_id': ObjectId(batch_id)})
+
+    async def page(self, statuses: Optional[List[str]] = None, limit: int = 100, after: Optional[str] = None) -> BatchPage:
+        "Newest batches first, keyset paginated on (date_created, _id)."
+        query = decode_cursor(after) if after else {}
+        if statuses:
+            query['status'] = {'$in': statuses}
+        cursor = self.collection.find(query, BATCH_SUMMARY_PROJECTION).sort([('date_created', -1), ('_id', -1)]).limit(limit + 1)
+        batches = await cursor.to_list(limit + 1)
+        next_cursor = encode_cursor(batches[limit - 1]) if len(batches) > limit else None
+        return BatchPage(items=[BatchSummary(**batch) for batch in batches[:limit]], next_cursor=next_cursor)
+
+    def created_between(self, start: datetime, end: datetime) -> AsyncIOMotorCursor:
+        "Batches created in [start, end), oldest first."
+        return self.collection.find({'date_created': {'$gte': start, '$lt': end}},
+                                    {'batch_name': 1, 'date_created': 1}).sort([('date_created', 1), ('_id', 1)])
+
+    async def update(self, batch_id, fields: Dict[str, Any]):
+        await self.collection.update_one({'_id': ObjectId(batch_id)}, {'$set': fields})
+        await self.touch()
+
+    async def transition(self, batch_id, status: BatchStatus, fields: Optional[Dict[str, Any]] = None) -> bool:
+        "Move a batch to status if its current status allows it, atomically. False when it does not."
+        sources = [source.value for source, targets in BATCH_TRANSITIONS.items() if status in targets]
+        result = await self.collection.update_one({'_id': ObjectId(batch_id), 'status': {'$in': sources}},
+                                                  {'$set': {**(fields or {}), 'status': status.value}})
+        if result.modified_count:
+            await self.touch()
+            if self.progress:
+                await self.progress.set(str(batch_id), status=status.value)
+        return result.modified_count == 1
+
+    async def add_timings(self, batch_id, timings: Dict[str, Dict[str, float]]):
+        "Add stage timings to the batch, several workers can add to the same batch."
+        increments = {f'timings.{stage}.{key}': value for stage, totals in timings.items() for key, value in totals.items()}
+        if increments:
+            await self.collection.update_one({'_id': ObjectId(batch_id)}, {'$inc': increments})
+
+    async def touch(self):
+        if self.versions is not None:
+            await self.versions.update_one({'_id': 'batches'}, {'$set': {'version': ObjectId()}}, upsert=True)
+
+    async def etag(self, *params) -> Optional[str]:
+        "Weak ETag of a listing, changes whenever any batch is written. Reads one small document, not the batches."
+        if self.versions is None:
+            return None
+        document = await self.versions.find_one({'_id': 'batches'})
+        version = str(document['version']) if document else ''
+        digest = hashlib.sha1(json.dumps([version, *params], default=str).encode()).hexdigest()
+        return f'W/"{digest}"'
+
+
+@dataclass
+class TransactionRepository:
+    collection: AsyncIOMotorCollection
+
+    async def insert_many(self, documents: List[dict]):
+        if documents:
+            await self.collection.insert_many(documents)
+
+    async def exists(self, batch_id: str) -> bool:
+        return bool(await self.collection.count_documents({'batch_id': batch_id}, limit=1))
+
+    async def delete_attempt(self, batch_id: str, attempt: int) -> int:
+        "Remove what an ingest attempt created, so an interrupted attempt can run again."
+        return (await self.collection.delete_many({'batch_id': batch_id, 'attempt': attempt})).deleted_count
+
+    async def count(self, batch_id: str) -> int:
+        return await self.collection.count_documents({'batch_id': batch_id})
+
+    def find(self, query: dict, projection: Optional[dict] = None, batch_size: int = 1000) -> AsyncIOMotorCursor:
+        return self.collection.find(query, projection).batch_size(batch_size)
+
+    def payments(self, batch_id: str, batch_size: int = 1000) -> AsyncIOMotorCursor:
+        "Payment sub-documents of a batch, only the transactions that have one."
+        return self.find({'batch_id': batch_id, 'payment': {'$ne': None}}, {'payment': 1, '_id': 0}, batch_size)
+
+    def aggregate(self, pipeline: List[dict], batch_size: int = 1000):
+        return self.collection.aggregate(pipeline, batchSize=batch_size)
+
+    async def bulk_write(self, updates: List) -> int:
+        "Returns the number of transactions matched by the updates."
+        if not updates:
+            return 0
+        result = await self.collection.bulk_write(updates, ordered=False)
+        return result.matched_count
+
+
+@dataclass
+class IngestErrorRepository:
+    "Rows rejected while parsing an upload, one document per row and ingest attempt."
+    collection: AsyncIOMotorCollection
+
+    async def insert_many(self, batch_id: str, errors: List[dict], attempt: int = 0):
+        if errors:
+            await self.collection.insert_many([{**error, 'batch_id': batch_id, 'attempt': attempt} for error in errors])
+
+    async def count(self, batch_id: str) -> int:
+        return await self.collection.count_documents({'batch_id': batch_id})
+
+    async def page(self, batch_id: str, limit: int = 100, after: Optional[str] = None) -> IngestErrorPage:
+        "Errors of a batch in the order they were recorded, keyset paginated on _id."
+        query = {'batch_id': batch_id}
+        if after:
+            if not ObjectId.is_valid(after):
+                raise ValueError('Invalid cursor')
+            query['_id'] = {'$gt': ObjectId(after)}
+        errors = await self.collection.find(query).sort('_id', 1).limit(limit + 1).to_list(limit + 1)
+        next_cursor = str(errors[limit - 1]['_id']) if len(errors) > limit else None
+        return IngestErrorPage(items=[IngestError(**error) for error in errors[:limit]], next_cursor=next_cursor)
+
+    async def records(self, batch_id: str) -> List[Tuple[int, Dict[str, Optional[str]]]]:
+        "(row index, raw record) of every rejected row of a batch, in row order."
+        cursor = self.collection.find({'batch_id': batch_id}, {'row': 1, 'record': 1}).sort('row', 1)
+        return [(error['row'], error['record']) async for error in cursor]
+
+    async def delete_attempt(self, batch_id: str, attempt: int):
+        await self.collection.delete_many({'batch_id': batch_id, 'attempt': attempt})
+
+    async def delete_previous(self, batch_id: str, attempt: int, rows: Optional[Collection[int]] = None):
+        """
+        Drop the errors recorded before attempt for the rows that attempt read again, all of them without rows.
+        The rows that failed again were recorded under attempt.
+        """
+        query = {'batch_id': batch_id, 'attempt': {'$lt': attempt}}
+        if rows is not None:
+            query['row'] = {'$in': sorted(rows)}
+        await self.collection.delete_many(query)
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from models import parse_amount
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorCursor
+from pymongo import DeleteMany, UpdateOne
+from repository import TransactionRepository
+
+SOURCE = 'source'
+BRANCH = 'branch'
+STATUS = 'status'
+
+# Field each rollup kind groups the transactions of a batch by.
+GROUP_FIELDS = {
+    SOURCE: '$payment.source',
+    BRANCH: '$transaction.Payor.DunkinId',
+    STATUS: '$status',
+}
+
+
+def _source(tnx: dict) -> Optional[str]:
+    return (tnx.get('payment') or {}).get('source')
+
+
+class BatchRollups:
+    """
+    Per batch totals (amount in cents and count) by payment source, payor branch and status, one document per group.
+    They are kept up to date with $inc as transactions are created and paid, so reports read O(groups) documents
+    instead of aggregating the whole batch. A batch without rollups is recomputed from the transactions on first read.
+    """
+    def __init__(self, collection: AsyncIOMotorCollection, transactions: TransactionRepository):
+        self.collection = collection
+        self.transactions = transactions
+
+    async def _inc(self, batch_id: str, deltas: Dict[Tuple[str, Optional[str]], List[int]]):
+        updates = [UpdateOne({'batch_id': batch_id, 'kind': kind, 'key': key},
+                             {'$inc': {'total': total, 'count': count}},
+                             upsert=True)
+                   for (kind, key), (total, count) in deltas.items() if total or count]
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False)
+
+    async def add_transactions(self, batch_id: str, transactions: Iterable[dict]):
+        "Account for newly inserted transaction summaries."
+        deltas = defaultdict(lambda: [0, 0])
+        for tnx in transactions:
+            amount = parse_amount(tnx['transaction']['Amount'])
+            for key in ((SOURCE, _source(tnx)), (BRANCH, tnx['transaction']['Payor']['DunkinId']), (STATUS, tnx['status'])):
+                deltas[key][0] += amount
+                deltas[key][1] += 1
+        await self._inc(batch_id, deltas)
+
+    async def apply_payouts(self, batch_id: str, changes: Iterable[Tuple[dict, dict]]):
+        "Move transactions between status/source groups, changes are (transaction before, fields set by the payout)."
+        deltas = defaultdict(lambda: [0, 0])
+        for before, result in changes:
+            amount = parse_amount(before['transaction']['Amount'])
+            for kind, old, new in ((STATUS, before.get('status'), result.get('status')), (SOURCE, _source(before), _source(result))):
+                if old == new:
+                    continue
+                deltas[(kind, old)][0] -= amount
+                deltas[(kind, old)][1] -= 1
+                deltas[(kind, new)][0] += amount
+                deltas[(kind, new)][1] += 1
+        await self._inc(batch_id, deltas)
+
+    async def aggregate(self, batch_id: str, kind: str) -> Dict[Optional[str], Tuple[int, int]]:
+        pipeline = [
+            {"$match": {"batch_id": batch_id}},
+            {"$group": {"_id": GROUP_FIELDS[kind], "total": {"$sum": "$transaction.Amount"}, "count": {"$sum": 1}}},
+        ]
+        return {result['_id']: (result['total'], result['count']) async for result in self.transactions.aggregate(pipeline)}
+
+    async def recompute(self, batch_id: str):
+        """
+        Rebuild the rollups of a batch from its transactions. Groups are overwritten in place and stale ones removed,
+        so concurrent $inc upserts never meet a missing document or a duplicate key.
+        """
+        requests = []
+        for kind in GROUP_FIELDS:
+            groups = await self.aggregate(batch_id, kind)
+            requests += [UpdateOne({'batch_id': batch_id, 'kind': kind, 'key': key}, {'$set': {'total': total, 'count': count}}, upsert=True)
+                         for key, (total, count) in groups.items()]
+            requests.append(DeleteMany({'batch_id': batch_id, 'kind': kind, 'key': {'$nin': list(groups)}}))
+        await self.collection.bulk_write(requests, ordered=False)
+
+    async def totals(self, batch_id: str, kind: str) -> AsyncIOMotorCursor:
+        "Rollup documents of one kind for a batch, with the recompute fallback for batches without rollups."
+        query = {'batch_id': batch_id, 'kind': kind, 'count': {'$gt': 0}}
+        projection = {'_id': 0, 'key': 1, 'total': 1, 'count': 1}
+        if not await self.collection.count_documents({'batch_id': batch_id}, limit=1):
+            await self.recompute(batch_id)
+        return self.collection.find(query, projection)
+
+    async def check(self, batch_id: str) -> dict:
+        "Compare the stored rollups with a fresh aggregation of the transactions."
+        differences = []
+        for kind in GROUP_FIELDS:
+            expected = await self.aggregate(batch_id, kind)
+            stored = {doc['key']: (doc['total'], doc['count'])
+                      async for doc in self.collection.find({'batch_id': batch_id, 'kind': kind, 'count': {'$ne': 0}})}
+            for key in expected.keys() | stored.keys():
+                expected_total, expected_count = expected.get(key, (0, 0))
+                stored_total, stored_count = stored.get(key, (0, 0))
+                if expected_count != stored_count or expected_total != stored_total:
+                    differences.append({'kind': kind, 'key': key,
+                                        'expected_total': expected_total, 'stored_total': stored_total,
+                                        'expected_count': expected_count, 'stored_count': stored_count})
+        return {'batch_id': batch_id, 'consistent': not differences, 'differences': differences}
@@ -0,0 +1,50 @@
+"""
+Exact per source, branch and status totals of a batch, to reconcile it before its payouts are invoked.
+The rollups are kept up to date incrementally, these are computed from the transactions themselves: the columns
+are read once and every grouping is summed with NumPy in integer cents.
+"""
+from typing import Dict, List, Optional
+
+import numpy as np
+from models import BatchTotals, GroupTotal, parse_amount
+from repository import TransactionRepository
+
+SUMMARY_PROJECTION = {'_id': 0, 'transaction.Amount': 1, 'transaction.Payor.DunkinId': 1, 'status': 1, 'source': 1}
+
+
+class Codes:
+    "Dense integer code per distinct key, in order of first appearance."
+    def __init__(self):
+        self.index: Dict[Optional[str], int] = {}
+
+    def __call__(self, key: Optional[str]) -> int:
+        code = self.index.get(key)
+        if code is None:
+            code = self.index[key] = len(self.index)
+        return code
+
+    def totals(self, codes: np.ndarray, amounts: np.ndarray) -> List[GroupTotal]:
+        totals = np.zeros(len(self.index), dtype=np.int64)
+        np.add.at(totals, codes, amounts)
+        counts = np.bincount(codes, minlength=len(self.index))
+        return [GroupTotal(key=key, total=int(totals[code]), count=int(counts[code])) for key, code in self.index.items()]
+
+
+def summarize(amounts: List[int], groups: Dict[str, Codes], codes: Dict[str, List[int]]) -> Dict[str, List[GroupTotal]]:
+    "Totals per group of every grouping, codes holds the group code of each amount per grouping."
+    values = np.array(amounts, dtype=np.int64)
+    return {name: groups[name].totals(np.array(codes[name], dtype=np.intp), values) for name in groups}
+
+
+async def summarize_batch(transactions: TransactionRepository, batch_id: str, batch_size: int = 1000) -> BatchTotals:
+    "Totals of a batch by Method source account, payor branch and status."
+    groups = {'sources': Codes(), 'branches': Codes(), 'statuses': Codes()}
+    codes: Dict[str, List[int]] = {name: [] for name in groups}
+    amounts = []
+    async for tnx in transactions.find({'batch_id': batch_id}, SUMMARY_PROJECTION, batch_size):
+        amounts.append(parse_amount(tnx['transaction']['Amount']))
+        codes['sources'].append(groups['sources'](tnx.get('source')))
+        codes['branches'].append(groups['branches'](tnx['transaction']['Payor']['DunkinId']))
+        codes['statuses'].append(groups['statuses'](tnx.get('status')))
+    totals = summarize(amounts, groups, codes)
+    return BatchTotals(batch_id=batch_id, total=sum(group.total for group in totals['statuses']), count=len(amounts), **totals)
@@ -0,0 +1,93 @@
+import asyncio
+import io
+import json
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from bson import ObjectId
+
+from export import EXPORT_SCHEMA, export_row, iter_export
+from models import ExportFormat
+
+BATCH = {'_id': ObjectId(), 'batch_name': 'payroll', 'date_created': datetime(2024, 1, 31)}
+
+# Payment as returned by Method, fee and metadata are objects.
+PAYMENT = {
+    'id': 'pmt_rPrDPEwyCVUcm',
+    'reversal_id': None,
+    'source_trace_id': None,
+    'destination_trace_id': None,
+    'source': 'acc_JMJZT6r7iHi8e',
+    'destination': 'acc_AXthnzpBnxxWP',
+    'amount': 5000,
+    'description': 'Loan Pmt',
+    'status': 'pending',
+    'fund_status': 'pending',
+    'error': None,
+    'metadata': {'batch': 'payroll'},
+    'estimated_completion_date': '2024-02-02',
+    'source_settlement_date': '2024-02-01',
+    'destination_settlement_date': '2024-02-02',
+    'fee': {'type': 'standard', 'amount': 0},
+    'type': 'standard',
+    'created_at': '2024-01-31T21:24:38.397Z',
+    'updated_at': '2024-01-31T21:24:38.888Z',
+}
+
+TRANSACTION = {
+    '_id': ObjectId(),
+    'batch_id': str(BATCH['_id']),
+    'status': 'success',
+    'source': PAYMENT['source'],
+    'destination': PAYMENT['destination'],
+    'payout_date': datetime(2024, 1, 31, 21, 24),
+    'transaction': {
+        'Employee': {'DunkinId': 'EMP-1', 'DunkinBranch': 'BRC-1', 'FirstName': 'Ada', 'LastName': 'Lovelace',
+                     'DOB': '1990-12-10', 'PhoneNumber': '+15121231111'},
+        'Payor': {'DunkinId': 'CORP-1', 'ABARouting': '011000028', 'AccountNumber': '1234', 'Name': 'Dunkin',
+                  'DBA': 'Dunkin', 'EIN': '32120240', 'Address': {'Line1': '1 Main St', 'City': 'Austin', 'State': 'TX', 'Zip': '78701'}},
+        'Payee': {'PlaidId': 'ins_1', 'LoanAccountNumber': '5678'},
+        'Amount': 5000,
+    },
+    'payment': PAYMENT,
+}
+
+
+async def collect(chunks) -> bytes:
+    return b''.join([chunk async for chunk in chunks])
+
+
+async def one(record_batch):
+    yield record_batch
+
+
+def test_export_row_keeps_payment_objects_as_json():
+    row = export_row(BATCH, TRANSACTION)
+    assert row['payment.amount'] == 5000
+    assert json.loads(row['payment.fee']) == {'type': 'standard', 'amount': 0}
+    assert json.loads(row['payment.metadata']) == {'batch': 'payroll'}
+    assert row['Amount'] == 5000
+    assert row['Payor.Address.City'] == 'Austin'
+
+
+def test_export_row_of_a_legacy_float_amount():
+    transaction = {**TRANSACTION, 'transaction': {**TRANSACTION['transaction'], 'Amount': 5.03}}
+    assert export_row(BATCH, transaction)['Amount'] == 503
+
+
+def test_parquet_export_of_a_paid_transaction():
+    record_batch = pa.RecordBatch.from_pylist([export_row(BATCH, TRANSACTION)], schema=EXPORT_SCHEMA)
+    data = asyncio.run(collect(iter_export(one(record_batch), ExportFormat.PARQUET)))
+    table = pq.read_table(io.BytesIO(data))
+    assert table.schema.equals(EXPORT_SCHEMA)
+    assert table.column('payment.fee').to_pylist() == [json.dumps(PAYMENT['fee'])]
+    assert table.column('payment.amount').to_pylist() == [5000]
+
+
+def test_arrow_export_of_a_paid_transaction():
+    record_batch = pa.RecordBatch.from_pylist([export_row(BATCH, TRANSACTION)], schema=EXPORT_SCHEMA)
+    data = asyncio.run(collect(iter_export(one(record_batch), ExportFormat.ARROW)))
+    table = pa.ipc.open_stream(data).read_all()
+    assert table.num_rows == 1
+    assert table.column('payment.id').to_pylist() == [PAYMENT['id']]
@@ -0,0 +1,69 @@
+import pytest
+
+from models import format_cents, parse_amount
+
+
+@pytest.mark.parametrize('value, cents', [
+    ('5.03', 503),
+    ('$5.03', 503),
+    ('$1,234.56', 123456),
+    ('1.234,56 €', 123456),
+    ('1 234,5', 123450),
+    ('12,34', 1234),
+    ('1,234,567', 123456700),
+    ('1.234.567,89', 123456789),
+    ('$1,500', 150000),
+    (5.03, 503),
+    (0.1 + 0.2, 30),
+    ('1.500 €', 150000),
+    ('USD 2,500', 250000),
+    ('7', 700),
+    (12.5, 1250),
+    (503, 503),
+])
+def test_parse_amount(value, cents):
+    assert parse_amount(value) == cents
+
+
+@pytest.mark.parametrize('value', [
+    # A lone separator followed by three digits is not a thousands separator without a currency that says so.
+    '0.001',
+    '0.125',
+    '1.500',
+    '12.345',
+    '1,500',
+    # Leading groups of zero or more than three digits are not thousands groups.
+    '$0,125',
+    '€0.125',
+    '1234,567',
+    # More than two decimals.
+    '1,234.567',
+    '1.2345',
+    '€1,500',
+    # Malformed.
+    '1.234.56',
+    '1,23,456',
+    'n/a',
+    '',
+    '-5.00',
+])
+def test_parse_amount_rejects(value):
+    with pytest.raises(ValueError):
+        parse_amount(value)
+
+
+def test_parse_amount_rejects_fractions_of_a_cent():
+    with pytest.raises(ValueError):
+        parse_amount(0.001)
+
+
+def test_format_cents():
+    assert format_cents(123456) == '1234.56'
+    assert format_cents(5) == '0.05'
+    assert format_cents(-150) == '-1.50'
+
+
+def test_format_cents_of_a_float_total_in_dollars():
+    assert format_cents(5.03) == '5.03'
+    assert format_cents(1234.5) == '1234.50'
+    assert format_cents(0.1 + 0.2) == '0.30'
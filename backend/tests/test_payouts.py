@@ -0,0 +1,130 @@
+import asyncio
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from method.errors import MethodInvalidRequestError
+
+import payouts
+from method_manager import MethodExecutor
+from payouts import PayoutRunner
+from rate_limiter import RateLimitExceeded
+
+
+class Cursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def sort(self, *args):
+        return self
+
+    async def to_list(self, length):
+        rows, self.rows = self.rows[:length], self.rows[length:]
+        return rows
+
+    async def __aiter__(self):
+        for row in self.rows:
+            yield row
+
+
+class Transactions:
+    "Transactions of one batch in memory, a row is paid once it has a payout_date like in Mongo."
+    def __init__(self, rows):
+        self.rows = {row['_id']: row for row in rows}
+
+    def find(self, query, projection=None, batch_size=1000):
+        if 'payout_chunk' in query:
+            return Cursor([dict(row) for row in self.rows.values() if row.get('payout_chunk') == query['payout_chunk']])
+        return Cursor([dict(row) for row in self.rows.values() if 'payout_date' not in row])
+
+    async def bulk_write(self, updates) -> int:
+        written = 0
+        for update in updates:
+            row = self.rows[update._filter['_id']]
+            if 'payout_date' not in row:
+                row.update(update._doc['$set'])
+                written += 1
+        return written
+
+
+class Jobs:
+    def __init__(self):
+        self.counters = Counter()
+
+    async def update_one(self, query, update):
+        self.counters.update(update.get('$inc', {}))
+
+
+class Batches:
+    async def add_timings(self, *args):
+        pass
+
+
+class Rollups:
+    def __init__(self):
+        self.changes = []
+
+    async def apply_payouts(self, batch_id, changes):
+        self.changes += [(before['_id'], result['status']) for before, result in changes]
+
+
+def transaction() -> dict:
+    return {'_id': ObjectId(), 'status': 'pending', 'source': 'acc_source', 'destination': 'acc_destination', 'transaction': {'Amount': 5000}}
+
+
+@pytest.fixture
+def runner():
+    rows = [transaction() for _ in range(3)]
+    return PayoutRunner(SimpleNamespace(executor=MethodExecutor(2)), Batches(), Transactions(rows), Jobs(), Rollups(), chunk_size=2)
+
+
+def run_shard(runner: PayoutRunner):
+    ids = sorted(runner.transactions.rows)
+    asyncio.run(runner.run_shard('batch', ids[0], ids[-1]))
+
+
+def test_a_rejected_payout_is_left_unpaid_and_paid_on_resume(runner, monkeypatch):
+    rejected = str(sorted(runner.transactions.rows)[1])
+    keys = []
+
+    def invoke_payment(amount, source, destination, method_client, idempotency_key=None):
+        keys.append(idempotency_key)
+        if idempotency_key == rejected and keys.count(rejected) == 1:
+            raise RateLimitExceeded('CREATE_PAYMENT')
+        return {'id': f'pmt_{idempotency_key}', 'amount': amount}
+
+    monkeypatch.setattr(payouts.TransactionService, 'invoke_payment', staticmethod(invoke_payment))
+    with pytest.raises(RuntimeError):
+        run_shard(runner)
+    statuses = {str(_id): row.get('status') for _id, row in runner.transactions.rows.items()}
+    assert statuses.pop(rejected) == 'pending'
+    assert set(statuses.values()) == {'success'}
+    assert runner.jobs.counters == {'processed': 2, 'paid': 2, 'failed': 0}
+
+    run_shard(runner)
+    row = runner.transactions.rows[ObjectId(rejected)]
+    assert row['status'] == 'success'
+    assert row['payment'] == {'id': f'pmt_{rejected}', 'amount': 5000}
+    # Sent again with the same idempotency key, the rows paid before are not sent again.
+    assert keys.count(rejected) == 2
+    assert len(keys) == 4
+    assert runner.jobs.counters == {'processed': 3, 'paid': 3, 'failed': 0}
+
+
+def test_a_payout_refused_by_method_is_failed(runner, monkeypatch):
+    def invoke_payment(amount, source, destination, method_client, idempotency_key=None):
+        raise MethodInvalidRequestError({'type': 'INVALID_REQUEST', 'message': 'Invalid destination'})
+
+    monkeypatch.setattr(payouts.TransactionService, 'invoke_payment', staticmethod(invoke_payment))
+    run_shard(runner)
+    assert {row['status'] for row in runner.transactions.rows.values()} == {'failed'}
+    assert all('payout_date' in row for row in runner.transactions.rows.values())
+    assert runner.jobs.counters == {'processed': 3, 'paid': 0, 'failed': 3}
+
+
+def test_rows_skipped_again_are_not_rolled_up_twice(runner):
+    rows = list(runner.transactions.rows.values())
+    assert asyncio.run(runner.skip('batch', rows[:2])) == 2
+    assert asyncio.run(runner.skip('batch', rows)) == 1
+    assert sorted(runner.rollups.changes) == sorted((row['_id'], 'skipped') for row in rows)
@@ -0,0 +1,166 @@
+import asyncio
+import random
+from bisect import bisect_left
+
+import mongomock
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import rate_limiter
+from benchmarks.fake_method import FakeMethod, FakeMethodApi
+from method_manager import TransactionService
+from rate_limiter import GLOBAL, MongoTokenBucket, RateLimiter, RateLimitExceeded, TokenBucket
+
+
+class Clock:
+    "Stands in for the time module of rate_limiter, sleeping only moves the clock."
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+def max_in_window(times, period: float) -> int:
+    "Most calls in any window of period seconds."
+    times = sorted(times)
+    # A little slack for float rounding of the waits.
+    return max(index - bisect_left(times, start - period + 1e-6) + 1 for index, start in enumerate(times))
+
+
+def run_callers(clock: Clock, reserve, calls: int, seed: int = 0):
+    "Reserve calls at random moments, each one happens after its wait."
+    rng = random.Random(seed)
+    times = []
+    for _ in range(calls):
+        clock.now += rng.choice((0.0, 0.0, 0.01, 0.5, 3.0))
+        times.append(clock.now + reserve())
+    return times
+
+
+def test_token_bucket_never_exceeds_budget(clock):
+    bucket = TokenBucket(60, 10)
+    times = run_callers(clock, bucket.reserve, 600)
+    assert max_in_window(times, 10) <= 60
+
+
+def test_token_bucket_serves_burst_without_waiting(clock):
+    bucket = TokenBucket(600, 60, burst=10)
+    assert [bucket.reserve() for _ in range(10)] == [0.0] * 10
+    # The rest of the budget trickles in, calls - burst tokens per period.
+    assert bucket.reserve() == pytest.approx(60 / 590)
+
+
+def test_token_bucket_max_wait_takes_no_token(clock):
+    bucket = TokenBucket(600, 60, burst=1)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve(max_wait=0.01) is None
+    assert bucket.reserve() == pytest.approx(60 / 599)
+
+
+def test_mongo_buckets_share_the_budget(clock):
+    collection = mongomock.MongoClient().db.rate_limits
+    buckets = [MongoTokenBucket(collection, 'method:*', 60, 10) for _ in range(4)]
+    rng = random.Random(1)
+    times = run_callers(clock, lambda: rng.choice(buckets).reserve(), 600)
+    assert max_in_window(times, 10) <= 60
+
+
+def test_shared_limiters_hold_the_budget_across_instances(clock):
+    collection = mongomock.MongoClient().db.rate_limits
+    limiters = [RateLimiter(120, 60, {'CREATE_PAYMENT': 30}, collection, fallback_share=3) for _ in range(3)]
+    rng = random.Random(2)
+    payments, others = [], []
+    for _ in range(900):
+        clock.now += rng.choice((0.0, 0.05, 1.0))
+        limiter = rng.choice(limiters)
+        operation = rng.choice(('CREATE_PAYMENT', 'CREATE_ACCOUNT'))
+        at = clock.now + limiter.reserve(operation)
+        (payments if operation == 'CREATE_PAYMENT' else others).append(at)
+    assert max_in_window(payments + others, 60) <= 120
+    assert max_in_window(payments, 60) <= 30
+    assert sum(limiter.stats()['CREATE_PAYMENT']['fallback'] for limiter in limiters) == 0
+
+
+def test_limiters_fall_back_to_their_share_without_mongo(clock):
+    class Down:
+        def find_one(self, *args, **kwargs):
+            raise ServerSelectionTimeoutError('down')
+
+    limiters = [RateLimiter(120, 60, collection=Down(), fallback_share=3) for _ in range(3)]
+    rng = random.Random(3)
+    times = run_callers(clock, lambda: rng.choice(limiters).reserve(GLOBAL), 900)
+    assert max_in_window(times, 60) <= 120
+    assert all(limiter.stats()[GLOBAL]['fallback'] == limiter.stats()[GLOBAL]['calls'] for limiter in limiters)
+
+
+def test_rejects_calls_that_would_wait_too_long(clock):
+    limiter = RateLimiter(120, 60, max_wait=1.0)
+    with pytest.raises(RateLimitExceeded):
+        for _ in range(10):
+            limiter.reserve('CREATE_PAYMENT')
+    assert limiter.stats()['CREATE_PAYMENT']['rejected'] == 1
+
+
+def test_token_bucket_clamps_the_burst_to_the_budget(clock):
+    bucket = TokenBucket(5, 60, burst=10)
+    assert bucket.capacity == 5
+    times = run_callers(clock, bucket.reserve, 100)
+    assert max_in_window(times, 60) <= 5
+
+
+def test_a_budget_of_one_call_per_window(clock):
+    limiter = RateLimiter(600, 60, {'CREATE_PAYMENT': 1})
+    times = []
+    for _ in range(4):
+        limiter.acquire('CREATE_PAYMENT')
+        times.append(clock.now)
+    assert times == [1000.0, 1060.0, 1120.0, 1180.0]
+    assert max_in_window(times, 60) == 1
+
+
+def test_a_rejected_call_gives_back_its_operation_token(clock):
+    limiter = RateLimiter(60, 60, {'CREATE_PAYMENT': 10}, max_wait=0)
+    limiter.acquire('LIST_MERCHANTS')
+    # The global budget is empty, the CREATE_PAYMENT token taken first is given back.
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire('CREATE_PAYMENT')
+    clock.sleep(2)
+    assert limiter.acquire('CREATE_PAYMENT') == 0
+
+
+def test_a_rejected_call_gives_back_its_shared_operation_token(clock):
+    collection = mongomock.MongoClient().db.rate_limits
+    limiter = RateLimiter(60, 60, {'CREATE_PAYMENT': 10}, collection=collection, max_wait=0)
+    limiter.acquire('LIST_MERCHANTS')
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire('CREATE_PAYMENT')
+    clock.sleep(2)
+    assert limiter.acquire('CREATE_PAYMENT') == 0
+
+
+def test_payments_from_several_threads_stay_within_the_method_budget():
+    # Real time: the calls are 1/19s apart while the budget allows 20 a second, thread scheduling cannot overrun it.
+    api = FakeMethodApi(calls=20, period=1, latency=0.01)
+    method = FakeMethod(api, calls=20, period=1, max_in_flight=4)
+
+    def pay(index: int):
+        return TransactionService.invoke_payment(100, 'acc_source', 'acc_destination', method, idempotency_key=str(index))
+
+    payments = asyncio.run(method.executor.map(pay, range(40)))
+    assert len({payment['id'] for payment in payments}) == 40
+    assert api.rejected == 0
+    assert api.max_calls_in_window() <= 20
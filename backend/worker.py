@@ -0,0 +1,183 @@
+"""
+Job worker, runs the ingestion and payout jobs queued by the API.
+
+    python worker.py                 # Config.WORKER_PROCESSES processes
+    python worker.py --processes 8
+
+Every process runs one job at a time. The processes share the Method rate limit through Mongo, if it cannot
+be reached each one falls back to an even split of the budget.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from account_cache import AccountCache
+from config import Config
+from dedup import UploadHashes
+from fastapi.logger import logger
+from ingest import Ingestor
+from jobs import INGEST, PAYOUT, RETRY, JobQueue, WorkerRegistry
+from method_manager import MethodWrapper
+from metrics import METRICS
+from models import JobStatus
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from payouts import PayoutRunner
+from rate_limiter import RateLimiter
+from repository import BatchRepository, IngestErrorRepository, ProgressRepository, TransactionRepository, create_client, create_sync_client
+from rollups import BatchRollups
+
+
+@dataclass
+class Worker:
+    queue: JobQueue
+    registry: WorkerRegistry
+    ingestor: Ingestor
+    payouts: PayoutRunner
+    worker_id: str
+    lease_seconds: float = 60
+    poll_interval: float = 1.0
+    last_report: Optional[datetime] = None
+
+    async def run_forever(self):
+        while True:
+            job = await self.queue.claim(self.worker_id, self.lease_seconds)
+            if job is None:
+                await self.report(None)
+                await asyncio.sleep(self.poll_interval)
+                continue
+            await self.run_job(job)
+
+    async def run_job(self, job: dict):
+        "Run a claimed job, renewing its lease every third of the lease and stopping if it is lost."
+        if job['attempts'] > 1:
+            METRICS.inc('job_retries_total', kind=job['kind'])
+        await self.report(job, force=True)
+        work = asyncio.ensure_future(self.handle(job))
+        while not work.done():
+            await asyncio.wait({work}, timeout=self.lease_seconds / 3)
+            if work.done():
+                break
+            if not await self.queue.heartbeat(job['_id'], self.worker_id, self.lease_seconds):
+                logger.warning(f"Lost the lease of job {job['_id']}, stopping it")
+                work.cancel()
+            await self.report(job)
+        try:
+            work.result()
+        except asyncio.CancelledError:
+            METRICS.inc('jobs_total', kind=job['kind'], outcome='lost')
+            return
+        except Exception as e:
+            METRICS.inc('jobs_total', kind=job['kind'], outcome='failed')
+            logger.error(f"Job {job['_id']} ({job['kind']}) of batch {job['batch_id']} failed {e}")
+            if await self.queue.fail(job, self.worker_id, repr(e)) == JobStatus.FAILED.value:
+                await self.give_up(job, repr(e))
+            return
+        METRICS.inc('jobs_total', kind=job['kind'], outcome='done')
+        if await self.queue.complete(job['_id'], self.worker_id) and job['kind'] == PAYOUT:
+            run_id = job['payload']['run_id']
+            if not await self.queue.pending(job['batch_id'], PAYOUT, {'payload.run_id': run_id}):
+                await self.payouts.finish(job['batch_id'], run_id)
+
+    async def handle(self, job: dict):
+        batch_id, payload = job['batch_id'], job['payload']
+        if job['attempts'] > job['max_attempts']:
+            # The last attempt died without giving the lease back.
+            raise RuntimeError('Out of attempts')
+        if job['kind'] == INGEST:
+            await self.ingestor.create_transactions(batch_id, payload['file_id'])
+        elif job['kind'] == RETRY:
+            await self.ingestor.retry_transactions(batch_id, payload['attempt'], payload.get('file_id'))
+        elif job['kind'] == PAYOUT:
+            await self.payouts.run_shard(batch_id, payload['first'], payload['last'])
+        else:
+            raise ValueError(f"Unknown job kind {job['kind']}")
+
+    async def give_up(self, job: dict, error: str):
+        if job['kind'] == PAYOUT:
+            await self.queue.cancel(job['batch_id'], PAYOUT)
+            await self.payouts.fail(job['batch_id'])
+        elif job['kind'] == RETRY:
+            # The rows created before the retry are still good, the batch stays payable.
+            await self.ingestor.abandon_retry(job['batch_id'], job['payload']['attempt'], error, job['payload'].get('file_id'))
+        else:
+            await self.ingestor.fail(job['batch_id'])
+
+    async def report(self, job: Optional[dict], force: bool = False):
+        now = datetime.utcnow()
+        if not force and self.last_report and (now - self.last_report).total_seconds() < self.lease_seconds / 3:
+            return
+        self.last_report = now
+        await self.registry.report(self.worker_id, {
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'job_id': job['_id'] if job else None,
+            'kind': job['kind'] if job else None,
+            'batch_id': job['batch_id'] if job else None,
+            'merchant_cache': self.ingestor.method_client.merchant_cache.stats(),
+            'rate_limit': self.ingestor.method_client.rate_limiter.stats(),
+            'metrics': METRICS.snapshot(),
+        })
+
+
+def create_rate_limiter(config: Config, processes: int) -> RateLimiter:
+    "Method rate limiter shared through the rate_limits collection."
+    sync_client = create_sync_client(config.MONGO_URI, config.METHOD_MAX_IN_FLIGHT)
+    return RateLimiter(config.METHOD_RATE_LIMIT_CALLS, config.METHOD_RATE_LIMIT_PERIOD, config.METHOD_OPERATION_RATE_LIMITS,
+                       sync_client["payments"]["rate_limits"], config.METHOD_RATE_LIMIT_MAX_WAIT, fallback_share=processes)
+
+
+def create_worker(config: Config, processes: int) -> Worker:
+    client = create_client(config.MONGO_URI, config.MONGO_MAX_POOL_SIZE, config.MONGO_MIN_POOL_SIZE)
+    db = client["payments"]
+    rate_limiter = create_rate_limiter(config, processes)
+    method = MethodWrapper(env=config.METHOD_ENV,api_key=config.METHOD_API_KEY,max_in_flight=config.METHOD_MAX_IN_FLIGHT,rate_limiter=rate_limiter,
+                           merchant_cache_ttl=config.MERCHANT_CACHE_TTL,merchant_cache_size=config.MERCHANT_CACHE_SIZE)
+    progress = ProgressRepository(db["batch_progress"])
+    batches = BatchRepository(db["batches"], db["versions"], progress)
+    transactions = TransactionRepository(db["transactions"])
+    rollups = BatchRollups(db["batch_rollups"], transactions)
+    ingestor = Ingestor(method, batches, transactions, IngestErrorRepository(db["ingest_errors"]), rollups,
+                        AsyncIOMotorGridFSBucket(db, "uploads"), AccountCache(db["method_accounts"], config.ACCOUNT_CACHE_SIZE, config.METHOD_ENV),
+                        UploadHashes(db["upload_hashes"], db["row_hashes"]), progress)
+    payouts = PayoutRunner(method, batches, transactions, db["payout_jobs"], rollups, config.PAYOUT_CHUNK_SIZE, config.PAYOUT_SHARD_SIZE, progress)
+    return Worker(JobQueue(db["job_queue"], config.JOB_MAX_ATTEMPTS), WorkerRegistry(db["workers"]), ingestor, payouts,
+                  f'{socket.gethostname()}:{os.getpid()}', config.JOB_LEASE_SECONDS, config.JOB_POLL_INTERVAL)
+
+
+async def start(config: Config, processes: int):
+    worker = create_worker(config, processes)
+    # Fail at startup rather than on the first claim when Mongo does not answer.
+    try:
+        await asyncio.wait_for(worker.queue.collection.database.command('ping'), config.STARTUP_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        raise SystemExit(f"Mongo did not answer within {config.STARTUP_TIMEOUT_SECONDS}s")
+    await worker.run_forever()
+
+
+def run_process(processes: int):
+    asyncio.run(start(Config(), processes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=Config.WORKER_PROCESSES, help='number of worker processes to start')
+    args = parser.parse_args()
+    if args.processes == 1:
+        run_process(1)
+        return
+    # Spawned so every process opens its own Mongo client and Method session.
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_process, args=(args.processes,), name=f'worker-{index}') for index in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
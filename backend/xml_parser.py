@@ -1,9 +1,13 @@
 import xml.etree.ElementTree as ET
-from typing import List, Optional
+from typing import Any, Collection, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from fastapi import UploadFile
 
-from models import Address, Employee, Payee, Payor, Transaction
+from metrics import Timings, timed, timed_iter
+from models import Address, Employee, Interner, Payee, Payor, Transaction, record_error, transactions_from_records
+
+# Number of parsed transactions handed downstream at once while streaming.
+DEFAULT_CHUNK_SIZE = 1000
 
 
 def parse_address(element: ET.Element) -> Optional[Address]:
@@ -53,19 +57,122 @@ def parse_payee(element: ET.Element) -> Optional[Payee]:
         LoanAccountNumber=element.find('LoanAccountNumber').text,
     )
 
-def parse_rows_from_xml(file: UploadFile) -> List[Transaction]:
-    tree = ET.parse(file.file)
-    root = tree.getroot()
+def parse_row(row_element: ET.Element) -> Optional[Transaction]:
+    try:
+        return Transaction(
+            Employee=parse_employee(row_element.find('Employee')),
+            Payor=parse_payor(row_element.find('Payor')),
+            Payee=parse_payee(row_element.find('Payee')),
+            Amount=row_element.find('Amount').text,
+        )
+    except Exception:
+        return None
+
+def parse_record(row_element: ET.Element) -> Dict[str, Optional[str]]:
+    """
+    Flatten a <row> into {"Employee.DOB": ..., "Payor.Address.City": ..., "Amount": ...}.
+    Walks the children directly, which is much cheaper than a find per field.
+    """
+    record = {}
+    for child in row_element:
+        if not len(child):
+            record[child.tag] = child.text
+            continue
+        for field in child:
+            if not len(field):
+                record[f'{child.tag}.{field.tag}'] = field.text
+                continue
+            for nested in field:
+                record[f'{child.tag}.{field.tag}.{nested.tag}'] = nested.text
+    return record
+
+def row_error(index: int, record: Dict[str, Optional[str]]) -> Dict[str, Any]:
+    field, reason = record_error(record)
+    return {'row': index, 'field': field, 'reason': reason, 'record': record}
+
+def validate_records(records: List[Tuple[int, Dict[str, Optional[str]]]], interner: Interner,
+                     errors: Optional[List[Dict[str, Any]]] = None) -> List[Transaction]:
+    "Valid transactions of (row index, record) pairs, the rejected rows are appended to errors."
+    rows = transactions_from_records([record for _, record in records], interner)
+    if errors is not None:
+        errors.extend(row_error(index, record) for (index, record), row in zip(records, rows) if row is None)
+    return [row for row in rows if row is not None]
+
+def iter_rows_from_xml(file: UploadFile, chunk_size: int = DEFAULT_CHUNK_SIZE, bulk: bool = True,
+                       interner: Optional[Interner] = None, errors: Optional[List[Dict[str, Any]]] = None,
+                       rows: Optional[Collection[int]] = None, timings: Optional[Timings] = None,
+                       found: Optional[Set[int]] = None) -> Iterator[List[Transaction]]:
+    """
+    Stream transactions out of the uploaded xml in chunks of at most chunk_size.
+    Each <row> is cleared from the tree once parsed so memory stays flat regardless of file size.
+    In bulk mode rows are kept as flat records and validated a chunk at a time by transactions_from_records,
+    otherwise every row is validated through the pydantic models.
+    Employees and payors are interned by DunkinId, pass an interner to read the distinct counts and conflicts.
+    Rejected rows are appended to errors as they are parsed ({'row', 'field', 'reason', 'record'}), the caller
+    is expected to drain the list between chunks. With rows only those row indexes are parsed, and the ones the
+    file actually has are added to found.
+    Time spent reading the xml and validating the rows is added to timings.
+    """
+    interner = interner or Interner()
+    offset = 0
+    for elements in timed_iter(iter_row_elements(file, chunk_size), 'parse', timings):
+        indexed = list(enumerate(elements, offset))
+        offset += len(elements)
+        if rows is not None:
+            indexed = [(index, element) for index, element in indexed if index in rows]
+            if found is not None:
+                found.update(index for index, _ in indexed)
+        if bulk:
+            with timed('parse', timings):
+                records = [(index, parse_record(element)) for index, element in indexed]
+            with timed('validate', timings):
+                transactions = validate_records(records, interner, errors)
+        else:
+            transactions = []
+            with timed('validate', timings):
+                for index, element in indexed:
+                    row = parse_row(element)
+                    if row is not None:
+                        transactions.append(interner.intern_transaction(row))
+                    elif errors is not None:
+                        errors.append(row_error(index, parse_record(element)))
+        if transactions:
+            yield transactions
+
+def iter_rows_from_records(records: Iterable[Tuple[int, Dict[str, Optional[str]]]], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           interner: Optional[Interner] = None, errors: Optional[List[Dict[str, Any]]] = None,
+                           timings: Optional[Timings] = None) -> Iterator[List[Transaction]]:
+    "Same as iter_rows_from_xml for records that were already flattened, e.g. the stored rejected rows."
+    interner = interner or Interner()
+    records = list(records)
+    for start in range(0, len(records), chunk_size):
+        with timed('validate', timings):
+            transactions = validate_records(records[start:start + chunk_size], interner, errors)
+        if transactions:
+            yield transactions
+
+def iter_row_elements(file: UploadFile, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[List[ET.Element]]:
+    """Top level <row> elements of the xml in chunks, detached from the tree as soon as they are complete."""
+    context = ET.iterparse(file.file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 1
     rows = []
-    for row_element in root.findall('row'):
-        try:
-            row = Transaction(
-                Employee=parse_employee(row_element.find('Employee')),
-                Payor=parse_payor(row_element.find('Payor')),
-                Payee=parse_payee(row_element.find('Payee')),
-                Amount=row_element.find('Amount').text,
-            )
-            rows.append(row)
-        except Exception as e:
+    for event, element in context:
+        if event == 'start':
+            depth += 1
             continue
-    return rows
\ No newline at end of file
+        depth -= 1
+        if depth != 1:
+            continue
+        if element.tag == 'row':
+            rows.append(element)
+        # Drop everything parsed so far, the root element is kept alive by iterparse.
+        root.clear()
+        if len(rows) >= chunk_size:
+            yield rows
+            rows = []
+    if rows:
+        yield rows
+
+def parse_rows_from_xml(file: UploadFile) -> List[Transaction]:
+    return [row for rows in iter_rows_from_xml(file) for row in rows]
@@ -8,13 +8,14 @@ import Snackbar from "@mui/material/Snackbar";
 import TableContainer from "@mui/material/TableContainer";
 import Typography from "@mui/material/Typography";
 import { styled } from "@mui/material/styles";
-import React, { useEffect, useState } from "react";
+import React, { useCallback, useEffect, useState } from "react";
 import Modal from "react-modal";
 import LoadingSpinner from "./components/LoadingSpinner";
 import MenuComponent from "./components/MenuComponent";
 import ModalComponent from "./components/ModalComponent";
 import TableComponent from "./components/TableComponent";
 import useApiCall from "./hooks/useApiCall";
+import useBatchEvents from "./hooks/useBatchEvents";
 import useFileUpload from "./hooks/useFileUpload";
 
 Modal.setAppElement("#root");
@@ -51,6 +52,24 @@ function App() {
     setBatches(batchesData);
   };
 
+  // Live status and counters of the listed batches, pushed by the server instead of refetching the list.
+  const handleProgress = useCallback((progress) => {
+    setBatches((current) =>
+      current.map((batch) =>
+        batch._id === progress.batch_id
+          ? {
+              ...batch,
+              status: progress.status || batch.status,
+              valid_transactions: progress.valid,
+              total_transactions: progress.valid + progress.invalid,
+              progress,
+            }
+          : batch
+      )
+    );
+  }, []);
+  useBatchEvents(handleProgress);
+
   useEffect(() => {
     const fetchBatches = async () => {
       const batchesData = await fetchAllBatches();
@@ -41,7 +41,10 @@ const TableRowComponent = ({ batch, handleClick, handleInvokePayment }) => {
       <TableCell>
       {`${batch.valid_transactions} / ${batch.total_transactions}`}
       </TableCell>
-      <TableCell>{batch.status}</TableCell>
+      <TableCell>
+        {batch.status}
+        {batch.status === "Processing" && batch.progress && ` (${batch.progress.processed} / ${batch.progress.total})`}
+      </TableCell>
       <TableCell>
         {renderOptions()} {/* Render the options based on status */}
       </TableCell>
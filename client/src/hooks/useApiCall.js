@@ -50,9 +50,17 @@ const useApiCall = (setLoading, setError, setSnackbarMessage) => {
   const fetchAllBatches = async () => {
     try {
       setLoading(true);
-      const response = await axios.get(`${BASE_URL}/batches`);
+      // The listing is paginated, newest batches first. Every page is requested with the same URL each time,
+      // so the browser revalidates it with its ETag and an unchanged page comes back as 304.
+      const batches = [];
+      let after = null;
+      do {
+        const response = await axios.get(`${BASE_URL}/batches`, { params: after ? { after } : {} });
+        batches.push(...response.data.items);
+        after = response.data.next_cursor;
+      } while (after);
       setLoading(false);
-      return response.data;
+      return batches;
     } catch (error) {
       setMessage({ type: 'error', text: 'Failed to fetch batches' });
       setLoading(false);
@@ -60,10 +68,10 @@ const useApiCall = (setLoading, setError, setSnackbarMessage) => {
     }
   };
 
-  const invokePayment = async (batchId) => {
+  const invokePayment = async (batchId, force = false) => {
     try {
       setLoading(true);
-      const response = await axios.post(`${BASE_URL}/invoke-payment/${batchId}`);
+      const response = await axios.post(`${BASE_URL}/invoke-payment/${batchId}`, null, { params: { force } });
       if (response.status === 200) {
         setLoading(false);
         setSnackbarMessage({ text: "Invoked Payment Successfully.", type: "success" });
@@ -75,6 +83,13 @@ const useApiCall = (setLoading, setError, setSnackbarMessage) => {
       }
     } catch (error) {
       setLoading(false);
+      // The reconciliation found duplicate rows or payors above their limit, let the operator decide.
+      const reconciliation = error.response && error.response.status === 409 ? error.response.data.detail : null;
+      if (reconciliation && !force && window.confirm(
+        `${reconciliation.duplicates} duplicate rows and ${reconciliation.payors_over_limit.length} payors above their limit, ` +
+        `${reconciliation.missing_accounts} rows without an account will be skipped. Invoke the payment anyway?`)) {
+        return invokePayment(batchId, true);
+      }
       setSnackbarMessage({ text: "Failed to invoke payment.", type: "error" });
       setMessage({ type: 'error', text: 'Failed to invoke payment' });
     }
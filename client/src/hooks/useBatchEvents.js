@@ -0,0 +1,14 @@
+import { useEffect } from 'react';
+
+const BASE_URL = 'http://localhost:8000';
+
+// Follow the progress of every batch over server-sent events and hand each update to onProgress.
+const useBatchEvents = (onProgress) => {
+  useEffect(() => {
+    const source = new EventSource(`${BASE_URL}/events/batches`);
+    source.onmessage = (event) => onProgress(JSON.parse(event.data));
+    return () => source.close();
+  }, [onProgress]);
+};
+
+export default useBatchEvents;